@@ -12,7 +12,6 @@ import threading
 import time
 from pathlib import Path
 
-from anonymization_functions import anonymize_texts
 from GUI.text_content import JSON_EXAMPLE, LEGEND, METRICS_EXPLAINATION
 
 # make project root importable (adjust as in your project)
@@ -24,9 +23,11 @@ import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
 from PIL import Image, ImageTk
 
-from config import DEFAULT_ENTITIES, DEFAULT_OUTPUTS_IN_SINGLE_FILE,MULTI_PROCESSING, P_CORES
+from config import DEFAULT_ENTITIES, DEFAULT_OUTPUTS_IN_SINGLE_FILE,MULTI_PROCESSING, P_CORES, INFERENCE_PROFILES, \
+    DEFAULT_INFERENCE_PROFILE
 from data_generation import ANONYMIZATION_LABELS
-from utils.anonymization_utils import read_file, save_many_texts, save_metrics
+from utils.cpu_utils import plan_cpu_usage
+from utils.profile_utils import get_profile_per_matching
 
 
 # --------------------
@@ -70,9 +71,10 @@ class AnonymizerApp:
         self.selected_files = []
         self.output_dir = ""
         self.use_name_dictionary_label = tk.StringVar(value="Nessuna")
+        self.inference_profile = tk.StringVar(value=DEFAULT_INFERENCE_PROFILE)
         self.outputs_in_single_file = tk.BooleanVar(value=DEFAULT_OUTPUTS_IN_SINGLE_FILE)
         self.use_multiprocessing = tk.BooleanVar(value=MULTI_PROCESSING)
-        self.n_cores = tk.IntVar(value=P_CORES)
+        self.n_cores = tk.IntVar(value=P_CORES or plan_cpu_usage()["usable_cores"])
         self.cores_label = None
         self.cores_spinbox = None
 
@@ -313,10 +315,17 @@ class AnonymizerApp:
             self.cores_spinbox.config(state="disabled")
             self.cores_label.config(foreground="gray")
 
+    def _on_inference_profile_change(self, *_):
+        """Align the extra matching level for names and surnames to the one of the selected profile."""
+        level = get_profile_per_matching(self.inference_profile.get())
+        for label, value in self.EXTRA_PER_MATCHING_OPTIONS.items():
+            if value == level:
+                self.use_name_dictionary_label.set(label)
+
     def show_advanced_settings(self):
         win = tk.Toplevel(self.root)
         win.title("Impostazioni avanzate")
-        win.geometry("650x400")
+        win.geometry("650x520")
         win.transient(self.root)
         win.grab_set()
 
@@ -365,6 +374,38 @@ class AnonymizerApp:
 
         ttk.Separator(frame).pack(fill="x", pady=10)
 
+        # --- Inference profile ---
+        ttk.Label(
+            frame,
+            text="Profilo di inferenza:",
+            font=("Arial", 9),
+            foreground="black"
+        ).pack(anchor="w", pady=(0, 0))
+
+        ttk.Combobox(
+            frame,
+            textvariable=self.inference_profile,
+            values=list(INFERENCE_PROFILES.keys()),
+            state="readonly",
+            width=15
+        ).pack(anchor="w", padx=5)
+
+        self.inference_profile.trace_add("write", self._on_inference_profile_change)
+
+        ttk.Label(
+            frame,
+            text=(
+                "Legenda:\n"
+                "\t• fast: massima velocità, senza sovrapposizione tra le finestre del modello.\n"
+                "\t• balanced: impostazioni con cui il modello è stato addestrato.\n"
+                "\t• thorough: maggiore sovrapposizione e anonimizzazione di tutti i nomi conosciuti, più lento."
+            ),
+            font=("Arial", 9),
+            foreground="gray"
+        ).pack(anchor="w", pady=(8, 0))
+
+        ttk.Separator(frame).pack(fill="x", pady=10)
+
         # --- New multiprocessing options ---
         ttk.Checkbutton(
             frame,
@@ -511,6 +552,10 @@ class AnonymizerApp:
 
     # Main anonymization loop
     def _anonymize_worker(self):
+        # Imported on first use, so that the window opens without waiting for spaCy and torch
+        from anonymization_functions import anonymize_texts
+        from utils.anonymization_utils import read_file, save_many_texts, save_metrics
+
         if not self.selected_files:
             self.root.after(0, lambda: messagebox.showwarning("Attenzione", "Seleziona almeno un documento."))
             return
@@ -547,7 +592,8 @@ class AnonymizerApp:
                                               per_matching=self.EXTRA_PER_MATCHING_OPTIONS[self.use_name_dictionary_label.get()],
                                               personal_data=all_per_data, meta_data=all_metadata,
                                               multi_processing=self.use_multiprocessing.get(),
-                                              p_cores=self.n_cores.get())
+                                              p_cores=self.n_cores.get(),
+                                              profile=self.inference_profile.get())
         end_time = time.time()
 
         out_path = save_many_texts(
@@ -0,0 +1,134 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable
+
+from spacy import Language
+
+from config import DEFAULT_NER_MODEL, MICRO_BATCH_SIZE, MICRO_BATCH_WAIT_MS, MAX_PENDING_REQUESTS
+from utils.anonymization_utils import read_file
+from utils.batching_utils import MicroBatcher
+from utils.model_utils import load_model
+from utils.pdf_utils import extract_structured_text, read_pdf_from_s3
+
+READ_CONCURRENCY = 8    # Maximum number of files or S3 objects read at the same time by the async readers
+
+_default = None         # AsyncAnonymizer used by anonymize_async and anonymize_many_async, created at the first call
+_default_lock = None
+
+
+# ----------------------------
+#   Async Anonymizer
+# ----------------------------
+class AsyncAnonymizer:
+    """
+    Asyncio interface to the anonymization: the texts of concurrent calls are collected into shared batches and
+    anonymized in a background thread (see utils.batching_utils.MicroBatcher), so the event loop is never blocked.
+    At most max_pending texts are queued at a time; further calls wait for a free slot (backpressure).
+    """
+
+    def __init__(self,
+                 nlp: Language,
+                 max_batch_size: int = MICRO_BATCH_SIZE,
+                 max_wait_ms: float = MICRO_BATCH_WAIT_MS,
+                 max_pending: int = MAX_PENDING_REQUESTS,
+                 **anonymize_kwargs):
+        """
+        :param nlp: loaded spaCy Language model.
+        :param max_batch_size: maximum number of texts anonymized together.
+        :param max_wait_ms: maximum time a text waits for other texts before its batch is started.
+        :param max_pending: maximum number of texts waiting to be anonymized.
+        :param anonymize_kwargs: other arguments of anonymize_texts (e.g. entities, per_matching, use_cache).
+        """
+        self.batcher = MicroBatcher(nlp, max_batch_size, max_wait_ms, max_pending, **anonymize_kwargs)
+        self.slots = asyncio.Semaphore(max_pending)
+
+    async def anonymize(self, text: str, personal_data: dict[str, str] = None) -> str:
+        """
+        Anonymizes a text in the next shared batch.
+
+        :param text: the text to anonymize.
+        :param personal_data: optional dictionary of specific personal data to anonymize.
+        :return: the anonymized text.
+        """
+        async with self.slots:
+            # Waiting for the memory to drop blocks, so it is done in a thread. The semaphore guarantees a free slot in
+            # the batcher queue, so that submit does not block the event loop either
+            if self.batcher.memory_pressure():
+                await asyncio.get_running_loop().run_in_executor(None, self.batcher.wait_for_memory)
+            return await asyncio.wrap_future(self.batcher.submit(text, personal_data, wait_memory=False))
+
+    async def anonymize_many(self, texts: list[str], personal_data: list[dict[str, str]] = None) -> list[str]:
+        """
+        Anonymizes a list of texts, which share the batches with the texts of the other concurrent calls.
+
+        :param texts: the texts to anonymize.
+        :param personal_data: optional list of dictionaries of specific personal data to anonymize for each text.
+        :return: the anonymized texts, in the same order.
+        """
+        if personal_data is None: personal_data = [None] * len(texts)
+        return list(await asyncio.gather(*(self.anonymize(t, pd) for t, pd in zip(texts, personal_data))))
+
+    def stats(self) -> dict:
+        """Throughput and latency statistics (see MicroBatcher.stats)."""
+        return self.batcher.stats()
+
+    async def close(self) -> None:
+        """Waits for the queued texts to be anonymized and stops the background thread."""
+        await asyncio.get_running_loop().run_in_executor(None, self.batcher.close)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+async def get_default_anonymizer(model_path: str = DEFAULT_NER_MODEL, profile: str = None) -> AsyncAnonymizer:
+    """Returns the AsyncAnonymizer shared by anonymize_async calls, loading the model outside the event loop the first time."""
+    global _default, _default_lock
+    if _default_lock is None: _default_lock = asyncio.Lock()
+    async with _default_lock:
+        if _default is None:
+            nlp = await asyncio.get_running_loop().run_in_executor(None, load_model, model_path, profile)
+            _default = AsyncAnonymizer(nlp)
+    return _default
+
+
+async def anonymize_async(text: str, personal_data: dict[str, str] = None) -> str:
+    """
+    Async counterpart of anonymization_functions.anonymize with the default model and settings. Concurrent calls
+    are anonymized together in shared batches.
+    """
+    return await (await get_default_anonymizer()).anonymize(text, personal_data)
+
+
+async def anonymize_many_async(texts: list[str], personal_data: list[dict[str, str]] = None) -> list[str]:
+    """Async counterpart of anonymization_functions.anonymize_texts with the default model and settings."""
+    return await (await get_default_anonymizer()).anonymize_many(texts, personal_data)
+
+
+# ----------------------------
+#   Async Readers
+# ----------------------------
+_read_executor = ThreadPoolExecutor(max_workers=READ_CONCURRENCY, thread_name_prefix="async-reader")
+
+
+async def read_file_async(file_path: str) -> tuple[list[str], list[dict[str, str]] | None, dict[str, str] | None]:
+    """Reads a file in a background thread (see utils.anonymization_utils.read_file)."""
+    return await asyncio.get_running_loop().run_in_executor(_read_executor, read_file, file_path)
+
+
+async def read_s3_pdf_async(pdf_key: str) -> str:
+    """Downloads a PDF file from the S3 bucket (PDF_BUCKET_NAME) and extracts its text in a background thread."""
+    return await asyncio.get_running_loop().run_in_executor(
+        _read_executor, lambda: extract_structured_text(read_pdf_from_s3(pdf_key)))
+
+
+async def read_files_async(paths: Iterable[str]) -> list[tuple[list[str], list[dict[str, str]] | None, dict[str, str] | None]]:
+    """Reads several files concurrently, at most READ_CONCURRENCY at a time, returning their read_file results in order."""
+    return list(await asyncio.gather(*(read_file_async(path) for path in paths)))
+
+
+async def read_s3_pdfs_async(pdf_keys: Iterable[str]) -> list[str]:
+    """Extracts the texts of several PDF files of the S3 bucket concurrently, at most READ_CONCURRENCY at a time."""
+    return list(await asyncio.gather(*(read_s3_pdf_async(key) for key in pdf_keys)))
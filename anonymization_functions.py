@@ -1,15 +1,28 @@
-from typing import Iterable
-from multiprocessing import Pool
+import sys
+from itertools import repeat
+from typing import Iterable, Callable
+from multiprocessing import Pool, active_children
 
-import spacy
 from spacy import Language
+from spacy.tokens import Doc
 
-from config import DEFAULT_NER_MODEL, DEFAULT_ENTITIES, DEFAULT_EXTRA_PER_MATCHING_LEVEL, SINGLE_TEXT_FIELDS, MULTI_PROCESSING, P_CORES
-from evaluation.compute_metrics import compute_metrics_from_spacy_docs, infer_predicted_spans
-from rules.rules import apply_rules
-from utils.anonymization_utils import anonymize_doc, get_entity_spans_from_metadata
-from utils.multiprocessing_utils import estimate_spacy_params
-from utils.path_utils import get_resource_path
+from config import DEFAULT_NER_MODEL, DEFAULT_ENTITIES, DEFAULT_EXTRA_PER_MATCHING_LEVEL, SINGLE_TEXT_FIELDS, MULTI_PROCESSING, P_CORES, \
+    AUTO_TUNING, USE_RESULT_CACHE, USE_SEGMENT_CACHE, SHARED_MEMORY_TRANSPORT, WATCHDOG, MEMORY_GOVERNOR, VOCAB_RECYCLE_DOCS, \
+    VOCAB_RSS_CHECK_DOCS, MEMORY_CHUNK_CHARS
+from evaluation.compute_metrics import compute_metrics, infer_predicted_spans
+from rules.rules import apply_rules, contains_personal_data, identifies_patient, patient_tag, per_tag
+from utils.anonymization_utils import anonymize_doc, anonymize_spans, doc_to_spans, get_entity_spans_from_metadata
+from utils.cache_utils import ResultCache, result_cache_key, split_paragraphs
+from utils.cpu_utils import plan_cpu_usage, apply_thread_limits, pin_child_processes, init_pinned_worker
+from utils.multiprocessing_utils import estimate_spacy_params, ThroughputTuner
+from utils.memory_utils import memory_zone, process_in_memory_zones, MemoryGovernor
+from utils.shared_memory_utils import predict_spans_shared
+from utils.profiling_utils import RunProfiler
+from utils.timing_utils import get_pipeline_metrics, register_documents, pipe_by_stage, stage, count, NER_STAGE, RULES_STAGE, \
+    REPLACEMENT_STAGE
+from utils.watchdog import predict_spans_with_watchdog, quarantine_record
+from utils.model_utils import load_model, apply_inference_profile, get_profile_per_matching, get_model_name, get_model_version, \
+    get_model_load_args
 
 # ----------------------------
 #   Anonymization Function
@@ -18,7 +31,8 @@ def anonymize(text: str,
               nlp:Language = None,
               entities:Iterable[str]=None,
               per_matching:bool=None,
-              personal_data:dict[str, str]=None) -> str:
+              personal_data:dict[str, str]=None,
+              profile:str=None) -> str:
     """
     Anonymizes the input text by replacing entities with placeholders only for the specified entity types,
     or the default ones if none are specified.
@@ -28,12 +42,15 @@ def anonymize(text: str,
     :param entities: List of entity types to anonymize.
     :param per_matching: Whether to anonymize PER and PATIENT entities in combination with dictionaries or not.
     :param personal_data: Dictionary of specific personal data to anonymize.
+    :param profile: Name of the inference profile to apply to the model. If None, the default profile is used.
     """
-    if nlp is None: nlp = spacy.load(DEFAULT_NER_MODEL)
+    if nlp is None: nlp = load_model(DEFAULT_NER_MODEL, profile)
+    elif profile is not None: apply_inference_profile(nlp, profile)
     if entities is None: entities = DEFAULT_ENTITIES
-    if per_matching is None: per_matching = DEFAULT_EXTRA_PER_MATCHING_LEVEL
+    if per_matching is None: per_matching = get_profile_per_matching(profile)
 
-    return anonymize_doc(apply_rules(nlp(text), per_matching, personal_data), entities)
+    with memory_zone(nlp):
+        return anonymize_doc(apply_rules(nlp(text), per_matching, personal_data), entities)
 
 def anonymize_texts(texts: list[str],
                     nlp: Language = None,
@@ -42,7 +59,15 @@ def anonymize_texts(texts: list[str],
                     personal_data: list[dict[str, str]] = None,
                     meta_data: list[dict] = None,
                     multi_processing: bool = MULTI_PROCESSING,
-                    p_cores: int = P_CORES) -> tuple[list[str], dict[str, dict[str, float]] | None]:
+                    p_cores: int = P_CORES,
+                    auto_tuning: bool = AUTO_TUNING,
+                    profile: str = None,
+                    use_cache: bool = USE_RESULT_CACHE,
+                    segment_cache: bool = USE_SEGMENT_CACHE,
+                    watchdog: bool = WATCHDOG,
+                    quarantine: list[dict] = None,
+                    profile_output: str = None,
+                    profile_memory: bool = False) -> tuple[list[str], dict[str, dict[str, float]] | None]:
     """
     Applies the anonymization function to a list of texts with optional personal data and metadata.
     If metadata is provided and contains entity information, it is used to extract gold entities and apply evaluation.
@@ -54,47 +79,344 @@ def anonymize_texts(texts: list[str],
     :param personal_data: list of dictionaries of specific personal data to anonymize for each text.
     :param meta_data: list of metadata dictionaries for each text, used for evaluation if they contain entity information.
     :param multi_processing: whether to use multi-processing for anonymization or not.
-    :param p_cores: number of performance CPU cores to use for multi-processing, if it is set to True.
+    :param p_cores: maximum number of performance CPU cores to use for multi-processing. If None, it is detected.
+    :param auto_tuning: whether to tune batch size and number of processes at runtime instead of using static estimates.
+    :param profile: name of the inference profile to apply to the model (see INFERENCE_PROFILES). If None, the default profile is used.
+    :param use_cache: whether to reuse the results of texts already anonymized with the same settings, skipping NER for them.
+    :param segment_cache: whether to process texts paragraph by paragraph, reusing the results of recurring paragraphs
+                          that do not contain personal data.
+    :param watchdog: whether to run NER and rules in worker processes under time budgets per text (NER_TIMEOUT,
+                     RULES_TIMEOUT). Texts exceeding them are skipped, with None as anonymized text.
+    :param quarantine: optional list to which the records of the texts skipped by the watchdog are appended, with
+                       their index and reason code.
+    :param profile_output: if given, the run is profiled with PROFILE_MODE, worker processes included, and the profile is
+                           saved with this path prefix (e.g. "out/run" saves "out/run_profile.folded", see utils.profiling_utils).
+    :param profile_memory: whether the profile also traces the allocations of the rules and merge stages.
     :return: a tuple containing the list of anonymized texts and a dictionary of evaluation metrics (if metadata is provided)
     """
-    if nlp is None: nlp = spacy.load(get_resource_path(DEFAULT_NER_MODEL))
+    if profile_output is not None:
+        with RunProfiler(memory=profile_memory) as profiler:
+            result = anonymize_texts(texts, nlp=nlp, entities=entities, per_matching=per_matching, personal_data=personal_data,
+                                     meta_data=meta_data, multi_processing=multi_processing, p_cores=p_cores,
+                                     auto_tuning=auto_tuning, profile=profile, use_cache=use_cache,
+                                     segment_cache=segment_cache, watchdog=watchdog, quarantine=quarantine)
+        profiler.save(profile_output)
+        return result
+
+    if nlp is None: nlp = load_model(DEFAULT_NER_MODEL, profile)
+    elif profile is not None: apply_inference_profile(nlp, profile)
     if entities is None: entities = DEFAULT_ENTITIES
-    if per_matching is None: per_matching = DEFAULT_EXTRA_PER_MATCHING_LEVEL
+    if per_matching is None: per_matching = get_profile_per_matching(profile)
+    if personal_data is None: personal_data = [None] * len(texts)
+
+    doc_ids = register_documents(texts)     # None unless pipeline metrics are being collected
+    results = [None] * len(texts)
+    cache = ResultCache() if use_cache or segment_cache else None
+    model_version = get_model_version(nlp) if cache is not None else None
+    if use_cache:
+        keys = [result_cache_key(text, per_data, model_version, entities, per_matching)
+                for text, per_data in zip(texts, personal_data)]
+        results = cache.get_many(keys)
+
+    # Only texts missing from the cache go through NER and rules
+    missing = [i for i, result in enumerate(results) if result is None]
+    count("cache_hits", len(texts) - len(missing))
+    count("processed", len(texts) - len(missing))
+    if missing:
+        predict = lambda t, p, ids=None: _predict_spans(t, nlp, per_matching, p, multi_processing, p_cores, auto_tuning,
+                                                        watchdog, ids)
+        missing_texts, missing_personal_data = [texts[i] for i in missing], [personal_data[i] for i in missing]
+        missing_ids = [doc_ids[i] for i in missing] if doc_ids is not None else None
+        if segment_cache:
+            pred_spans = _predict_segment_spans(missing_texts, missing_personal_data, predict, cache,
+                                                model_version, entities, per_matching, missing_ids)
+        else:
+            pred_spans = predict(missing_texts, missing_personal_data, missing_ids)
+        for i, spans in zip(missing, pred_spans):
+            if isinstance(spans, str):  # Reason code of a text skipped by the watchdog
+                results[i] = {"text": None, "spans": None}
+                if quarantine is not None: quarantine.append(quarantine_record(spans, index=i))
+                count("skipped")
+            else:
+                with stage(REPLACEMENT_STAGE, [doc_ids[i]] if doc_ids is not None else None):
+                    results[i] = {"text": anonymize_spans(texts[i], spans, entities), "spans": spans}
+                count("entities", len(spans))
+                count("processed")
+        if use_cache:
+            cache.put_many([(keys[i], results[i]) for i in missing if results[i]["spans"] is not None])
+    if cache is not None:
+        cache.close()
+
+    anonymized_texts = [result["text"] for result in results]
+    processed = [i for i, result in enumerate(results) if result["spans"] is not None]
+    metrics = _evaluate([texts[i] for i in processed], [results[i]["spans"] for i in processed],
+                        [meta_data[i] for i in processed] if meta_data is not None else None, entities)
+
+    return anonymized_texts, metrics
+
+
+def extract_ner_docs(texts: list[str],
+                     nlp: Language = None,
+                     multi_processing: bool = MULTI_PROCESSING,
+                     p_cores: int = P_CORES,
+                     auto_tuning: bool = AUTO_TUNING,
+                     profile: str = None) -> list[Doc]:
+    """
+    Runs only the NER model on a list of texts, so that its output can be saved (see utils.docbin_utils) and
+    anonymized later with anonymize_docs using different rule settings.
+
+    :param texts: the list of original texts to process
+    :param nlp: pre-loaded spaCy Language model. If None, loads the default
+    :param multi_processing: whether to use multi-processing or not.
+    :param p_cores: maximum number of performance CPU cores to use for multi-processing. If None, it is detected.
+    :param auto_tuning: whether to tune batch size and number of processes at runtime instead of using static estimates.
+    :param profile: name of the inference profile to apply to the model (see INFERENCE_PROFILES). If None, the default profile is used.
+    :return: the list of docs with the entities predicted by the NER model.
+    """
+    if nlp is None: nlp = load_model(DEFAULT_NER_MODEL, profile)
+    elif profile is not None: apply_inference_profile(nlp, profile)
+
+    doc_ids = register_documents(texts)     # None unless pipeline metrics are being collected
+    plan = plan_cpu_usage(p_cores, multi_processing)
+    apply_thread_limits(plan)
+    tuner = ThroughputTuner(texts, get_model_name(nlp), plan["processes"]) if auto_tuning else None
+    docs = list(_run_ner(texts, nlp, plan, multi_processing, tuner, doc_ids))
+    if tuner is not None: tuner.finish()
+    count("processed", len(docs))
+    return docs
+
+
+def anonymize_docs(docs: list[Doc],
+                   entities: Iterable[str] = None,
+                   per_matching: int = None,
+                   personal_data: list[dict[str, str]] = None,
+                   meta_data: list[dict] = None,
+                   multi_processing: bool = MULTI_PROCESSING,
+                   p_cores: int = P_CORES,
+                   profile: str = None) -> tuple[list[str], dict[str, dict[str, float]] | None]:
+    """
+    Applies rules, entity merging and replacement to docs already processed by the NER model (see extract_ner_docs),
+    without running the model again.
+
+    :param docs: the list of docs with the entities predicted by the NER model
+    :param entities: list of entity types to anonymize.
+    :param per_matching: whether to anonymize PER and PATIENT entities in combination with dictionaries or not.
+    :param personal_data: list of dictionaries of specific personal data to anonymize for each text.
+    :param meta_data: list of metadata dictionaries for each text, used for evaluation if they contain entity information.
+    :param multi_processing: whether to use multi-processing for the rules or not.
+    :param p_cores: maximum number of performance CPU cores to use for multi-processing. If None, it is detected.
+    :param profile: name of the inference profile whose extra PER matching level is used if per_matching is None.
+    :return: a tuple containing the list of anonymized texts and a dictionary of evaluation metrics (if metadata is provided)
+    """
+    if entities is None: entities = DEFAULT_ENTITIES
+    if per_matching is None: per_matching = get_profile_per_matching(profile)
+    if personal_data is None: personal_data = [None] * len(docs)
+
+    texts = [doc.text for doc in docs]
+    doc_ids = register_documents(texts)     # None unless pipeline metrics are being collected
+    plan = plan_cpu_usage(p_cores, multi_processing)
+    pred_spans = _apply_rules_to_docs(docs, per_matching, personal_data, multi_processing, plan, doc_ids)
+
+    anonymized_texts = []
+    for text, spans, doc_id in zip(texts, pred_spans, doc_ids or repeat(None)):
+        with stage(REPLACEMENT_STAGE, [doc_id] if doc_id is not None else None):
+            anonymized_texts.append(anonymize_spans(text, spans, entities))
+        count("processed")
+    return anonymized_texts, _evaluate(texts, pred_spans, meta_data, entities)
 
-    if multi_processing:
-        n_processes, batch_size = estimate_spacy_params(texts, p_cores)
-        anonymized_docs = nlp.pipe(texts, n_process=n_processes, batch_size=batch_size)
-    else:
-        anonymized_docs = [nlp(text) for text in texts]
 
+def _evaluate(texts: list[str],
+              pred_spans: list[list[tuple[int, int, str]]],
+              meta_data: list[dict] | None,
+              entities: Iterable[str]) -> dict[str, dict[str, float]] | None:
+    """Computes the evaluation metrics of the predicted spans if the metadata contain gold entity information."""
+    if meta_data is None or not any([(meta is not None and (meta.get(SINGLE_TEXT_FIELDS[4]) is not None or meta.get(SINGLE_TEXT_FIELDS[3]) is not None)) for meta in meta_data]):
+        return None
+
+    # Extract gold entities from the entity metadata
+    gold_docs, pred_docs_eval = [], []
+    for text, meta, spans in zip(texts, meta_data, pred_spans):
+        if meta is not None and (meta.get(SINGLE_TEXT_FIELDS[4]) is not None or meta.get(SINGLE_TEXT_FIELDS[3]) is not None):
+            gold_docs.append({"text": text, "entities":
+                get_entity_spans_from_metadata(text, meta[SINGLE_TEXT_FIELDS[4]]) if meta.get(SINGLE_TEXT_FIELDS[4]) is not None
+                else infer_predicted_spans(text, meta[SINGLE_TEXT_FIELDS[3]])
+            })
+            pred_docs_eval.append({"text": text, "entities": {tuple(span) for span in spans}})
+    return compute_metrics(gold_docs, pred_docs_eval, entities)
+
+
+def _predict_spans(texts: list[str],
+                   nlp: Language,
+                   per_matching: int,
+                   personal_data: list[dict[str, str]],
+                   multi_processing: bool,
+                   p_cores: int,
+                   auto_tuning: bool,
+                   watchdog: bool = False,
+                   doc_ids: list[int] = None) -> list[list[tuple[int, int, str]] | str]:
+    """
+    Runs NER and rules on the given texts, returning the (start, end, label) entity spans of each text, or the reason
+    code of the texts skipped by the watchdog. The stage timings are attributed to doc_ids in the pipeline metrics.
+    """
+    plan = plan_cpu_usage(p_cores, multi_processing)
+    apply_thread_limits(plan)
+    # Several tasks per worker, so that the load stays balanced when texts have different lengths
+    chunk_size = max(1, min(estimate_spacy_params(texts, plan["usable_cores"])[1], nlp.batch_size,
+                            -(-len(texts) // (plan["processes"] * 4))))
+
+    # NER and rules both run in the worker processes, so their time is only measured as a whole
+    model_args = get_model_load_args(nlp, plan["threads_per_process"]) if nlp.path is not None else None
+    if watchdog and nlp.path is not None:
+        with stage(NER_STAGE, doc_ids, [len(text) for text in texts]):
+            return [value for _, value in predict_spans_with_watchdog(texts, personal_data, per_matching,
+                                                                      model_args, plan, chunk_size)]
+
+    if multi_processing and SHARED_MEMORY_TRANSPORT and plan["processes"] > 1 and nlp.path is not None:
+        labels = sorted(set(DEFAULT_ENTITIES) | set(nlp.get_pipe("ner").labels))
+        with stage(NER_STAGE, doc_ids, [len(text) for text in texts]):
+            return predict_spans_shared(texts, personal_data, per_matching, model_args, labels, plan, chunk_size)
+
+    # Docs only live inside memory zones, so the strings they add to the vocab are released periodically
+    governor = MemoryGovernor() if MEMORY_GOVERNOR else None
+    # A single tuner for all the slices, so that its warm-up spans them and the profile is saved once
+    tuner = ThroughputTuner(texts, get_model_name(nlp), plan["processes"]) if auto_tuning else None
+    # Each slice starts new spaCy worker processes, so multi-process slices are only made smaller under memory pressure
+    spawns_workers = plan["processes"] > 1 and (multi_processing or auto_tuning)
+    chunk_ids = lambda chunk, start: doc_ids[start:start + len(chunk)] if doc_ids is not None else None
+    spans = process_in_memory_zones(nlp, texts, lambda chunk, start: _apply_rules_to_docs(
+        _run_ner(chunk, nlp, plan, multi_processing, tuner, chunk_ids(chunk, start)),
+        per_matching, personal_data[start:start + len(chunk)], multi_processing, plan, chunk_ids(chunk, start)),
+        check_every=VOCAB_RECYCLE_DOCS if spawns_workers else VOCAB_RSS_CHECK_DOCS, governor=governor,
+        max_chars=None if spawns_workers or governor is None else MEMORY_CHUNK_CHARS)
+    if tuner is not None: tuner.finish()
+    if governor is not None and (governor.counters["shrinks"] or governor.counters["pauses"]):
+        stats = governor.stats()
+        print(f"Memory governor: peak {stats['peak_mb']:.0f} MB (high watermark {stats['high_watermark_mb']:.0f} MB), "
+              f"chunks shrunk {stats['shrinks']} times, intake paused {stats['pauses']} times for {stats['paused_s']:.1f} s.",
+              file=sys.stderr)
+    return spans
+
+
+def _run_ner(texts: list[str],
+             nlp: Language,
+             plan: dict,
+             multi_processing: bool,
+             tuner: ThroughputTuner = None,
+             doc_ids: list[int] = None) -> Iterable[Doc]:
+    """
+    Runs the NER model on the given texts with the processes and batch sizes of the given CPU plan, or of the tuner
+    if given (the caller calls its finish method once all the texts are processed).
+    While pipeline metrics are collected, a single process runs the tokenizer and each component separately to time
+    them (with the batch size of the model, without tuning it), and worker processes are only timed as a whole.
+    """
+    if get_pipeline_metrics() is not None:
+        if plan["processes"] > 1 and (multi_processing or tuner is not None):
+            with stage(NER_STAGE, doc_ids, [len(text) for text in texts]):
+                return list(_run_ner_unmeasured(texts, nlp, plan, multi_processing, tuner))
+        return list(pipe_by_stage(nlp, texts, doc_ids))
+    return _run_ner_unmeasured(texts, nlp, plan, multi_processing, tuner)
+
+
+def _run_ner_unmeasured(texts: list[str], nlp: Language, plan: dict, multi_processing: bool,
+                        tuner: ThroughputTuner = None) -> Iterable[Doc]:
+    if tuner is not None:
+        return list(_pin_workers(tuner.pipe(nlp, texts), plan))
+    elif multi_processing:
+        batch_size = min(estimate_spacy_params(texts, plan["usable_cores"])[1], nlp.batch_size)
+        return _pin_workers(nlp.pipe(texts, n_process=plan["processes"], batch_size=batch_size), plan)
+    return list(nlp.pipe(texts))
+
+
+def _apply_rules_to_docs(docs: Iterable[Doc],
+                         per_matching: int,
+                         personal_data: list[dict[str, str]],
+                         multi_processing: bool,
+                         plan: dict,
+                         doc_ids: list[int] = None) -> list[list[tuple[int, int, str]]]:
+    """Applies the rules to the given docs, returning the (start, end, label) entity spans of each doc."""
     if multi_processing:
-        with Pool(processes=p_cores) as pool:
-            pred_docs = pool.starmap(apply_rules,
-                [(doc, per_matching, per_data) for doc, per_data in zip(anonymized_docs, personal_data)]
+        with Pool(processes=plan["usable_cores"], initializer=init_pinned_worker, initargs=(plan,)) as pool, \
+                stage(RULES_STAGE, doc_ids):
+            return pool.starmap(_apply_rules_spans,
+                [(doc, per_matching, per_data) for doc, per_data in zip(docs, personal_data)]
             )
-    else:
-        pred_docs = [apply_rules(doc, per_matching, per_data) for doc, per_data in zip(anonymized_docs, personal_data)]
-
-    anonymized_texts = [anonymize_doc(doc, entities) for doc in pred_docs]
-    metrics = None
-
-    # If entity metadata is provided, extract gold entities for evaluation
-    pred_docs_eval = []
-    if meta_data is not None and any([(meta is not None and SINGLE_TEXT_FIELDS[-1] in meta and meta[SINGLE_TEXT_FIELDS[-1]] is not None) for meta in meta_data]):
-        gold_docs = []
-        for text, meta, pred_doc_eval in zip(texts, meta_data, pred_docs):
-            if meta[SINGLE_TEXT_FIELDS[-1]] is not None or meta[SINGLE_TEXT_FIELDS[-2]] is not None:
-                gold_docs.append({"text": text, "entities":
-                    get_entity_spans_from_metadata(text, meta[SINGLE_TEXT_FIELDS[-1]]) if meta[SINGLE_TEXT_FIELDS[-1]] is not None
-                    else infer_predicted_spans(text, meta[SINGLE_TEXT_FIELDS[-2]])
-                })
-                pred_docs_eval.append(pred_doc_eval)
-        metrics = compute_metrics_from_spacy_docs(gold_docs, pred_docs_eval, entities)
+    return [_apply_rules_spans(doc, per_matching, per_data, doc_id)
+            for doc, per_data, doc_id in zip(docs, personal_data, doc_ids or repeat(None))]
 
-    return anonymized_texts, metrics
+
+def _predict_segment_spans(texts: list[str],
+                           personal_data: list[dict[str, str]],
+                           predict: Callable,
+                           cache: ResultCache,
+                           model_version: str,
+                           entities: Iterable[str],
+                           per_matching: int,
+                           doc_ids: list[int] = None) -> list[list[tuple[int, int, str]] | str]:
+    """
+    Predicts the entity spans of the given texts paragraph by paragraph. Paragraphs containing the personal data of
+    their text are always predicted with them and never cached, so that cached results cannot carry patient-specific
+    context to other texts. The other paragraphs are predicted without personal data, only once per distinct content,
+    and their results are reused from the cache when available. Paragraph offsets are re-based into the full texts.
+    Texts with a paragraph skipped by the watchdog are skipped as a whole, with its reason code.
+    """
+    segments = []   # (text index, paragraph start, paragraph end, cache key, or None for paragraphs with personal data)
+    for i, (text, per_data) in enumerate(zip(texts, personal_data)):
+        for start, end in split_paragraphs(text):
+            paragraph = text[start:end]
+            key = None if contains_personal_data(paragraph, per_data) else \
+                result_cache_key(paragraph, None, model_version, entities, per_matching, scope="segment")
+            segments.append((i, start, end, key))
+
+    keys = list(dict.fromkeys(key for _, _, _, key in segments if key is not None))
+    cached = dict(zip(keys, cache.get_many(keys)))
+    missing_keys = [key for key in keys if cached[key] is None]
+    first_segment = {}
+    for n, (_, _, _, key) in enumerate(segments):
+        first_segment.setdefault(key, n)
+
+    # Predict at once the paragraphs with personal data and one occurrence of each uncached paragraph
+    to_predict = [n for n, (_, _, _, key) in enumerate(segments) if key is None] + [first_segment[key] for key in missing_keys]
+    pred_spans = predict([texts[segments[n][0]][segments[n][1]:segments[n][2]] for n in to_predict],
+                         [personal_data[segments[n][0]] if segments[n][3] is None else None for n in to_predict],
+                         [doc_ids[segments[n][0]] for n in to_predict] if doc_ids is not None else None) if to_predict else []
+    segment_spans = dict(zip(to_predict, pred_spans))
+    for key in missing_keys:
+        cached[key] = {"spans": segment_spans[first_segment[key]]}
+    cache.put_many([(key, cached[key]) for key in missing_keys if not isinstance(cached[key]["spans"], str)])
+
+    spans = [[] for _ in texts]
+    for n, (i, start, _, key) in enumerate(segments):
+        result = segment_spans[n] if key is None else cached[key]["spans"]
+        if isinstance(spans[i], str):
+            continue    # Text already skipped because of another paragraph
+        if isinstance(result, str):
+            spans[i] = result
+        elif key is None:
+            spans[i] += [(start + s, start + e, label) for s, e, label in result]
+        else:
+            # Paragraphs predicted without personal data still need the PATIENT label change of their text
+            relabel = identifies_patient(personal_data[i])
+            spans[i] += [(start + s, start + e, per_tag if relabel and label == patient_tag else label)
+                         for s, e, label in result]
+    return spans
+
+
+def _apply_rules_spans(doc: Doc, per_matching: int, personal_data: dict[str, str], doc_id: int = None) -> list[tuple[int, int, str]]:
+    """Applies the rules to a doc and returns only its entity spans, which are cheaper to send back from worker processes."""
+    with stage(None, [doc_id] if doc_id is not None else None):
+        return doc_to_spans(apply_rules(doc, per_matching, personal_data))
+
+
+def _pin_workers(docs: Iterable[Doc], plan: dict, check_every: int = 64) -> Iterable[Doc]:
+    """Yields the given docs, pinning the spaCy worker processes to their cores as soon as they are started."""
+    # Processes running before the first doc is requested, i.e. before spaCy starts its workers, are not spaCy's
+    pinned, others = set(), {process.pid for process in active_children()}
+    for i, doc in enumerate(docs):
+        if i % check_every == 0: pin_child_processes(plan, pinned, others)
+        yield doc
 
 
-def get_full_labeller(path: str = DEFAULT_NER_MODEL, per_matching:int=DEFAULT_EXTRA_PER_MATCHING_LEVEL):
-    """Returns a full anonymization function using the specified spaCy model path."""
-    nlp = spacy.load(get_resource_path(path))
+def get_full_labeller(path: str = DEFAULT_NER_MODEL, per_matching:int=DEFAULT_EXTRA_PER_MATCHING_LEVEL, profile:str=None):
+    """Returns a full anonymization function using the specified spaCy model path and inference profile."""
+    nlp = load_model(path, profile)
     return lambda text: apply_rules(nlp(text), per_matching)
\ No newline at end of file
@@ -1,23 +1,32 @@
 #!/usr/bin/env python3
 
 import os
+import re
+import json
+import time
 import warnings
 import argparse
 import sys
-import spacy
-import spacy_transformers
+from contextlib import nullcontext
 
-from anonymization_functions import anonymize_texts
-from config import DEFAULT_NER_MODEL, PERSONAL_DATA_FORMAT, DEFAULT_OUTPUTS_IN_SINGLE_FILE
-from utils import read_json_file
-from utils.anonymization_utils import read_file, save_many_texts, save_metrics
-from GUI.GUI import main as gui_main
+from config import DEFAULT_NER_MODEL, PERSONAL_DATA_FORMAT, DEFAULT_OUTPUTS_IN_SINGLE_FILE, MULTI_PROCESSING, \
+    INFERENCE_PROFILES, DEFAULT_INFERENCE_PROFILE, TRANSFORMER_BACKEND, USE_RESULT_CACHE, USE_SEGMENT_CACHE, RESULT_CACHE_PATH, \
+    WATCHDOG, MP_START_METHOD, SERVER_HOST, SERVER_PORT, JSONL_BATCH_SIZE, JSONL_FIELDS, PATIENT_DATA_FIELDS, SINGLE_TEXT_FIELDS, \
+    PIPELINE_METRICS, LIVE_METRICS_INTERVAL, PROFILE_MODE, ESTIMATE_SAMPLE_DOCS, RESUME_CHUNK_FILES, \
+    QUEUE_UNIT_FILES, QUEUE_LEASE_SECONDS, QUEUE_HEARTBEAT_SECONDS, SHARED_MEMORY_TRANSPORT
+from utils import read_json_file, save_json_file
+from utils.cpu_utils import plan_cpu_usage, apply_thread_limits
+from utils.path_utils import list_input_files
+from utils.pdf_utils import extract_structured_text, read_pdf_from_s3
+from utils.preload_utils import configure_start_method, share_with_workers
+from utils.profile_utils import get_profile_per_matching
+from utils.profiling_utils import RunProfiler, SAMPLING, DETERMINISTIC
+from utils.timing_utils import collect_pipeline_metrics, get_pipeline_metrics, stage, READ_STAGE, WRITE_STAGE
 
 import multiprocessing as mp
-mp.freeze_support()
-mp.set_start_method("spawn", force=True)
 
 warnings.filterwarnings("ignore", message=r".*\[W095\].*")
+OUTPUT_NAME_RE = re.compile(r"_anonymized(_\d+)?\.(json|txt)$")     # Names of the outputs saved per input file
 
 
 # ----------------------------
@@ -28,7 +37,17 @@ def anonymize(inputs: list[str],
               text: str = None,
               entities: list[str] = None,
               per_matching: int = None,
-              personal_data: str = None) -> str:
+              personal_data: str = None,
+              profile: str = None,
+              backend: str = TRANSFORMER_BACKEND,
+              use_cache: bool = USE_RESULT_CACHE,
+              segment_cache: bool = USE_SEGMENT_CACHE,
+              save_ner: str = None,
+              from_ner: str = None,
+              watchdog: bool = WATCHDOG,
+              resume: bool = False,
+              incremental: bool = False,
+              queue: bool = False) -> str:
     """
     Anonymizes text using spaCy NER and additional rules, with flexible input and output options.
 
@@ -38,48 +57,81 @@ def anonymize(inputs: list[str],
     :param entities: list of entity types to anonymize. If omitted, default entity types will be used.
     :param per_matching: whether to anonymize PER and PATIENT entities in combination with dictionaries or not. If omitted, the default level of extra matching will be applied.
     :param personal_data: path to json dictionary of specific personal data to anonymize. This should be provided in case of pdf files, where no metadata is available.
+    :param profile: name of the inference profile trading accuracy for throughput. If omitted, the default profile is used.
+    :param backend: backend running the transformer, "pytorch" or "onnx" (falls back to "pytorch" if the ONNX export is unavailable).
+    :param use_cache: whether to reuse the results of texts already anonymized with the same settings, skipping NER for them.
+    :param segment_cache: whether to process texts paragraph by paragraph, reusing the results of recurring paragraphs without personal data.
+    :param save_ner: folder where to save the output of the NER model, to be anonymized later with from_ner. If provided, no anonymization is performed.
+    :param from_ner: folder containing the output of the NER model saved with save_ner. If provided, only rules, merging and replacement are applied to it, without loading the model.
+    :param watchdog: whether to read and anonymize each document under time budgets, skipping the ones exceeding them. Skipped documents are listed with a reason code in _quarantine.json in the output folder.
+    :param resume: whether to anonymize the input files a chunk at a time, writing the outputs of each file and recording it in a journal in the output folder as soon as its chunk is done, so that the run can be started again after an interruption skipping the files already done. Outputs are saved per input file.
+    :param incremental: like resume, recording in a manifest in the output folder the content hash of each input file and of each document, together with the settings, so that later runs only anonymize the new or changed files and the new or changed entries of patient JSONs, merging them into the existing outputs.
+    :param queue: whether to anonymize the input files as one of the nodes sharing the output folder, claiming groups of files through lease files in its _queue folder until all of them are done. Outputs are saved per input file.
     :return: the path to the saved anonymized file directory.
     """
+    # spaCy, torch and the document readers are only imported here, so that --help, --cpu-report and the GUI start fast
+    from anonymization_functions import anonymize_texts, anonymize_docs, extract_ner_docs
+    from utils.anonymization_utils import save_many_texts, save_metrics
+    from utils.docbin_utils import save_ner_docs, load_ner_docs
+    from utils.model_utils import get_model_version
+
+    if per_matching is not None and per_matching not in [0, 1, 2]:
+        print("Error: per_matching must be 0, 1, or 2.", file=sys.stderr)
+        sys.exit(1)
+    if save_ner and from_ner:
+        print("Error: save_ner and from_ner cannot be used together.", file=sys.stderr)
+        sys.exit(1)
 
     #  Retrieve input text
     texts = []
     metadata = []
     personal_data_list = []
+    sources = []
+    quarantine = []
+
+    # INPUT CASE 0: output of the NER model saved via --save-ner
+    if from_ner:
+        try:
+            docs, metadata, personal_data_list, saved_inputs = load_ner_docs(from_ner)
+        except Exception as e:
+            print(f"Error reading NER output from '{from_ner}': {e}", file=sys.stderr)
+            sys.exit(1)
+        texts = [doc.text for doc in docs]
+        inputs = inputs or saved_inputs
 
     # INPUT CASE 1: direct text input via --text
-    if text:
+    elif text:
         texts = [text]
         metadata = [None]
         personal_data_list = [None]
 
     # INPUT CASE 2: Files / Folders
     elif inputs:
-        expanded_files = []
-
-        for path in inputs:
-            if os.path.isdir(path):
-                for filename in os.listdir(path):
-                    full_path = os.path.join(path, filename)
-                    if os.path.isfile(full_path):
-                        expanded_files.append(full_path)
-            elif os.path.isfile(path):
-                expanded_files.append(path)
-            else:
-                print(f"Warning: '{path}' is not valid.", file=sys.stderr)
-
+        expanded_files = list_input_files(inputs)
         if not expanded_files:
             print("Error: No valid input files found.", file=sys.stderr)
             sys.exit(1)
 
-        for filepath in expanded_files:
-            try:
-                t, m, pd = read_file(filepath)
-                texts.extend(t)
-                metadata.extend(m if m else [None])
-                personal_data_list.extend([pd]*len(t) if pd else [None]*len(t))
-            except Exception as e:
-                print(f"Error reading '{filepath}': {e}", file=sys.stderr)
+        if queue or resume or incremental:
+            # Started again on the same folders: the files written by the previous runs are not inputs
+            out_dir = _output_dir(output_dir, inputs)
+            expanded_files = _exclude_run_files(expanded_files, out_dir)
+            if not expanded_files:
+                print("Error: No valid input files found.", file=sys.stderr)
                 sys.exit(1)
+        if queue:
+            return _anonymize_from_queue(expanded_files, out_dir, entities, per_matching,
+                                         personal_data, profile, backend, use_cache, segment_cache, watchdog)
+        if resume or incremental:
+            return _anonymize_in_chunks(expanded_files, out_dir, entities, per_matching,
+                                        personal_data, profile, backend, use_cache, segment_cache, watchdog, incremental)
+
+        read_files, quarantine = _read_files(expanded_files, watchdog)
+        for filepath, (t, m, pd) in read_files:
+            texts.extend(t)
+            metadata.extend(m if m else [None])
+            personal_data_list.extend([pd]*len(t) if pd else [None]*len(t))
+            sources.extend([filepath]*len(t))
 
     # CASE 3: stdin fallback
     elif not sys.stdin.isatty():
@@ -92,49 +144,65 @@ def anonymize(inputs: list[str],
         sys.exit(1)
 
     if personal_data:
+        personal_data_list = [_read_personal_data(personal_data)] * len(texts)
+
+    # Load spaCy model
+    if not from_ner:
+        nlp = _load_model(profile, backend, per_matching)
+
+    # Save only the output of the NER model
+    if save_ner:
         try:
-            pd = read_json_file(personal_data)
-            personal_data_list = [pd] * len(texts)
+            save_ner_docs(extract_ner_docs(texts, nlp=nlp, profile=profile), save_ner, metadata=metadata,
+                          personal_data=personal_data_list, inputs=inputs, model_version=get_model_version(nlp))
         except Exception as e:
-            print(f"Error reading personal data file '{personal_data}': {e}", file=sys.stderr)
+            print(f"Error saving NER output to '{save_ner}': {e}", file=sys.stderr)
             sys.exit(1)
+        print(f"NER output saved to '{save_ner}'.")
+        return save_ner
 
-    if per_matching is not None:
-        if per_matching not in [0, 1, 2]:
-            print("Error: per_matching must be 0, 1, or 2.", file=sys.stderr)
-            sys.exit(1)
-        per_matching = per_matching
-
-    # Load spaCy model
-    try:
-        nlp = spacy.load(DEFAULT_NER_MODEL)
-    except Exception as e:
-        print(f"Error loading spaCy model: {e}", file=sys.stderr)
-        sys.exit(1)
+    # Documents registered in the pipeline metrics from here on are the texts, in order
+    pipeline_metrics = get_pipeline_metrics()
+    first_doc_id = len(pipeline_metrics.documents) if pipeline_metrics is not None else None
 
     # Anonymize
-    anonymized, metrics = anonymize_texts(texts,
-                                          nlp=nlp,
-                                          entities=entities,
-                                          per_matching=per_matching,
-                                          personal_data=personal_data_list,
-                                          meta_data=metadata)
+    if from_ner:
+        anonymized, metrics = anonymize_docs(docs,
+                                             entities=entities,
+                                             per_matching=per_matching,
+                                             personal_data=personal_data_list,
+                                             meta_data=metadata,
+                                             profile=profile)
+    else:
+        anonymized, metrics = anonymize_texts(texts,
+                                              nlp=nlp,
+                                              entities=entities,
+                                              per_matching=per_matching,
+                                              personal_data=personal_data_list,
+                                              meta_data=metadata,
+                                              profile=profile,
+                                              use_cache=use_cache,
+                                              segment_cache=segment_cache,
+                                              watchdog=watchdog,
+                                              quarantine=quarantine)
+
+    # Per-document stage timings are reported with the input file of each text
+    if pipeline_metrics is not None and sources:
+        pipeline_metrics.describe_documents(first_doc_id, source=sources)
+
+    # Documents skipped by the watchdog are not saved
+    for record in quarantine:
+        if record["index"] is not None and sources: record["source"] = sources[record["index"]]
+    kept = [i for i, t in enumerate(anonymized) if t is not None]
+    anonymized, metadata, personal_data_list = [anonymized[i] for i in kept], [metadata[i] for i in kept], [personal_data_list[i] for i in kept]
+
     # Output result
     out_path = None
-    if output_dir:
-        if not os.path.isdir(output_dir):
-            print(f"Provided folder path '{output_dir}' is not a valid directory.", file=sys.stderr)
-            sys.exit(1)
-        out_dir = output_dir
-    elif inputs:
-        if len(inputs) == 1:
-            out_dir = os.path.dirname(inputs[0]) if os.path.isfile(inputs[0]) else inputs[0]
-            if out_dir == "": out_dir = os.getcwd()
-        else:
-            print("Multiple input files provided without output_dir. Please specify an output directory.", file=sys.stderr)
-            sys.exit(1)
+    if output_dir or inputs:
+        out_dir = _output_dir(output_dir, inputs)
     else:
         print(anonymized)
+        if quarantine: print(f"Skipped documents: {json.dumps(quarantine)}", file=sys.stderr)
         return None
 
     try:
@@ -147,6 +215,10 @@ def anonymize(inputs: list[str],
         print(f"Error writing to directory '{out_dir}': {e}", file=sys.stderr)
         sys.exit(1)
 
+    if quarantine:
+        save_json_file(os.path.join(out_dir, "_quarantine.json"), quarantine)
+        print(f"{len(quarantine)} documents skipped, see '{os.path.join(out_dir, '_quarantine.json')}'.", file=sys.stderr)
+
     if out_path:
         print(f"Anonymized text saved to '{out_path}'.")
         if metrics:
@@ -154,6 +226,426 @@ def anonymize(inputs: list[str],
 
     return out_path
 
+
+def _anonymize_in_chunks(files: list[str],
+                         out_dir: str,
+                         entities: list[str],
+                         per_matching: int,
+                         personal_data: str,
+                         profile: str,
+                         backend: str,
+                         use_cache: bool,
+                         segment_cache: bool,
+                         watchdog: bool,
+                         incremental: bool) -> str:
+    """
+    Anonymizes the given input files RESUME_CHUNK_FILES at a time, saving the outputs of each file as soon as its chunk
+    is done and recording it in the journal of the output folder (see utils.journal_utils), or in its manifest if
+    incremental (see utils.manifest_utils). Files already recorded, and unchanged since, are skipped, so that an
+    interrupted run picks up where it stopped. With the manifest, files are compared by content and settings, and only
+    the new or changed entries of patient JSONs are anonymized, merged with the ones saved before.
+    The model is only loaded if some files are left. The arguments are the ones of anonymize.
+
+    :return: the output folder.
+    """
+    from utils.journal_utils import RunJournal, JOURNAL_FILE
+    from utils.manifest_utils import RunManifest, MANIFEST_FILE, settings_fingerprint
+
+    forced_personal_data = _read_personal_data(personal_data) if personal_data else None
+    if incremental:
+        try:
+            settings = settings_fingerprint(DEFAULT_NER_MODEL, profile, backend, entities, per_matching,
+                                            forced_personal_data)
+        except OSError as e:
+            print(f"Error reading spaCy model: {e}", file=sys.stderr)
+            sys.exit(1)
+        tracker = RunManifest(os.path.join(out_dir, MANIFEST_FILE), settings)
+    else:
+        tracker = RunJournal(os.path.join(out_dir, JOURNAL_FILE))
+
+    with tracker:
+        pending = [filepath for filepath in files if not tracker.is_done(filepath)]
+        if len(pending) < len(files):
+            print(f"Skipping {len(files) - len(pending)} of {len(files)} input files already anonymized according to '{tracker.path}'.", file=sys.stderr)
+        if pending:
+            nlp = _load_model(profile, backend, per_matching)
+
+        for start in range(0, len(pending), RESUME_CHUNK_FILES):
+            chunk = pending[start:start + RESUME_CHUNK_FILES]
+            known = {filepath: tracker.known_entries(filepath) for filepath in chunk}
+            read_files, read_quarantine = _read_files(chunk, watchdog, known)
+            for record in read_quarantine:
+                tracker.record(record["source"], 0, [], [record])
+
+            try:
+                results = _anonymize_read_files(read_files, known, nlp, out_dir, tracker.next_index, forced_personal_data,
+                                                entities, per_matching, profile, use_cache, segment_cache, watchdog)
+            except OSError as e:
+                print(e, file=sys.stderr)
+                sys.exit(1)
+            for result in results:
+                tracker.record(*result)
+            tracker.checkpoint()
+
+        quarantine = tracker.quarantine()
+
+    if quarantine:
+        save_json_file(os.path.join(out_dir, "_quarantine.json"), quarantine)
+        print(f"{len(quarantine)} documents skipped, see '{os.path.join(out_dir, '_quarantine.json')}'.", file=sys.stderr)
+    print(f"Anonymized text saved to '{out_dir}'.")
+    return out_dir
+
+
+def _anonymize_from_queue(files: list[str],
+                          out_dir: str,
+                          entities: list[str],
+                          per_matching: int,
+                          personal_data: str,
+                          profile: str,
+                          backend: str,
+                          use_cache: bool,
+                          segment_cache: bool,
+                          watchdog: bool) -> str:
+    """
+    Anonymizes the given input files as one of the nodes sharing the output folder through its work queue (see
+    utils.queue_utils): the files are split into units of QUEUE_UNIT_FILES files, and the node claims and anonymizes
+    units until none is left, then waits for the units leased by the other nodes, reclaiming the ones of dead nodes.
+    Files that cannot be read are quarantined and units failing are recorded in the queue, so that a bad input does
+    not stop the nodes. The model is only loaded if the node claims a unit. The arguments are the ones of anonymize.
+
+    :return: the output folder.
+    """
+    from utils.queue_utils import WorkQueue, QUEUE_DIR, LeaseLost, lease_heartbeat
+
+    queue = WorkQueue(os.path.join(out_dir, QUEUE_DIR))
+    units = queue.create_units(files, QUEUE_UNIT_FILES)
+    print(f"Node {queue.node} joined the queue of {len(units)} units in '{queue.root}'.", file=sys.stderr)
+    forced_personal_data = _read_personal_data(personal_data) if personal_data else None
+    nlp, done = None, 0
+    while True:
+        unit = queue.claim()
+        if unit is None:
+            if not queue.leased():
+                break
+            time.sleep(QUEUE_HEARTBEAT_SECONDS)     # Units still leased: done by their nodes, or reclaimed once expired
+            continue
+        if nlp is None:
+            nlp = _load_model(profile, backend, per_matching)
+        started = time.perf_counter()
+        with lease_heartbeat(queue, unit) as check_lease:
+            try:
+                # No document saved before: every document of the unit is read and anonymized
+                known = {filepath: {} for filepath in unit["files"]}
+                read_files, quarantine = _read_files(unit["files"], watchdog, known, quarantine_errors=True)
+                results = _anonymize_read_files(read_files, known, nlp, out_dir, unit["first_index"], forced_personal_data,
+                                                entities, per_matching, profile, use_cache, segment_cache, watchdog,
+                                                before_save=check_lease)
+                check_lease()
+            except LeaseLost as e:
+                print(f"Warning: {e} The unit is left to it.", file=sys.stderr)
+                queue.update_node("idle")
+                continue
+            except Exception as e:
+                print(f"Error anonymizing unit {unit['id']}: {e}", file=sys.stderr)
+                queue.fail(unit, str(e))
+                continue
+        queue.complete(unit, {"files": unit["files"],
+                              "docs": sum(docs for _, docs, _, _, _ in results),
+                              "outputs": [path for _, _, outputs, _, _ in results for path in outputs],
+                              "quarantine": quarantine + [record for _, _, _, skipped, _ in results for record in skipped],
+                              "seconds": time.perf_counter() - started})
+        done += 1
+
+    queue.update_node("done")
+    status = queue.status()
+    print(f"Node {queue.node} anonymized {done} units. Queue: {status['done']['units']}/{status['units']} units done, {len(status['failed'])} failed.", file=sys.stderr)
+    if status["quarantine"]:
+        save_json_file(os.path.join(out_dir, "_quarantine.json"), status["quarantine"])
+        print(f"{len(status['quarantine'])} documents skipped, see '{os.path.join(out_dir, '_quarantine.json')}'.", file=sys.stderr)
+    print(f"Anonymized text saved to '{out_dir}'.")
+    return out_dir
+
+
+def _anonymize_read_files(read_files: list[tuple[str, tuple]],
+                          known: dict[str, dict],
+                          nlp,
+                          out_dir: str,
+                          first_index: int,
+                          forced_personal_data: dict,
+                          entities: list[str],
+                          per_matching: int,
+                          profile: str,
+                          use_cache: bool,
+                          segment_cache: bool,
+                          watchdog: bool,
+                          before_save=None) -> list[tuple[str, int, list[str], list[dict], list[str]]]:
+    """
+    Anonymizes together the documents of the given files, read with read_file_entries (see _read_files), then saves
+    the outputs of each file, named after it, with its documents in order: the ones saved before (known, by file and
+    document hash) and the ones just anonymized. The other arguments are the ones of anonymize.
+
+    :param first_index: index of the first document, used to name the outputs of consecutive calls without collisions.
+    :param before_save: optional function called before saving the outputs of each file, which aborts by raising
+                        (e.g. when the lease of a queue unit was lost, see utils.queue_utils.lease_heartbeat).
+    :return: for each file, its path, number of documents, output paths, documents skipped by the watchdog and hashes
+             of the documents saved, i.e. the arguments of RunJournal.record. Raises OSError if the outputs cannot be
+             written.
+    """
+    from anonymization_functions import anonymize_texts
+    from utils.anonymization_utils import save_many_texts
+    from utils.manifest_utils import saved_text
+
+    # Documents not saved before, i.e. all of them unless the manifest knows some entries of a patient JSON
+    texts, metadata, personal_data_list, sources, quarantine = [], [], [], [], []
+    for filepath, (t, m, pd, _) in read_files:
+        new = [i for i, text in enumerate(t) if text is not None]
+        texts.extend(t[i] for i in new)
+        metadata.extend(m[i] for i in new)
+        personal_data_list.extend([forced_personal_data or pd]*len(new))
+        sources.extend([filepath]*len(new))
+
+    anonymized = []
+    if texts:
+        pipeline_metrics = get_pipeline_metrics()
+        first_doc_id = len(pipeline_metrics.documents) if pipeline_metrics is not None else None
+        anonymized, _ = anonymize_texts(texts,
+                                        nlp=nlp,
+                                        entities=entities,
+                                        per_matching=per_matching,
+                                        personal_data=personal_data_list,
+                                        meta_data=metadata,
+                                        profile=profile,
+                                        use_cache=use_cache,
+                                        segment_cache=segment_cache,
+                                        watchdog=watchdog,
+                                        quarantine=quarantine)
+        if pipeline_metrics is not None:
+            pipeline_metrics.describe_documents(first_doc_id, source=sources)
+
+    # Outputs of each file, named after it, with its documents in order (saved before or just anonymized)
+    results, position = [], 0
+    for filepath, (t, m, pd, hashes) in read_files:
+        kept_texts, kept_metadata, kept_hashes, skipped = [], [], [], []
+        for i, text in enumerate(t):
+            if text is None:
+                anonymized_text = saved_text(known[filepath][hashes[i]])
+            else:
+                anonymized_text = anonymized[position]
+                skipped += [{**record, "index": i, "source": filepath}
+                            for record in quarantine if record["index"] == position]
+                position += 1
+            if anonymized_text is not None:
+                kept_texts.append(anonymized_text)
+                kept_metadata.append(m[i])
+                kept_hashes.append(hashes[i])
+        outputs = []
+        if kept_texts:
+            if before_save is not None: before_save()
+            try:
+                save_many_texts(kept_texts,
+                                output_dir=out_dir,
+                                original_filename=filepath,
+                                single_file=DEFAULT_OUTPUTS_IN_SINGLE_FILE,
+                                metadata=kept_metadata,
+                                personal_data=[forced_personal_data or pd]*len(kept_texts),
+                                first_index=first_index,
+                                written_files=outputs)
+            except Exception as e:
+                raise OSError(f"Error writing to directory '{out_dir}': {e}") from e
+        results.append((filepath, len(t), outputs, skipped, kept_hashes))
+        first_index += len(t)
+    return results
+
+
+def _read_files(files: list[str], watchdog: bool, known: dict[str, dict] = None, quarantine_errors: bool = False) \
+        -> tuple[list[tuple[str, tuple]], list[dict]]:
+    """
+    Reads the given files (see read_file), under time budgets if watchdog, exiting if a file cannot be read without
+    watchdog (unless quarantine_errors). Returns the (path, read_file result) pairs of the files read and the
+    quarantine records of the others.
+    If known (the hashes of the documents already saved, by file) is given, files are read with read_file_entries,
+    whose results also include the document hashes and have None in place of the texts of the known documents.
+    """
+    from utils.anonymization_utils import read_file
+    from utils.manifest_utils import read_file_entries
+    from utils.watchdog import read_files_with_watchdog, quarantine_record, EXTRACTION_ERROR_REASON
+
+    if watchdog:
+        if known is None:
+            return read_files_with_watchdog(files)
+        # Worker processes read the known documents too (the hashes are not sent to them), they are dropped here
+        read_files, quarantine = read_files_with_watchdog(files, reader=read_file_entries)
+        return [(filepath, ([None if digest in known[filepath] else text for text, digest in zip(t, hashes)], m, pd, hashes))
+                for filepath, (t, m, pd, hashes) in read_files], quarantine
+    read_files, quarantine = [], []
+    for filepath in files:
+        try:
+            read_files.append((filepath, read_file(filepath) if known is None else read_file_entries(filepath, known[filepath])))
+        except Exception as e:
+            print(f"Error reading '{filepath}': {e}", file=sys.stderr)
+            if not quarantine_errors:
+                sys.exit(1)
+            quarantine.append(quarantine_record(EXTRACTION_ERROR_REASON, source=filepath, detail=str(e)))
+    return read_files, quarantine
+
+
+def _read_personal_data(path: str) -> dict:
+    try:
+        return read_json_file(path)
+    except Exception as e:
+        print(f"Error reading personal data file '{path}': {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+def _load_model(profile: str, backend: str, per_matching: int):
+    """Loads the spaCy model, exiting if it cannot be loaded, and shares it with the worker processes."""
+    from utils.model_utils import load_model
+
+    try:
+        nlp = load_model(DEFAULT_NER_MODEL, profile, backend)
+    except Exception as e:
+        print(f"Error loading spaCy model: {e}", file=sys.stderr)
+        sys.exit(1)
+    share_with_workers(nlp, per_matching if per_matching is not None else get_profile_per_matching(profile))
+    return nlp
+
+
+def _exclude_run_files(files: list[str], out_dir: str) -> list[str]:
+    """Drops from the input files the ones written in out_dir by the runs saving per input file: their outputs
+    (<name>_anonymized.json, <name>_anonymized_<n>.txt), journal, manifest and quarantine, so that these runs can be started
+    again when the output folder is also an input folder. The _queue folder is not listed, inputs not being recursive."""
+    from utils.journal_utils import JOURNAL_FILE
+    from utils.manifest_utils import MANIFEST_FILE
+
+    out_dir = os.path.abspath(out_dir)
+    run_files = (JOURNAL_FILE, MANIFEST_FILE, "_quarantine.json")
+    return [filepath for filepath in files
+            if os.path.dirname(os.path.abspath(filepath)) != out_dir
+            or not (os.path.basename(filepath).startswith(run_files) or OUTPUT_NAME_RE.search(os.path.basename(filepath)))]
+
+
+def _output_dir(output_dir: str, inputs: list[str]) -> str:
+    """Folder where to save the outputs: output_dir, or the folder of the single input. Exits if neither is valid."""
+    if output_dir:
+        if not os.path.isdir(output_dir):
+            print(f"Provided folder path '{output_dir}' is not a valid directory.", file=sys.stderr)
+            sys.exit(1)
+        return output_dir
+    if len(inputs) == 1:
+        out_dir = os.path.dirname(inputs[0]) if os.path.isfile(inputs[0]) else inputs[0]
+        return out_dir if out_dir != "" else os.getcwd()
+    print("Multiple input files provided without output_dir. Please specify an output directory.", file=sys.stderr)
+    sys.exit(1)
+
+# ----------------------------
+#   JSONL Streaming
+# ----------------------------
+def anonymize_jsonl(inputs: list[str] = None,
+                    entities: list[str] = None,
+                    per_matching: int = None,
+                    personal_data: str = None,
+                    profile: str = None,
+                    backend: str = TRANSFORMER_BACKEND,
+                    use_cache: bool = USE_RESULT_CACHE,
+                    segment_cache: bool = USE_SEGMENT_CACHE,
+                    ordered: bool = True,
+                    batch_size: int = JSONL_BATCH_SIZE) -> None:
+    """
+    Anonymizes a stream of JSON Lines records, read from the given files or from stdin, writing one JSON line per
+    record to stdout as soon as its batch is done. Each record contains the text in the 'testo' field (or the S3 key
+    of a PDF file in 'key_s3'), the optional personal data in 'anagrafica' and any other metadata field.
+    Output records contain the input line number ('riga'), the metadata fields and the anonymized text in
+    'testo_anonimizzato', or an error message in 'errore'. Original texts, personal data and entity lists are not
+    copied to the output.
+
+    :param inputs: list of JSONL files to read. If empty, records are read from stdin.
+    :param entities: list of entity types to anonymize. If omitted, default entity types will be used.
+    :param per_matching: level of extra matching for PER and PATIENT entities. If omitted, the level of the inference profile is used.
+    :param personal_data: path to json dictionary of personal data used for the records without 'anagrafica'.
+    :param profile: name of the inference profile trading accuracy for throughput. If omitted, the default profile is used.
+    :param backend: backend running the transformer, "pytorch" or "onnx".
+    :param use_cache: whether to reuse the results of texts already anonymized with the same settings.
+    :param segment_cache: whether to process texts paragraph by paragraph, reusing the results of recurring paragraphs.
+    :param ordered: whether output records keep the input order. If False, each batch is written as soon as it is done.
+    :param batch_size: number of records anonymized together.
+    """
+    from utils.model_utils import load_model
+    from utils.streaming_utils import anonymize_stream
+
+    try:
+        default_personal_data = read_json_file(personal_data) if personal_data else None
+        nlp = load_model(DEFAULT_NER_MODEL, profile, backend)
+    except Exception as e:
+        print(f"Error loading personal data or spaCy model: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    plan = plan_cpu_usage(multi_processing=MULTI_PROCESSING)
+    apply_thread_limits(plan)
+    if per_matching is None: per_matching = get_profile_per_matching(profile)
+    share_with_workers(nlp, per_matching)
+
+    batches = _read_jsonl_batches(_read_lines(inputs), batch_size, default_personal_data)
+    for records, result in anonymize_stream(batches, nlp, plan, ordered, entities=entities, per_matching=per_matching,
+                                            use_cache=use_cache, segment_cache=segment_cache):
+        anonymized = iter(result) if not isinstance(result, Exception) else None
+        with stage(WRITE_STAGE):
+            for line_no, record, error in records:
+                if error is None and anonymized is None: error = f"{type(result).__name__}: {result}"
+                if error is not None:
+                    output = {JSONL_FIELDS[0]: line_no, JSONL_FIELDS[1]: error}
+                else:
+                    output = {JSONL_FIELDS[0]: line_no,
+                              **{k: v for k, v in record.items() if k not in _JSONL_PRIVATE_FIELDS},
+                              SINGLE_TEXT_FIELDS[3]: next(anonymized)}
+                sys.stdout.write(json.dumps(output, ensure_ascii=False) + "\n")
+            sys.stdout.flush()
+
+
+# Fields of the input records which are not copied to the output, since they contain the original text or personal data
+_JSONL_PRIVATE_FIELDS = {SINGLE_TEXT_FIELDS[2], SINGLE_TEXT_FIELDS[4], PATIENT_DATA_FIELDS[0]}
+
+
+def _read_lines(inputs: list[str]):
+    if not inputs:
+        yield from sys.stdin
+        return
+    for path in inputs:
+        with open(path, "r", encoding="utf-8") as f:
+            yield from f
+
+
+def _read_jsonl_batches(lines, batch_size: int, default_personal_data: dict[str, str] = None):
+    """
+    Groups the records of the given lines into batches of (records, texts, personal data), where records are
+    (line number, record, error) triples and texts and personal data only cover the records without errors.
+    """
+    records, texts, personal_data = [], [], []
+    for line_no, line in enumerate(lines):
+        if not line.strip(): continue
+        try:
+            with stage(READ_STAGE):
+                record = json.loads(line)
+                if SINGLE_TEXT_FIELDS[2] in record:
+                    text = record[SINGLE_TEXT_FIELDS[2]]
+                elif SINGLE_TEXT_FIELDS[5] in record:
+                    text = extract_structured_text(read_pdf_from_s3(record[SINGLE_TEXT_FIELDS[5]]))
+                else:
+                    raise ValueError(f"Each record must contain either a '{SINGLE_TEXT_FIELDS[2]}' or a '{SINGLE_TEXT_FIELDS[5]}' field.")
+            if not isinstance(text, str): raise ValueError(f"The '{SINGLE_TEXT_FIELDS[2]}' field must be a string.")
+        except Exception as e:
+            records.append((line_no, None, f"{type(e).__name__}: {e}"))
+        else:
+            records.append((line_no, record, None))
+            texts.append(text)
+            personal_data.append(record.get(PATIENT_DATA_FIELDS[0]) or default_personal_data)
+
+        if len(records) >= batch_size:
+            yield records, texts, personal_data
+            records, texts, personal_data = [], [], []
+    if records:
+        yield records, texts, personal_data
+
+
 # ----------------------------
 #   CLI logic
 # ----------------------------
@@ -167,27 +659,158 @@ def main():
     parser.add_argument("--entities", type=str, nargs="+", help="List of entity types to anonymize.")
     parser.add_argument("--per-matching", type=int, help="Enable extra matching for PER and PATIENT entities using dictionaries with increasing level of strictness: 0 = no extra matching, 1 = match only dictionary-unambiguous names, 2 = match all names.")
     parser.add_argument("--personal-data", type=str, help=f"Path to json dictionary of specific personal data to anonymize. Provided dictionary should have the following fields: {list(PERSONAL_DATA_FORMAT.keys())}.")
+    parser.add_argument("--inference-profile", type=str, choices=list(INFERENCE_PROFILES.keys()), help=f"Inference profile trading accuracy for throughput (default: {DEFAULT_INFERENCE_PROFILE}). 'fast' removes the overlap between transformer windows and disables extra PER matching, 'thorough' increases the overlap and matches all dictionary names.")
+    parser.add_argument("--backend", type=str, choices=["pytorch", "onnx"], default=TRANSFORMER_BACKEND, help=f"Backend running the transformer (default: {TRANSFORMER_BACKEND}). The onnx backend requires the transformer exported with 'optimize_model.py onnx' and falls back to pytorch if it is not available.")
+    parser.add_argument("--cache", action="store_true", default=USE_RESULT_CACHE, help=f"Reuse the results of texts already anonymized with the same model, entities and rules, skipping NER for them. Results are stored in '{RESULT_CACHE_PATH}'.")
+    parser.add_argument("--segment-cache", action="store_true", default=USE_SEGMENT_CACHE, help="Process texts paragraph by paragraph, reusing the results of recurring paragraphs (templates, headings, stock phrases). Paragraphs containing personal data are never cached.")
+    ner_output = parser.add_mutually_exclusive_group()
+    ner_output.add_argument("--save-ner", type=str, metavar="DIR", help="Run only the NER model and save its output (texts and entities) as sharded DocBin files in the given folder, to be anonymized later with --from-ner.")
+    ner_output.add_argument("--from-ner", type=str, metavar="DIR", help="Anonymize the NER output saved with --save-ner, applying only rules, merging and replacement with the given --entities and --per-matching, without running the model.")
+    parser.add_argument("--watchdog", action="store_true", default=WATCHDOG, help="Read and anonymize each document under time budgets (EXTRACTION_TIMEOUT, NER_TIMEOUT, RULES_TIMEOUT in config.py), skipping the ones exceeding them instead of stalling the batch. Skipped documents are listed with a reason code in _quarantine.json in the output folder.")
+    parser.add_argument("--resume", action="store_true", help=f"With file and folder inputs, anonymize {RESUME_CHUNK_FILES} files at a time (RESUME_CHUNK_FILES), saving the outputs of each input file (named after it) as soon as its chunk is done and recording it in _journal.jsonl in the output folder. Started again with the same inputs and output folder after a crash or a kill, the run skips the files already recorded and unchanged since.")
+    parser.add_argument("--incremental", action="store_true", help="Like --resume, recording in _manifest.json in the output folder the content hash of each input file and of each of its documents, with the model and settings used. Later runs with the same output folder skip the files unchanged since, and for the patient JSONs that changed only anonymize the new or changed entries of 'testi', merging them with the ones already saved. Changing model, profile, entities, rules or personal data anonymizes everything again.")
+    parser.add_argument("--jsonl", action="store_true", help="Stream mode: read one JSON record per line from the input files or stdin (with 'testo' or 'key_s3', optional 'anagrafica' and metadata fields) and write one JSON line per record to stdout, with the anonymized text in 'testo_anonimizzato'.")
+    parser.add_argument("--unordered", action="store_true", help="With --jsonl, write the records of each batch as soon as it is done instead of keeping the input order. Records can be matched to the input lines through the 'riga' field.")
+    parser.add_argument("--serve", action="store_true", help="Load the model once and run a local HTTP anonymization service (POST /anonymize, POST /anonymize/batch, GET /health, GET /stats), anonymizing concurrent requests together in micro-batches.")
+    parser.add_argument("--host", type=str, default=SERVER_HOST, help=f"Address the --serve service listens on (default: {SERVER_HOST}). The service has no authentication, so keep it local.")
+    parser.add_argument("--port", type=int, default=SERVER_PORT, help=f"Port the --serve service listens on (default: {SERVER_PORT}).")
+    parser.add_argument("--socket", type=str, metavar="PATH", help="Unix socket the --serve service listens on, instead of --host and --port.")
+    parser.add_argument("--start-method", type=str, choices=["spawn", "forkserver", "fork"], default=MP_START_METHOD, help=f"Start method of the worker processes (default: {MP_START_METHOD}). With 'forkserver' (Linux/macOS) the model and the rules are loaded once in a server process and the workers forked from it share them copy-on-write; 'fork' shares the model loaded by the main process.")
+    parser.add_argument("--pipeline-metrics", action="store_true", default=PIPELINE_METRICS, help="Time each stage of the pipeline (read, S3 fetch, PDF extraction, tokenization, transformer, NER, rules, merge, replacement, write) for each document, saving a report with the p50/p95/p99 times of each stage and the docs/s and chars/s throughput in <name>_pipeline_metrics.json next to the outputs. A summary is printed on stderr.")
+    parser.add_argument("--live-metrics", action="store_true", help=f"Print a summary of the pipeline metrics on stderr every {LIVE_METRICS_INTERVAL} s while anonymizing (implies --pipeline-metrics).")
+    parser.add_argument("--profile", type=str, nargs="?", const=PROFILE_MODE, choices=[SAMPLING, DETERMINISTIC], help=f"Profile the run (default mode: {PROFILE_MODE}). 'sampling' samples the stacks of the process and of its workers, saving them merged by pipeline stage as folded stacks in <name>_profile.folded (for flamegraph.pl, inferno or speedscope); 'deterministic' traces every call of the main process with cProfile, saving <name>_profile.pstats. Files are saved next to the outputs, or in the current folder as anonymize_*.")
+    parser.add_argument("--profile-memory", action="store_true", help="With --profile, also trace the allocations of the rules and merge stages with tracemalloc, saving their peak per document and top allocation sites in <name>_memory_profile.json and the snapshot of the largest document in <name>_<stage>.tracemalloc.")
+    parser.add_argument("--queue", action="store_true", help=f"Anonymize the inputs as one node of a group of machines sharing the output folder (e.g. over NFS), with the same command on each of them: nodes claim units of {QUEUE_UNIT_FILES} input files (QUEUE_UNIT_FILES) through lease files in the _queue folder of the output folder, and save the outputs of each input file named after it. Units leased by a node that stopped sending heartbeats for {QUEUE_LEASE_SECONDS} s are reclaimed by the others. Input paths must be the same on every node.")
+    parser.add_argument("--queue-status", type=str, metavar="OUTPUT_DIR", help="Print as JSON the progress of the --queue run saving in OUTPUT_DIR (units, files and documents done, failed, running and pending, throughput, estimated remaining time and activity of each node), then exit.")
     parser.add_argument("--gui", action="store_true", help="Launch the graphical user interface.")
+    parser.add_argument("--cpu-report", action="store_true", help="Print the detected CPU topology, CPU quotas and memory together with the planned number of processes and threads, then exit.")
+    parser.add_argument("--estimate", action="store_true", help="Dry run planning the anonymization of the inputs: scan them without running the model (documents, characters, PDF pages, S3 references), anonymize a sample of --calibration-docs documents to calibrate the costs on this machine, then print as JSON the predicted wall time, peak memory and recommended worker and batch configuration, and exit.")
+    parser.add_argument("--calibration-docs", type=int, default=ESTIMATE_SAMPLE_DOCS, metavar="N", help=f"Number of documents anonymized by --estimate to calibrate its predictions (default: {ESTIMATE_SAMPLE_DOCS}). With 0, the inputs are only scanned, without loading the model.")
 
     args = parser.parse_args()
+    per_matching = args.per_matching if args.per_matching is not None else get_profile_per_matching(args.inference_profile)
+    # The forkserver only preloads the model for the pools whose workers load it (watchdog, shared memory, --jsonl):
+    # the workers of nlp.pipe receive the pipeline pickled, so a preloaded copy would only take memory
+    model_args = None
+    if args.watchdog or MULTI_PROCESSING and (args.jsonl or SHARED_MEMORY_TRANSPORT):
+        # ONNX Runtime sessions keep the number of threads they were created with: the workers get their share of the cores
+        n_threads = plan_cpu_usage(multi_processing=MULTI_PROCESSING)["threads_per_process"] if args.backend == "onnx" else None
+        model_args = {"path": DEFAULT_NER_MODEL, "profile": args.inference_profile, "backend": args.backend, "n_threads": n_threads}
+    configure_start_method(args.start_method, model_args=model_args, per_matching=per_matching)
 
     # -----------------------------------
     # GUI MODE
     # -----------------------------------
     if args.gui or len(sys.argv) == 1:
+        from GUI.GUI import main as gui_main
         gui_main()
         return
 
+    if args.cpu_report:
+        print(json.dumps(plan_cpu_usage(multi_processing=MULTI_PROCESSING), indent=2))
+        return
+
+    if args.queue_status:
+        from utils.queue_utils import WorkQueue, QUEUE_DIR
+
+        queue_dir = os.path.join(args.queue_status, QUEUE_DIR)
+        if not os.path.isdir(queue_dir):
+            print(f"Error: no work queue found in '{args.queue_status}'.", file=sys.stderr)
+            sys.exit(1)
+        print(json.dumps(WorkQueue(queue_dir, node="status").status(), indent=2))
+        return
+
+    if args.estimate:
+        from utils.estimate_utils import estimate_run
+
+        files = list_input_files(args.inputs)
+        if not files:
+            print("Error: No valid input files found.", file=sys.stderr)
+            sys.exit(1)
+        print(json.dumps(estimate_run(files, args.calibration_docs, profile=args.inference_profile, backend=args.backend,
+                                      entities=args.entities, per_matching=per_matching), indent=2))
+        return
+
+    # Stage timings and profile of the CLI and JSONL modes
+    collect_metrics = args.pipeline_metrics or args.live_metrics
+    metrics_context = collect_pipeline_metrics(LIVE_METRICS_INTERVAL if args.live_metrics else None) \
+        if collect_metrics else nullcontext()
+    profiler = RunProfiler(args.profile or PROFILE_MODE, args.profile_memory) if args.profile or args.profile_memory else None
+
     # -----------------------------------
-    # CLI MODE
+    # JSONL STREAMING MODE
+    # -----------------------------------
+    if args.jsonl:
+        with metrics_context as pipeline_metrics, profiler or nullcontext():
+            anonymize_jsonl(inputs=args.inputs,
+                            entities=args.entities,
+                            per_matching=args.per_matching,
+                            personal_data=args.personal_data,
+                            profile=args.inference_profile,
+                            backend=args.backend,
+                            use_cache=args.cache,
+                            segment_cache=args.segment_cache,
+                            ordered=not args.unordered)
+        _save_run_reports(pipeline_metrics, profiler, None)
+        return
+
+    # -----------------------------------
+    # SERVICE MODE
     # -----------------------------------
-    anonymize(inputs=args.inputs,
-              output_dir=args.output_dir,
-              text=args.text,
+    if args.serve:
+        from utils.model_utils import load_model
+        from utils.server_utils import serve
+
+        nlp = load_model(DEFAULT_NER_MODEL, args.inference_profile, args.backend)
+        serve(nlp, args.host, args.port, args.socket,
               entities=args.entities,
-              per_matching=args.per_matching,
-              personal_data=args.personal_data)
+              per_matching=per_matching,
+              use_cache=args.cache, segment_cache=args.segment_cache)
+        return
+
+    # -----------------------------------
+    # CLI MODE
+    # -----------------------------------
+    with metrics_context as pipeline_metrics, profiler or nullcontext():
+        out_path = anonymize(inputs=args.inputs,
+                             output_dir=args.output_dir,
+                             text=args.text,
+                             entities=args.entities,
+                             per_matching=args.per_matching,
+                             personal_data=args.personal_data,
+                             profile=args.inference_profile,
+                             backend=args.backend,
+                             use_cache=args.cache,
+                             segment_cache=args.segment_cache,
+                             save_ner=args.save_ner,
+                             from_ner=args.from_ner,
+                             watchdog=args.watchdog,
+                             resume=args.resume,
+                             incremental=args.incremental,
+                             queue=args.queue)
+    _save_run_reports(pipeline_metrics, profiler, out_path)
+
+
+def _save_run_reports(pipeline_metrics, profiler: RunProfiler | None, out_path: str | None) -> None:
+    """
+    Prints the summary of the pipeline metrics and of the profile of a run on stderr, saving them next to its output
+    path. Without output path, the pipeline metrics are only printed and the profile is saved in the current folder.
+    """
+    if pipeline_metrics is not None:
+        print(f"Pipeline metrics: {pipeline_metrics.summary()}", file=sys.stderr)
+        if out_path:
+            from utils.anonymization_utils import save_pipeline_metrics
+            out_path = os.path.abspath(out_path)
+            report_path = save_pipeline_metrics(pipeline_metrics.report(), output_dir=os.path.dirname(out_path),
+                                                original_filename=os.path.basename(out_path))
+            print(f"Pipeline metrics saved to '{report_path}'.", file=sys.stderr)
+
+    if profiler is not None:
+        paths = profiler.save(os.path.abspath(out_path) if out_path else os.path.join(os.getcwd(), "anonymize"))
+        stages = ", ".join(f"{stage} {share:.0%}" for stage, share in profiler.stage_shares().items())
+        print(f"Profile{f' ({stages})' if stages else ''} saved to {', '.join(repr(path) for path in paths)}.", file=sys.stderr)
 
 
 if __name__ == "__main__":
+    mp.freeze_support()
     main()
\ No newline at end of file
@@ -6,12 +6,80 @@ DEFAULT_EXTRA_PER_MATCHING_LEVEL = 0            # Whether to use extra pattern m
                                                 # 0: no extra matching,
                                                 # 1: match non-ambiguous names and surnames when they appear as names (capitalized/uppercase and not preceded by a preposition),
                                                 # 2: match non-ambiguous names in any case and ambiguous names and surnames when they appear as names (capitalized/uppercase and not preceded by a preposition)
+DEFAULT_INFERENCE_PROFILE = "balanced"          # Inference profile applied to the loaded model, among the ones in INFERENCE_PROFILES
+INFERENCE_PROFILES = {                          # Trade-offs between throughput and accuracy, applied at load time without editing the model folder:
+                                                # window/stride: transformer span getter (stride < window re-encodes overlapping tokens),
+                                                # batch_size: texts per nlp.pipe batch, max_batch_items: max padded wordpieces per transformer batch,
+                                                # per_matching: extra PER matching level (None: DEFAULT_EXTRA_PER_MATCHING_LEVEL)
+    "fast":     {"window": 128, "stride": 128, "batch_size": 256, "max_batch_items": 8192, "per_matching": 0},
+    "balanced": {"window": 128, "stride": 96,  "batch_size": 128, "max_batch_items": 4096, "per_matching": None},
+    "thorough": {"window": 128, "stride": 64,  "batch_size": 64,  "max_batch_items": 4096, "per_matching": 2},
+}
+TRANSFORMER_BACKEND = "pytorch"                 # Backend running the transformer: "pytorch" or "onnx" (requires the transformer exported with optimize_model.py onnx, falls back to "pytorch" if unavailable)
+ONNX_TRANSFORMER_DIR = "transformer_onnx"       # Folder, inside the model folder, containing the transformer exported to ONNX
+SNAPSHOT_TRANSFORMER_DIR = "transformer_snapshot"  # Folder, inside the model folder, containing the memory-mappable snapshot of the transformer (optimize_model.py snapshot)
+USE_MODEL_SNAPSHOT = True                       # Whether the PyTorch backend loads the transformer from its snapshot, when available and up to date, for a faster cold start
+STRIP_TRF_DATA = True                           # Whether to drop the transformer tensors from the docs right after NER, since only the entities are needed afterwards
+VOCAB_RECYCLING = True                          # Whether to process docs in spaCy memory zones, releasing the strings they add to the vocab so that long-running processes do not grow without bound
+VOCAB_RECYCLE_DOCS = 10000                      # Maximum number of docs processed in the same memory zone
+VOCAB_RECYCLE_RSS_MB = None                     # Resident memory in MB beyond which the current memory zone is closed early. None: recycle only every VOCAB_RECYCLE_DOCS docs
+VOCAB_RSS_CHECK_DOCS = 500                      # Number of docs processed between two checks of the resident memory, if VOCAB_RECYCLE_RSS_MB is set
+MEMORY_GOVERNOR = True                          # Whether batch runs, streams and the service adapt to memory pressure: shrinking chunks, spilling finished results to disk and pausing intake
+MEMORY_HIGH_WATERMARK_MB = None                 # Resident memory in MB of the process and its workers beyond which the memory governor acts. None: 80% of the memory available at start (cgroup limits included)
+MEMORY_LOW_WATERMARK_MB = None                  # Resident memory in MB below which shrunk chunks grow back. None: 80% of the high watermark
+MEMORY_CHUNK_CHARS = 1000000                    # Maximum number of characters of the texts processed together by a single process between two checks of the memory governor, so that long documents are checked often
+MEMORY_CHECK_INTERVAL = 0.5                     # Minimum time in seconds between two measures of the memory by the governor
+MEMORY_PAUSE_TIMEOUT = 60                       # Maximum time in seconds intake is paused waiting for the memory to drop below the high watermark
+MEMORY_SPILL_DIR = None                         # Folder of the temporary files of spilled results. None: the system temporary folder
+WATCHDOG = False                                # Whether to process each document under time budgets, skipping and quarantining the ones exceeding them instead of stalling the whole batch
+EXTRACTION_TIMEOUT = 60                         # Time budget in seconds for reading a file, including the text extraction of PDF files
+NER_TIMEOUT = 30                                # Time budget in seconds for NER and rules on a text
+RULES_TIMEOUT = 10                              # Time budget in seconds for the regex matching of the rules on a text
 DEFAULT_OUTPUTS_IN_SINGLE_FILE = True           # True: If multiple texts are found in a json, save them in a single json file; False: save each text in a separate .txt file
+NER_SHARD_SIZE = 1000                           # Maximum number of docs in each DocBin file saved with --save-ner
+RESUME_CHUNK_FILES = 64                         # Number of input files read, anonymized and saved together by --resume runs, between two checkpoints of the journal
+QUEUE_UNIT_FILES = 16                           # Number of input files of each work unit claimed by the nodes of a --queue run
+QUEUE_LEASE_SECONDS = 600                       # Seconds without heartbeat after which the lease of a unit is considered abandoned by a dead node and reclaimed
+QUEUE_HEARTBEAT_SECONDS = 30                    # Seconds between two heartbeats of the lease of the unit being processed, well below QUEUE_LEASE_SECONDS
+PIPELINE_METRICS = False                        # Whether to time each stage of the pipeline (read, S3 fetch, PDF extraction, tokenization, transformer, NER, rules, merge, replacement, write) per document, saving a report in <name>_pipeline_metrics.json next to the outputs
+LIVE_METRICS_INTERVAL = 5                       # Time in seconds between two summaries of the pipeline metrics printed on stderr with --live-metrics
+PROFILE_MODE = "sampling"                       # Profiler used by --profile: "sampling" (stacks of the process and of its workers sampled and merged by stage, saved as folded stacks for flamegraph tools) or "deterministic" (every call of the main process traced with cProfile, saved as .pstats)
+PROFILE_SAMPLING_INTERVAL = 0.005               # Time in seconds between two stack samples of the sampling profiler
+PROFILE_MEMORY_FRAMES = 10                      # Number of frames stored by tracemalloc for each allocation of the rules and merge stages with --profile-memory
+ESTIMATE_SAMPLE_DOCS = 20                       # Number of documents anonymized by --estimate to calibrate its predictions on the current machine (0: only scan the inputs)
+ESTIMATE_PARALLEL_EFFICIENCY = 0.8              # Fraction of the throughput of a single process assumed for each additional worker process in the --estimate predictions
 
 ### IMPOSTAZIONI PER IL MULTI-PROCESSING
 
 MULTI_PROCESSING = False                        # Whether to use multiprocessing for anonymizing multiple texts
-P_CORES = 4                                     # Number of Cores / Performance Cores of the machine (used for multiprocessing)
+P_CORES = None                                  # Maximum number of Cores / Performance Cores to use for multiprocessing. None: detect them from the CPU topology, cgroup quotas and memory
+PIN_WORKERS = False                             # Whether to pin worker processes to dedicated performance cores
+WORKER_RAM_GB = 1.5                             # Estimated RAM needed by each worker process holding a copy of the model
+MP_START_METHOD = "spawn"                       # Start method of worker processes: "spawn", "forkserver" or "fork" (not on Windows). With "forkserver" and "fork" the model and the rules are loaded once and shared copy-on-write by the workers
+SHARED_MEMORY_TRANSPORT = False                 # Whether worker processes read texts and write entity spans through shared memory, each running NER and rules with its own model copy, instead of pickling texts and docs
+AUTO_TUNING = True                              # Whether to tune batch size and number of processes at runtime by measuring throughput and memory on the first batches
+TUNING_WARMUP_BATCHES = 3                       # Number of batches measured by the tuner before settling on the final parameters
+TUNING_MIN_BATCH_CHARS = 20000                  # Minimum number of characters of each warm-up batch for the tuned parameters to be saved as a profile
+TUNING_LENGTH_TOLERANCE = 2                     # Factor by which the average text length may differ from the one a profile was tuned on for it to be reused
+TUNING_PROFILES_PATH = "~/.anonimizzatore/tuning_profiles.json"  # File where tuned parameters are saved for each machine and model, so later runs start tuned
+
+### IMPOSTAZIONI CACHE
+
+USE_RESULT_CACHE = False                        # Whether to reuse the results of texts already anonymized with the same model, entities and rules, skipping NER for them
+USE_SEGMENT_CACHE = False                       # Whether to process texts paragraph by paragraph, reusing the results of recurring paragraphs (templates, headings, stock phrases). Paragraphs containing personal data are never cached
+RESULT_CACHE_PATH = "~/.anonimizzatore/result_cache.sqlite"  # File of the persistent cache of anonymization results (contains the original entity offsets, keep it private)
+RESULT_CACHE_MAX_MB = 1024                      # Maximum size of the result cache in MB, beyond which least recently used results are evicted
+
+### IMPOSTAZIONI SERVIZIO
+
+MICRO_BATCH_SIZE = 64                           # Maximum number of texts of concurrent requests anonymized together in a batch (async API and --serve)
+MICRO_BATCH_WAIT_MS = 20                        # Maximum time in milliseconds a request waits for other requests before its batch is started
+MAX_PENDING_REQUESTS = 1024                     # Maximum number of texts waiting to be anonymized, beyond which new requests wait (backpressure)
+SERVER_HOST = "127.0.0.1"                       # Address of the --serve HTTP service (keep it local: the service has no authentication)
+SERVER_PORT = 8765                              # Port of the --serve HTTP service
+SERVER_MAX_REQUEST_MB = 50                      # Maximum size of a request body of the --serve HTTP service
+SERVER_QUEUE_TIMEOUT = 30                       # Seconds a request waits for a free slot in the queue before being rejected with 503
+JSONL_BATCH_SIZE = 32                           # Number of records of the --jsonl stream anonymized together
 
 ### IMPOSTAZIONI CLOUD
 
@@ -31,6 +99,10 @@ SINGLE_TEXT_FIELDS = [
     "lista_entita",             # Lista di dizionari con le entità presenti nel testo, i singoli dizionari seguono la struttura di SINGLE_ENTITY_FIELDS (opzionale, usato per scopi di testing, alternativo a "testo_anonimizzato")
     "key_s3"                    # Stringa con il link al file pdf originale salvato su S3 (usato al posto del campo testo)
 ]
+JSONL_FIELDS = [
+    "riga",                     # Numero (0-based) della riga di input del record, per associare gli output agli input in modalità --jsonl non ordinata
+    "errore"                    # Messaggio di errore dei record che non è stato possibile anonimizzare in modalità --jsonl
+]
 PERSONAL_DATA_FIELDS = [
     "nome",
     "cognome",
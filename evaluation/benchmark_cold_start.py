@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from config import DEFAULT_NER_MODEL
+from utils import save_json_file
+
+# Run in a new interpreter for each measure, so that nothing is already imported or loaded
+_COLD_START = """
+import sys, time, json
+start = time.perf_counter()
+sys.path.insert(0, {root!r})
+import utils.model_utils as model_utils
+imported = time.perf_counter()
+model_utils.USE_MODEL_SNAPSHOT = {snapshot!r}
+nlp = model_utils.load_model({model!r})
+loaded = time.perf_counter()
+nlp("Il paziente Mario Rossi vive a Roma.")
+first_doc = time.perf_counter()
+from utils.memory_utils import get_rss_mb
+print(json.dumps({{"import_s": imported - start, "load_s": loaded - imported, "first_doc_s": first_doc - loaded,
+                  "total_s": first_doc - start, "rss_mb": get_rss_mb()}}))
+"""
+
+
+# ----------------------------
+#   Cold Start Benchmark
+# ----------------------------
+def benchmark_cold_start(model_path: str = DEFAULT_NER_MODEL, runs: int = 5, output_path: str = None) -> dict[str, dict[str, float]]:
+    """
+    Measures the time needed by a new process to import the libraries, load the model and anonymize a first doc,
+    loading the transformer from the spaCy serialization and from its snapshot (see optimize_model.py snapshot).
+    The first run of each mode is discarded, so that all the runs read the model files from the page cache.
+
+    :param model_path: path of the spaCy model, with a snapshot of its transformer.
+    :param runs: number of measured runs for each mode.
+    :param output_path: optional path of a JSON file where to save the results.
+    :return: the median of each measure for each mode.
+    """
+    results = {}
+    for mode, snapshot in (("spacy", False), ("snapshot", True)):
+        code = _COLD_START.format(root=str(PROJECT_ROOT), snapshot=snapshot, model=model_path)
+        measures = [json.loads(subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+                               .stdout.strip().splitlines()[-1]) for _ in range(runs + 1)][1:]
+        results[mode] = {key: statistics.median(m[key] for m in measures) for key in measures[0]}
+        print(f"{mode:>9}: import {results[mode]['import_s']:5.2f} s, load {results[mode]['load_s']:5.2f} s, "
+              f"first doc {results[mode]['first_doc_s']:5.2f} s, total {results[mode]['total_s']:5.2f} s, "
+              f"RSS {results[mode]['rss_mb']:7.1f} MB")
+
+    print(f"Model load speedup: {results['spacy']['load_s'] / results['snapshot']['load_s']:.2f}x")
+    if output_path:
+        save_json_file(output_path, results)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the cold start time of the model with and without its snapshot.")
+    parser.add_argument("--model", type=str, default=DEFAULT_NER_MODEL, help="Path of the spaCy model, with a snapshot created by 'optimize_model.py snapshot'.")
+    parser.add_argument("--runs", type=int, default=5, help="Number of measured runs for each mode.")
+    parser.add_argument("--output", type=str, help="Path of a JSON file where to save the results.")
+    args = parser.parse_args()
+
+    benchmark_cold_start(args.model, args.runs, args.output)
+
+
+if __name__ == "__main__":
+    main()
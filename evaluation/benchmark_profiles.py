@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import argparse
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from anonymization_functions import anonymize_texts
+from config import DEFAULT_NER_MODEL, DEFAULT_ENTITIES, INFERENCE_PROFILES
+from utils import save_json_file
+from utils.anonymization_utils import read_many_files
+from utils.model_utils import load_model
+
+
+# ----------------------------
+#   Profiles Benchmark
+# ----------------------------
+def benchmark_profiles(inputs: list[str],
+                       model_path: str = DEFAULT_NER_MODEL,
+                       profiles: list[str] = None,
+                       output_path: str = None) -> dict[str, dict[str, float]]:
+    """
+    Measures speed and accuracy of each inference profile on annotated JSON files, whose texts contain the
+    gold entities (or gold anonymized texts) used by the evaluation module.
+
+    :param inputs: list of annotated JSON files and/or folders containing them.
+    :param model_path: path of the spaCy model to benchmark.
+    :param profiles: names of the profiles to benchmark. If omitted, all the available profiles are benchmarked.
+    :param output_path: optional path of a JSON file where to save the results.
+    :return: a dictionary with docs/sec, chars/sec and F1/coverage (micro-averaged and over all entities) for each profile.
+    """
+    texts, metadata, personal_data = read_many_files(inputs, extensions=(".json",))
+    n_chars = sum(len(t) for t in texts)
+    results = {}
+
+    for profile in profiles or list(INFERENCE_PROFILES.keys()):
+        nlp = load_model(model_path, profile)
+        list(nlp.pipe(texts[:8]))  # Warm-up, so that lazy initializations are not measured
+
+        start_time = time.perf_counter()
+        _, metrics = anonymize_texts(texts, nlp=nlp, entities=DEFAULT_ENTITIES, personal_data=personal_data,
+                                     meta_data=metadata, auto_tuning=False, profile=profile)
+        elapsed = time.perf_counter() - start_time
+
+        results[profile] = {
+            "docs_per_sec": len(texts) / elapsed,
+            "chars_per_sec": n_chars / elapsed,
+            "micro_f1": metrics["micro"]["f1"] if metrics else None,
+            "ent_f1": metrics["ENT"]["f1"] if metrics else None,
+            "ent_coverage": metrics["ENT"]["coverage"] if metrics else None,
+        }
+
+    if output_path:
+        save_json_file(output_path, results)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure speed and accuracy of the inference profiles on annotated JSON files.")
+    parser.add_argument("inputs", nargs="+", help="Annotated JSON files and/or folders containing them.")
+    parser.add_argument("--model", type=str, default=DEFAULT_NER_MODEL, help="Path of the spaCy model to benchmark.")
+    parser.add_argument("--profiles", type=str, nargs="+", choices=list(INFERENCE_PROFILES.keys()), help="Profiles to benchmark (default: all).")
+    parser.add_argument("--output", type=str, help="Path of a JSON file where to save the results.")
+    args = parser.parse_args()
+
+    results = benchmark_profiles(args.inputs, args.model, args.profiles, args.output)
+
+    fmt = lambda v: f"{v:.3f}" if isinstance(v, float) else "—"
+    print("| Profile | Docs/sec | Chars/sec | Micro F1 | ENT F1 | ENT Coverage |")
+    print("|---------|----------|-----------|----------|--------|--------------|")
+    for profile, r in results.items():
+        print(f"| {profile} | {r['docs_per_sec']:.2f} | {r['chars_per_sec']:.0f} | {fmt(r['micro_f1'])} | {fmt(r['ent_f1'])} | {fmt(r['ent_coverage'])} |")
+
+
+if __name__ == "__main__":
+    main()
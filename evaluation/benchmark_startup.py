@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from config import DEFAULT_NER_MODEL
+from utils import save_json_file
+
+# Commands whose startup is measured, with the time budget (in seconds) each of them should start within.
+# Only the commands not needing the model have a budget: the others are dominated by importing spaCy and torch.
+STARTUP_COMMANDS = {
+    "help":       (["anonymize.py", "--help"], 1.0),
+    "cpu-report": (["anonymize.py", "--cpu-report"], 1.0),
+    "gui-import": (["-c", "import GUI.GUI"], 1.5),
+    "text":       (["-c", "import sys, anonymize; anonymize.DEFAULT_NER_MODEL = {model!r}; "
+                         "sys.argv = ['anonymize.py', '--text', 'Il paziente Mario Rossi vive a Roma.']; anonymize.main()"], None),
+}
+
+
+def _parse_importtime(stderr: str) -> dict[str, float]:
+    """Cumulative import time in seconds of each module imported by the command itself, from -X importtime output."""
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if name.startswith(" ") and not name.startswith("  "):  # Top-level imports only, nested ones are included
+            times[name.strip()] = times.get(name.strip(), 0) + int(cumulative) / 1e6
+    return times
+
+
+# ----------------------------
+#   Startup Benchmark
+# ----------------------------
+def benchmark_startup(commands: list[str] = None,
+                      runs: int = 5,
+                      top: int = 10,
+                      model_path: str = DEFAULT_NER_MODEL,
+                      output_path: str = None) -> dict[str, dict]:
+    """
+    Measures the wall time of short anonymize.py calls in new interpreters, together with the import time of each
+    top-level module they import (python -X importtime), and checks them against their startup budget.
+    The first run of each command is discarded, so that all the runs read the modules from the page cache.
+
+    :param commands: names of the commands to measure (keys of STARTUP_COMMANDS). If omitted, all of them are measured.
+    :param runs: number of measured runs for each command.
+    :param top: number of slowest modules printed for each command.
+    :param model_path: path of the spaCy model used by the commands anonymizing a text.
+    :param output_path: optional path of a JSON file where to save the results.
+    :return: for each command, the median wall and import time, the budget and the median import time of each module.
+    """
+    results = {}
+    for name in commands or STARTUP_COMMANDS:
+        args, budget = STARTUP_COMMANDS[name]
+        args = [arg.format(model=model_path) for arg in args]
+        walls, imports = [], []
+        for _ in range(runs + 1):
+            start = time.perf_counter()
+            process = subprocess.run([sys.executable, "-X", "importtime", *args], cwd=PROJECT_ROOT, capture_output=True,
+                                     text=True, stdin=subprocess.DEVNULL, env={**os.environ, "PYTHONWARNINGS": "ignore"})
+            walls.append(time.perf_counter() - start)
+            if process.returncode != 0:
+                raise RuntimeError(f"Command '{name}' failed: {process.stderr.strip().splitlines()[-1]}")
+            imports.append(_parse_importtime(process.stderr))
+        walls, imports = walls[1:], imports[1:]
+
+        modules = {module: statistics.median(run.get(module, 0) for run in imports) for module in imports[0]}
+        results[name] = {"wall_s": statistics.median(walls),
+                         "import_s": statistics.median(sum(run.values()) for run in imports),
+                         "budget_s": budget,
+                         "modules_s": dict(sorted(modules.items(), key=lambda item: -item[1]))}
+
+        status = "" if budget is None else f" (budget {budget:.1f} s: {'OK' if results[name]['wall_s'] <= budget else 'EXCEEDED'})"
+        print(f"{name:>10}: wall {results[name]['wall_s']:6.2f} s, imports {results[name]['import_s']:6.2f} s{status}")
+        for module, seconds in list(results[name]["modules_s"].items())[:top]:
+            print(f"{'':>12}{seconds:6.3f} s  {module}")
+
+    if output_path:
+        save_json_file(output_path, results)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the startup time of anonymize.py and the import time of each module.")
+    parser.add_argument("--commands", type=str, nargs="+", choices=list(STARTUP_COMMANDS.keys()), help="Commands to measure (default: all).")
+    parser.add_argument("--runs", type=int, default=5, help="Number of measured runs for each command.")
+    parser.add_argument("--top", type=int, default=10, help="Number of slowest modules printed for each command.")
+    parser.add_argument("--model", type=str, default=DEFAULT_NER_MODEL, help="Path of the spaCy model used by the 'text' command.")
+    parser.add_argument("--output", type=str, help="Path of a JSON file where to save the results.")
+    args = parser.parse_args()
+
+    results = benchmark_startup(args.commands, args.runs, args.top, args.model, args.output)
+    # Non-zero exit status when a budget is exceeded, so that regressions can be caught by scripts
+    sys.exit(int(any(r["budget_s"] is not None and r["wall_s"] > r["budget_s"] for r in results.values())))
+
+
+if __name__ == "__main__":
+    main()
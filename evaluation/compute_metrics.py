@@ -223,4 +223,20 @@ def compute_metrics(gold_docs: list[dict],
     return {
         **labels_dict,
         "ENT": labels_ent_dict["ENT"]
-    }
\ No newline at end of file
+    }
+
+
+def compute_metrics_delta(baseline: Dict[str, Dict[str, float]],
+                          candidate: Dict[str, Dict[str, float]]) -> Dict[str, Dict[str, float]]:
+    """
+    Compute the difference between the metrics of a candidate model and the ones of a baseline model, as returned by
+    compute_metrics, for each label and metric available in both of them (positive values mean the candidate is better).
+
+    :param baseline: metrics of the baseline model
+    :param candidate: metrics of the candidate model
+    :return: dict of metric deltas per label
+    """
+    return {
+        lbl: {metric: candidate[lbl][metric] - value for metric, value in baseline[lbl].items() if metric in candidate[lbl]}
+        for lbl in baseline if lbl in candidate
+    }
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import sys
+import json
+import argparse
+import subprocess
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from config import DEFAULT_NER_MODEL
+from utils import save_json_file
+
+# Run in a new interpreter for each mode, so that the peak memory of a mode does not include the previous ones
+_RUN = """
+import sys, time, json, hashlib, threading, functools
+sys.path.insert(0, {root!r})
+import anonymization_functions
+from evaluation.soak_memory import generate_texts
+from utils.memory_utils import MemoryGovernor, get_tree_rss_mb
+from utils.model_utils import load_model
+
+nlp = load_model({model!r})
+texts = [" ".join(generate_texts({sentences}, i * {sentences})) for i in range({texts})]
+anonymization_functions.MEMORY_GOVERNOR = {governor!r}
+anonymization_functions.MemoryGovernor = functools.partial(MemoryGovernor, high_watermark_mb={high_watermark!r})
+baseline = get_tree_rss_mb()
+
+peak, done = [baseline], threading.Event()
+def sample():
+    while not done.wait(0.05): peak[0] = max(peak[0], get_tree_rss_mb())
+threading.Thread(target=sample, daemon=True).start()
+
+start = time.perf_counter()
+anonymized, _ = anonymization_functions.anonymize_texts(texts, nlp=nlp, per_matching=0, multi_processing={multi_processing!r},
+                                                        auto_tuning=False)
+seconds = time.perf_counter() - start
+done.set()
+print(json.dumps({{"baseline_mb": baseline, "peak_mb": max(peak[0], get_tree_rss_mb()), "seconds": seconds,
+                  "texts_per_s": len(texts) / seconds, "output_sha256": hashlib.sha256(json.dumps(anonymized).encode()).hexdigest()}}))
+"""
+
+
+# ----------------------------
+#   Memory Pressure Benchmark
+# ----------------------------
+def measure_memory_pressure(n_texts: int = 200,
+                            sentences: int = 150,
+                            model_path: str = DEFAULT_NER_MODEL,
+                            high_watermark_mb: float = None,
+                            multi_processing: bool = False,
+                            output_path: str = None) -> dict[str, dict]:
+    """
+    Anonymizes a batch of long synthetic documents without and with the memory governor, measuring the peak resident
+    memory of the process and its workers and the throughput of each run.
+
+    :param n_texts: number of documents.
+    :param sentences: number of synthetic sentences of each document.
+    :param model_path: path of the spaCy model.
+    :param high_watermark_mb: high watermark of the governor. If None, halfway between the memory after loading the
+                              model and the peak memory of the run without governor.
+    :param multi_processing: whether to anonymize with multi-processing.
+    :param output_path: optional path of a JSON file where to save the results.
+    :return: the measures of each run.
+    """
+    results = {}
+    for mode, governor in (("off", False), ("governor", True)):
+        if governor and high_watermark_mb is None:
+            high_watermark_mb = (results["off"]["baseline_mb"] + results["off"]["peak_mb"]) / 2
+        code = _RUN.format(root=str(PROJECT_ROOT), model=model_path, texts=n_texts, sentences=sentences,
+                           governor=governor, high_watermark=high_watermark_mb, multi_processing=multi_processing)
+        process = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+        results[mode] = json.loads(process.stdout.strip().splitlines()[-1])
+        results[mode]["high_watermark_mb"] = high_watermark_mb if governor else None
+        print(f"{mode:>9}: peak {results[mode]['peak_mb']:7.1f} MB (after model load {results[mode]['baseline_mb']:7.1f} MB), "
+              f"{results[mode]['texts_per_s']:6.2f} texts/s" + (f", high watermark {high_watermark_mb:.1f} MB" if governor else ""))
+        if process.stderr.strip(): print(process.stderr.strip().splitlines()[-1])
+
+    print(f"Same output: {results['off']['output_sha256'] == results['governor']['output_sha256']}")
+    if output_path:
+        save_json_file(output_path, results)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure peak memory and throughput of a batch of long documents without and with the memory governor.")
+    parser.add_argument("--texts", type=int, default=200, help="Number of documents.")
+    parser.add_argument("--sentences", type=int, default=150, help="Number of synthetic sentences of each document.")
+    parser.add_argument("--model", type=str, default=DEFAULT_NER_MODEL, help="Path of the spaCy model.")
+    parser.add_argument("--high-watermark", type=float, help="High watermark in MB of the governor (default: halfway between the memory after loading the model and the peak without governor).")
+    parser.add_argument("--multi-processing", action="store_true", help="Anonymize with multi-processing.")
+    parser.add_argument("--output", type=str, help="Path of a JSON file where to save the results.")
+    args = parser.parse_args()
+
+    measure_memory_pressure(args.texts, args.sentences, args.model, args.high_watermark, args.multi_processing, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import random
+import argparse
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from anonymization_functions import anonymize_texts
+from config import DEFAULT_NER_MODEL
+from utils import save_json_file
+from utils import memory_utils
+from utils.memory_utils import get_rss_mb
+from utils.model_utils import load_model
+
+NAMES = ["Mario", "Giulia", "Luca", "Francesca", "Paolo", "Chiara", "Marco", "Sara"]
+CITIES = ["Roma", "Milano", "Napoli", "Torino", "Bologna", "Firenze", "Bari", "Genova"]
+
+
+def generate_texts(n: int, start: int = 0, seed: int = 0) -> list[str]:
+    """Short synthetic texts where most tokens are unique, so that each text adds new strings to the vocab."""
+    rng = random.Random(seed + start)
+    return [f"Il paziente {rng.choice(NAMES)}{i} di {rng.choice(CITIES)} ha il codice X{rng.getrandbits(40):x} "
+            f"e il numero 3{rng.randrange(10 ** 8):08d}, visita {i % 28 + 1}/{i % 12 + 1}."
+            for i in range(start, start + n)]
+
+
+# ----------------------------
+#   Memory Soak Test
+# ----------------------------
+def soak(n_texts: int = 1_000_000,
+         chunk_size: int = 10_000,
+         model_path: str = DEFAULT_NER_MODEL,
+         recycling: bool = True,
+         output_path: str = None) -> list[dict[str, float]]:
+    """
+    Anonymizes a stream of short synthetic texts in consecutive calls of anonymize_texts with the same loaded model,
+    as a long-running worker would, sampling the resident memory and the size of the string store after each call.
+
+    :param n_texts: total number of texts to anonymize.
+    :param chunk_size: number of texts passed to each anonymize_texts call.
+    :param model_path: path of the spaCy model.
+    :param recycling: whether to release the vocab strings with memory zones (VOCAB_RECYCLING).
+    :param output_path: optional path of a JSON file where to save the samples.
+    :return: the list of samples, one for each call.
+    """
+    memory_utils.VOCAB_RECYCLING = recycling
+    nlp = load_model(model_path)
+    samples = []
+    start_time = time.perf_counter()
+
+    for start in range(0, n_texts, chunk_size):
+        anonymize_texts(generate_texts(min(chunk_size, n_texts - start), start), nlp=nlp,
+                        per_matching=0, multi_processing=False, auto_tuning=False)
+        samples.append({"texts": min(start + chunk_size, n_texts), "seconds": time.perf_counter() - start_time,
+                        "rss_mb": get_rss_mb(), "strings": len(nlp.vocab.strings)})
+        print(f"{samples[-1]['texts']:>9} texts  RSS {samples[-1]['rss_mb']:8.1f} MB  strings {samples[-1]['strings']:>9}",
+              file=sys.stderr)
+
+    if output_path:
+        save_json_file(output_path, samples)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that memory stays flat while anonymizing a long stream of short texts.")
+    parser.add_argument("--texts", type=int, default=1_000_000, help="Total number of texts to anonymize.")
+    parser.add_argument("--chunk-size", type=int, default=10_000, help="Number of texts passed to each anonymize_texts call.")
+    parser.add_argument("--model", type=str, default=DEFAULT_NER_MODEL, help="Path of the spaCy model.")
+    parser.add_argument("--no-recycling", action="store_true", help="Disable the vocab recycling, to compare the memory growth.")
+    parser.add_argument("--output", type=str, help="Path of a JSON file where to save the samples.")
+    args = parser.parse_args()
+
+    samples = soak(args.texts, args.chunk_size, args.model, not args.no_recycling, args.output)
+
+    # The first call includes the lazy initializations of the model and of the rules
+    baseline = samples[min(1, len(samples) - 1)]
+    print(f"RSS growth after warm-up: {samples[-1]['rss_mb'] - baseline['rss_mb']:+.1f} MB, "
+          f"string store growth: {samples[-1]['strings'] - baseline['strings']:+d} strings")
+
+
+if __name__ == "__main__":
+    main()
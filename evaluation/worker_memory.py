@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import argparse
+from multiprocessing import Pool
+from pathlib import Path
+
+import psutil
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from config import DEFAULT_NER_MODEL, DEFAULT_EXTRA_PER_MATCHING_LEVEL
+from rules.rules import apply_rules
+from utils import save_json_file
+from utils.memory_utils import MB
+from utils.model_utils import load_model, load_worker_model, get_model_load_args
+from utils.preload_utils import configure_start_method, share_with_workers, SPAWN, FORKSERVER, FORK
+
+WARMUP_TEXT = "Il paziente Mario Rossi, nato a Roma il 12/03/1980, è seguito dal SerT di Milano (tel. 02 12345678)."
+
+_worker = {}
+
+
+def _init_worker(model_args: dict, per_matching: int) -> None:
+    _worker["nlp"] = load_worker_model(model_args)
+    # A first doc, so that the measured memory includes what inference allocates
+    apply_rules(_worker["nlp"](WARMUP_TEXT), per_matching)
+
+
+def _pid(_) -> int:
+    time.sleep(0.2)     # Keeps each worker busy, so that every worker gets a task
+    return os.getpid()
+
+
+def _memory_mb(process: psutil.Process) -> dict[str, float]:
+    info = process.memory_full_info()
+    return {"rss": info.rss / MB, "uss": info.uss / MB, "pss": getattr(info, "pss", info.uss) / MB}
+
+
+# ----------------------------
+#   Worker Memory Benchmark
+# ----------------------------
+def measure_worker_memory(methods: list[str] = None,
+                          workers: int = 2,
+                          model_path: str = DEFAULT_NER_MODEL,
+                          per_matching: int = DEFAULT_EXTRA_PER_MATCHING_LEVEL,
+                          output_path: str = None) -> dict[str, dict]:
+    """
+    Measures the memory of worker processes holding the model, for each start method. The proportional set size
+    (PSS) splits shared pages among the processes sharing them, so the sum of the PSS of all the processes is the
+    real footprint; the unique set size (USS) is the memory each worker does not share with any other process.
+
+    :param methods: start methods to measure, among "spawn", "forkserver" and "fork".
+    :param workers: number of worker processes.
+    :param model_path: path of the spaCy model.
+    :param per_matching: extra PER matching level of the rules compiled by the workers.
+    :param output_path: optional path of a JSON file where to save the results.
+    :return: for each start method, per-worker averages and the total footprint of all the processes in MB.
+    """
+    nlp = load_model(model_path)    # The main process holds the model, as anonymize.py does
+    model_args = get_model_load_args(nlp)
+    results = {}
+
+    # fork last, since sharing the model freezes the objects of this process
+    for method in sorted(methods or [SPAWN, FORKSERVER, FORK], key=[SPAWN, FORKSERVER, FORK].index):
+        if configure_start_method(method, model_args, per_matching) != method:
+            print(f"Start method '{method}' not available on this platform, skipped.", file=sys.stderr)
+            continue
+        share_with_workers(nlp, per_matching)
+
+        start = time.perf_counter()
+        with Pool(workers, initializer=_init_worker, initargs=(model_args, per_matching)) as pool:
+            pids = set(pool.map(_pid, range(workers * 4), chunksize=1))
+            startup = time.perf_counter() - start
+            worker_memory = [_memory_mb(psutil.Process(pid)) for pid in pids]
+            # This process, the workers and the process they were forked from (the forkserver, if used)
+            processes = {os.getpid()} | pids | {psutil.Process(pid).ppid() for pid in pids}
+            total_pss = sum(_memory_mb(psutil.Process(pid))["pss"] for pid in processes)
+
+        results[method] = {"workers": len(pids),
+                           "startup_s": startup,
+                           **{f"worker_{key}_mb": sum(m[key] for m in worker_memory) / len(worker_memory)
+                              for key in ("rss", "uss", "pss")},
+                           "total_pss_mb": total_pss}
+        print(f"{method:>10}: startup {startup:6.1f} s, per worker RSS {results[method]['worker_rss_mb']:7.1f} MB, "
+              f"USS {results[method]['worker_uss_mb']:7.1f} MB, PSS {results[method]['worker_pss_mb']:7.1f} MB, "
+              f"total PSS {total_pss:7.1f} MB")
+
+    if output_path:
+        save_json_file(output_path, results)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the memory of model-holding worker processes for each start method.")
+    parser.add_argument("--methods", type=str, nargs="+", choices=[SPAWN, FORKSERVER, FORK], help="Start methods to measure (default: all the available ones).")
+    parser.add_argument("--workers", type=int, default=2, help="Number of worker processes.")
+    parser.add_argument("--model", type=str, default=DEFAULT_NER_MODEL, help="Path of the spaCy model.")
+    parser.add_argument("--per-matching", type=int, default=DEFAULT_EXTRA_PER_MATCHING_LEVEL, help="Extra PER matching level of the rules compiled by the workers.")
+    parser.add_argument("--output", type=str, help="Path of a JSON file where to save the results.")
+    args = parser.parse_args()
+
+    measure_worker_memory(args.methods, args.workers, args.model, args.per_matching, args.output)
+
+
+if __name__ == "__main__":
+    main()
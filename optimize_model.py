@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import shutil
+import argparse
+
+from anonymization_functions import anonymize_texts
+from config import DEFAULT_NER_MODEL, DEFAULT_ENTITIES, ONNX_TRANSFORMER_DIR, SNAPSHOT_TRANSFORMER_DIR
+from evaluation.compute_metrics import compute_metrics_delta
+from utils import read_json_file, save_json_file
+from utils.anonymization_utils import read_many_files
+from utils.model_utils import load_model, QUANTIZATION_META_KEY, DYNAMIC_INT8, PYTORCH_BACKEND, ONNX_BACKEND
+from utils.path_utils import get_resource_path
+
+
+# ----------------------------
+#   Quantization Lambda
+# ----------------------------
+def quantize(model_path: str, output_path: str, eval_inputs: list[str] = None) -> str:
+    """
+    Produces a variant of the given model whose transformer linear layers are quantized to int8 with dynamic
+    quantization when the model is loaded through utils.model_utils.load_model (and therefore through
+    DEFAULT_NER_MODEL). Weights on disk are left in float32, so that the variant stays loadable by plain spaCy.
+    If annotated inputs are provided, an accuracy and speed comparison with the original model is saved in the
+    variant folder as quantization_report.json.
+
+    :param model_path: path of the spaCy model to quantize.
+    :param output_path: path of the folder where to save the quantized variant.
+    :param eval_inputs: optional list of annotated JSON files and/or folders used to compare the two models.
+    :return: the path of the quantized variant.
+    """
+    model_path = get_resource_path(model_path)
+    if os.path.exists(output_path):
+        raise ValueError(f"Output path '{output_path}' already exists.")
+
+    shutil.copytree(model_path, output_path)
+    meta_path = os.path.join(output_path, "meta.json")
+    meta = read_json_file(meta_path)
+    meta[QUANTIZATION_META_KEY] = DYNAMIC_INT8
+    save_json_file(meta_path, meta)
+    print(f"Quantized model saved to '{output_path}'.")
+
+    if eval_inputs:
+        report = compare_models(model_path, output_path, eval_inputs)
+        save_json_file(os.path.join(output_path, "quantization_report.json"), report)
+        print(f"Speedup: {report['speedup']:.2f}x, "
+              f"micro F1 delta: {report['delta']['micro']['f1']:+.4f}, ENT F1 delta: {report['delta']['ENT']['f1']:+.4f}")
+
+    return output_path
+
+
+# ----------------------------
+#   ONNX Export Lambda
+# ----------------------------
+def export_onnx(model_path: str, output_dir: str = None, int8: bool = False, eval_inputs: list[str] = None) -> str:
+    """
+    Exports the transformer component of the given model to ONNX, so that it can be run with ONNX Runtime by
+    loading the model with the "onnx" backend. By default the exported transformer is saved inside the model folder,
+    where the "onnx" backend looks for it.
+
+    :param model_path: path of the spaCy model whose transformer is exported.
+    :param output_dir: folder where to save the exported transformer. If omitted, it is saved inside the model folder.
+    :param int8: whether to also apply ONNX Runtime dynamic int8 quantization to the exported graph.
+    :param eval_inputs: optional list of annotated JSON files and/or folders used to compare the two backends.
+    :return: the path of the exported transformer folder.
+    """
+    from utils.onnx_utils import export_transformer_to_onnx, ONNX_MODEL_FILE
+
+    model_path = get_resource_path(model_path)
+    output_dir = output_dir or os.path.join(model_path, ONNX_TRANSFORMER_DIR)
+    export_transformer_to_onnx(load_model(model_path, backend=PYTORCH_BACKEND), output_dir)
+
+    if int8:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        onnx_path = os.path.join(output_dir, ONNX_MODEL_FILE)
+        quantize_dynamic(onnx_path, onnx_path, weight_type=QuantType.QInt8)
+    print(f"Transformer exported to ONNX in '{output_dir}'.")
+
+    if eval_inputs:
+        report = compare_models(model_path, model_path, eval_inputs, candidate_backend=ONNX_BACKEND)
+        save_json_file(os.path.join(output_dir, "onnx_report.json"), report)
+        print(f"Speedup: {report['speedup']:.2f}x, "
+              f"micro F1 delta: {report['delta']['micro']['f1']:+.4f}, ENT F1 delta: {report['delta']['ENT']['f1']:+.4f}")
+
+    return output_dir
+
+
+# ----------------------------
+#   Snapshot Lambda
+# ----------------------------
+def snapshot(model_path: str, output_dir: str = None) -> str:
+    """
+    Saves a snapshot of the transformer weights of the given model in a memory-mappable safetensors file, which
+    load_model uses instead of deserializing the transformer, for a faster cold start. By default the snapshot is
+    saved inside the model folder, where load_model looks for it. It must be re-created whenever the model changes
+    (outdated snapshots are detected and ignored).
+
+    :param model_path: path of the spaCy model.
+    :param output_dir: folder where to save the snapshot. If omitted, it is saved inside the model folder.
+    :return: the path of the snapshot folder.
+    """
+    import spacy
+    from utils.snapshot_utils import save_transformer_snapshot, load_snapshot_model
+
+    model_path = get_resource_path(model_path)
+    output_dir = output_dir or os.path.join(model_path, SNAPSHOT_TRANSFORMER_DIR)
+    nlp = spacy.load(model_path)
+    save_transformer_snapshot(nlp, model_path, output_dir)
+
+    # The snapshot must reproduce the predictions of the original model
+    text = "Il paziente Mario Rossi, nato a Roma il 12/03/1980, è seguito dal SerT di Milano (tel. 02 12345678)."
+    restored = load_snapshot_model(model_path, output_dir)
+    if [(e.start_char, e.end_char, e.label_) for e in nlp(text).ents] != [(e.start_char, e.end_char, e.label_) for e in restored(text).ents]:
+        raise RuntimeError(f"The snapshot in '{output_dir}' does not reproduce the predictions of the model.")
+    print(f"Model snapshot saved to '{output_dir}'.")
+    return output_dir
+
+
+def compare_models(baseline_path: str, candidate_path: str, eval_inputs: list[str],
+                   candidate_backend: str = PYTORCH_BACKEND) -> dict:
+    """Runs both models on the annotated inputs and returns their metrics, their deltas and the measured speedup."""
+    texts, metadata, personal_data = read_many_files(eval_inputs, extensions=(".json",))
+    report = {"texts": len(texts)}
+
+    for name, path, backend in (("baseline", baseline_path, PYTORCH_BACKEND), ("candidate", candidate_path, candidate_backend)):
+        nlp = load_model(path, backend=backend)
+        list(nlp.pipe(texts[:8]))  # Warm-up, so that lazy initializations are not measured
+        start_time = time.perf_counter()
+        _, metrics = anonymize_texts(texts, nlp=nlp, entities=DEFAULT_ENTITIES, personal_data=personal_data,
+                                     meta_data=metadata, auto_tuning=False)
+        report[name] = {"seconds": time.perf_counter() - start_time, "metrics": metrics}
+
+    report["speedup"] = report["baseline"]["seconds"] / report["candidate"]["seconds"]
+    report["delta"] = compute_metrics_delta(report["baseline"]["metrics"], report["candidate"]["metrics"])
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Produce optimized variants of the anonymization model.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    quantize_parser = subparsers.add_parser("quantize", help="Produce a variant with dynamic int8 quantization of the transformer linear layers, for CPU inference.")
+    quantize_parser.add_argument("output", help="Folder where to save the quantized variant.")
+    quantize_parser.add_argument("--model", type=str, default=DEFAULT_NER_MODEL, help="Path of the spaCy model to quantize.")
+    quantize_parser.add_argument("--eval", type=str, nargs="+", help="Annotated JSON files and/or folders used to report the accuracy and speed delta with respect to the original model.")
+
+    onnx_parser = subparsers.add_parser("onnx", help="Export the transformer component to ONNX, to be run with ONNX Runtime on CPU.")
+    onnx_parser.add_argument("--output", type=str, help=f"Folder where to save the exported transformer (default: '{ONNX_TRANSFORMER_DIR}' inside the model folder, where the onnx backend looks for it).")
+    onnx_parser.add_argument("--model", type=str, default=DEFAULT_NER_MODEL, help="Path of the spaCy model whose transformer is exported.")
+    onnx_parser.add_argument("--int8", action="store_true", help="Also apply dynamic int8 quantization to the exported graph.")
+    onnx_parser.add_argument("--eval", type=str, nargs="+", help="Annotated JSON files and/or folders used to report the accuracy and speed delta with respect to the PyTorch backend.")
+
+    snapshot_parser = subparsers.add_parser("snapshot", help="Save the transformer weights in a memory-mappable snapshot, loaded instead of the spaCy serialization for a faster cold start.")
+    snapshot_parser.add_argument("--model", type=str, default=DEFAULT_NER_MODEL, help="Path of the spaCy model.")
+    snapshot_parser.add_argument("--output", type=str, help=f"Folder where to save the snapshot (default: '{SNAPSHOT_TRANSFORMER_DIR}' inside the model folder, where load_model looks for it).")
+
+    args = parser.parse_args()
+
+    if args.command == "quantize":
+        quantize(args.model, args.output, args.eval)
+    elif args.command == "onnx":
+        export_onnx(args.model, args.output, args.int8, args.eval)
+    elif args.command == "snapshot":
+        snapshot(args.model, args.output)
+
+
+if __name__ == "__main__":
+    main()
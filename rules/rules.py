@@ -1,5 +1,8 @@
 import os
 import sys
+import time
+from contextvars import ContextVar
+from functools import lru_cache
 from pathlib import Path
 import regex as re
 
@@ -11,6 +14,7 @@ from config import PERSONAL_DATA_FORMAT
 
 from rules.prepare_dictionaries import load_wordlist
 from rules.merge_entities import merged_entity_spans
+from utils.timing_utils import stage, RULES_STAGE, MERGE_STAGE
 
 # Ensures project root is on sys.path
 PROJECT_ROOT = Path(sys._MEIPASS) if hasattr(sys, "_MEIPASS") else Path(__file__).resolve().parents[1]
@@ -35,6 +39,8 @@ url_tag = "URL"
 prov_tag = "PROV"
 code_tag = "CODE"
 
+_rules_deadline = ContextVar("rules_deadline", default=None)    # Monotonic time by which apply_rules must complete
+
 common_ambiguous_names = "[Mm]arco|[Ll]uca|[Ff]rancesco|[Pp]aolo|[Pp]aolino|Pasquale|Omero|[Ll]aura|Linda|Aurora|[Dd]ante|[Dd]iana|[Mm]aria|[Ll]ucia|Bruno|Viola|Angelo|Angela|[Aa]ugusto|[Ss]ilvia|[Ss]ilvio|[Ss]andra|Roman[oa]|Diletta|Fede|[Ll]idia|Gloria|[Pp]iero|[Rr]enat[oa]|Franco|[Ll]eo|[Mm]attia|Marino|Giada|[Rr]occo|[Vv]anessa|[Ss]auro|[Aa]lessia|Violetta|Massimo|[Cc]laudia|[Vv]eronica|[Vv]ittorio|Vittoria|[Pp]enelope|[Pp]atrizi[oa]|[Gg]raziano|Grazia|Cristian[oa]|[Ff]ilippo|[Ff]abiano|[Mm]oira|[Rr]affaella|[Ee]lisa|[Ll]isa|[Ll]azzaro|[Gg]iacinto|Salvatore|Stella|Fausto|[Tt]iziano|[Mm]immo|Italo|Guido|[Ii]do|[Mm]aia|Luna|[Cc]iro|[Cc]aio|[Aa]melia|[Mm]elissa|Gustavo"
 
 email_re = r"[A-Za-z0-9._%+-]+@+[A-Za-z0-9.-]+\.[A-Za-z]{2,}"
@@ -117,48 +123,63 @@ def _collect_entity_spans_from_regex(doc: Doc, pattern: str | re.Pattern[str], t
 
         return f"[{tag}]"
 
-    re.sub(pattern, replacer, text_nfc, flags=flags)
+    deadline = _rules_deadline.get()
+    if deadline is None:
+        re.sub(pattern, replacer, text_nfc, flags=flags)
+    else:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0: raise TimeoutError("Time budget of the rules exceeded.")
+        re.sub(pattern, replacer, text_nfc, flags=flags, timeout=remaining)
 
     return new_entities
 
-def _mask_not_ambiguous_entities(doc: Doc, dictionary: List[str], tag: str, flags = 0) -> list[Span]:
+def _not_ambiguous_pattern(dictionary: List[str]) -> str:
     """
-    Finds exact names from the given dictionary (case-insensitive, preserves accents).
+    Pattern of exact names from the given dictionary (to be used case-insensitive, preserves accents).
     Longer names are placed first to avoid partial matches (e.g. 'Marco Antonio' before 'Marco').
     It is assumed that the dictionary is sorted by length descending.
     """
-    if not dictionary:
-        return []
-
-    pattern = r"\b(?:" + "|".join(re.escape(n) for n in dictionary) + r")\b"
-    return _collect_entity_spans_from_regex(doc, pattern, tag, flags)
+    return r"\b(?:" + "|".join(re.escape(n) for n in dictionary) + r")\b"
 
 
-def _mask_ambiguous_entities(doc: Doc, dictionary: List[str], tag: str, flags = 0) -> list[Span]:
-    if not dictionary:
-        return []
-
+def _ambiguous_pattern(dictionary: List[str]) -> str:
     capitalized_dic = [t.capitalize() for t in dictionary if t]
     capitalized_dic.extend([t.upper() for t in dictionary if t])
-    pattern = ( # ensure not at start of sentence or after punctuation or paragraph break
+    return ( # ensure not at start of sentence or after punctuation or paragraph break
             r"(?<!^)"
             r"(?<!\n[\s\t]*\n[\s\t\n]*)"
             r"(?<![-\.!?:;·…»«>\n][\s\t\n]*)"
             r"\b(?:" + "|".join(re.escape(t) for t in capitalized_dic) + r")\b"
     )
-    return _collect_entity_spans_from_regex(doc, pattern, tag, flags)
 
 
-def _mask_province(doc: Doc, path: str, ambiguous: bool) -> list[Span]:
-    """Mask province names by checking if they appear in capitalized form. If ambiguous, also check they are sorrounded by parentheses."""
-    tokens = load_wordlist(path)
-    if not tokens:
-        return []
-
+def _province_pattern(tokens: List[str], ambiguous: bool) -> str:
+    """Province names in capitalized form. If ambiguous, they must also be sorrounded by parentheses."""
     capitalized_tokens = [t.upper() for t in tokens if t]
-    pattern = r"\(\s*(" + "|".join(re.escape(t) for t in capitalized_tokens) + r")\s*\)" if ambiguous \
+    return r"\(\s*(" + "|".join(re.escape(t) for t in capitalized_tokens) + r")\s*\)" if ambiguous \
         else r"\b(" + "|".join(re.escape(t) for t in capitalized_tokens) + r")\b"
-    return _collect_entity_spans_from_regex(doc, pattern, prov_tag)
+
+
+@lru_cache(maxsize=None)
+def _get_dictionary_regex(file: str, ambiguous: bool, province: bool = False) -> re.Pattern[str] | None:
+    """
+    Compiled regex matching the entries of a dictionary file, or None if the dictionary is empty.
+    Patterns of the largest dictionaries take seconds to build and tens of seconds to compile, so they are built once
+    per process (and shared with the worker processes forked after preload_rules).
+    """
+    dictionary = load_wordlist(file)
+    if not dictionary:
+        return None
+    if province:
+        return re.compile(_province_pattern(dictionary, ambiguous))
+    return re.compile(_ambiguous_pattern(dictionary)) if ambiguous \
+        else re.compile(_not_ambiguous_pattern(dictionary), re.IGNORECASE)
+
+
+def _mask_province(doc: Doc, path: str, ambiguous: bool) -> list[Span]:
+    """Mask province names by checking if they appear in capitalized form. If ambiguous, also check they are sorrounded by parentheses."""
+    pattern = _get_dictionary_regex(path, ambiguous, province=True)
+    return _collect_entity_spans_from_regex(doc, pattern, prov_tag) if pattern else []
 
 def _mask_ambiguous_common_names(doc: Doc) -> list[Span]:
     """
@@ -172,26 +193,43 @@ def _mask_entities_in_text(doc: Doc, file: str, tag: str, ambiguous: bool = Fals
     """
     Mask entities in the text using both not ambiguous and ambiguous masking.
     """
-    word_list = load_wordlist(file)
-    masked_ents = _mask_ambiguous_entities(doc, word_list, tag) if ambiguous \
-        else _mask_not_ambiguous_entities(doc, word_list, tag, re.IGNORECASE)
+    pattern = _get_dictionary_regex(file, ambiguous)
+    return _collect_entity_spans_from_regex(doc, pattern, tag) if pattern else []
 
-    return masked_ents
 
-
-def _mask_personal_data(doc: Doc, personal_data: dict[str, str]) -> list[Span]:
-    """Mask personal data in the text using the provided dictionary."""
-    new_entities = []
+def _get_personal_data_patterns(personal_data: dict[str, str]) -> list[tuple[str, str, int]]:
+    """Returns the (pattern, label, flags) regexes matching the values of the provided personal data."""
+    patterns = []
     for key, label in PERSONAL_DATA_FORMAT.items():
         if key in personal_data:
             pattern = r"\b" + re.escape(personal_data[key]) + r"\b" if label != "PATIENT" else \
                       r"\b(?:" + re.escape(personal_data[key]) + "|" + re.escape(personal_data[key])[0] + r"\.)\b"
             flag = re.IGNORECASE if label != "PROV" else 0
-            new_entities += _collect_entity_spans_from_regex(doc, pattern, label, flag)
+            patterns.append((pattern, label, flag))
+
+    return patterns
+
+
+def _mask_personal_data(doc: Doc, personal_data: dict[str, str]) -> list[Span]:
+    """Mask personal data in the text using the provided dictionary."""
+    new_entities = []
+    for pattern, label, flag in _get_personal_data_patterns(personal_data):
+        new_entities += _collect_entity_spans_from_regex(doc, pattern, label, flag)
 
     return new_entities
 
 
+def contains_personal_data(text: str, personal_data: dict[str, str] | None) -> bool:
+    """Whether the text contains any value (or patient initial) of the provided personal data."""
+    if not personal_data: return False
+    return any(re.search(pattern, text, flag) for pattern, _, flag in _get_personal_data_patterns(personal_data))
+
+
+def identifies_patient(personal_data: dict[str, str] | None) -> bool:
+    """Whether the personal data allow to recognize the patient, so that PATIENT entities are changed to PER."""
+    return bool(personal_data) and "nome" in personal_data and "cognome" in personal_data
+
+
 def _change_patient_to_per(doc: Doc) -> None:
     """Change all PATIENT entities to PER in the given Doc."""
     new_ents = []
@@ -206,21 +244,39 @@ def _change_patient_to_per(doc: Doc) -> None:
     doc.ents = new_ents
 
 
-def apply_rules(doc: Doc | str, per_matching:int = 0, personal_data:dict[str, str] = None) -> Doc:
+def apply_rules(doc: Doc | str, per_matching:int = 0, personal_data:dict[str, str] = None, timeout: float = None) -> Doc:
     """
     Mask various entities in the text using dictionaries and regex patterns.
 
     :param doc: The spaCy Doc object or raw text to process.
     :param per_matching: Whether to anonymize PER and PATIENT entities in combination with dictionaries
     :param personal_data: A dictionary of personal data to make specific masking
+    :param timeout: Time budget in seconds for all the regex matching on the doc. If exceeded, a TimeoutError is raised.
     """
+    token = _rules_deadline.set(time.monotonic() + timeout if timeout else None)
+    try:
+        with stage(RULES_STAGE):
+            return _apply_rules(doc, per_matching, personal_data)
+    finally:
+        _rules_deadline.reset(token)
+
+
+def preload_rules(per_matching: int = 0) -> None:
+    """
+    Builds and compiles the dictionary regexes used with the given extra PER matching level, so that they are ready
+    before the first doc and shared by the worker processes forked afterwards.
+    """
+    _apply_rules("", per_matching)
+
+
+def _apply_rules(doc: Doc | str, per_matching:int = 0, personal_data:dict[str, str] = None) -> Doc:
     if isinstance(doc, str):
         doc = Doc(spacy.blank("it").vocab, words=doc.split())
 
     new_entities = []
 
     if personal_data:
-        if "nome" in personal_data and "cognome" in personal_data:
+        if identifies_patient(personal_data):
             _change_patient_to_per(doc) # Patient can be safely recognized though personal data
         new_entities += _mask_personal_data(doc, personal_data)
 
@@ -249,4 +305,5 @@ def apply_rules(doc: Doc | str, per_matching:int = 0, personal_data:dict[str, st
     new_entities += _mask_province(doc, _get_file_path("province", False), False)
     new_entities += _mask_province(doc, _get_file_path("province", True), True)
 
-    return merged_entity_spans(new_entities, doc)
+    with stage(MERGE_STAGE):
+        return merged_entity_spans(new_entities, doc)
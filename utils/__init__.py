@@ -1,3 +1,12 @@
 from .json_utils import read_json_file, save_json_file, to_spacy_format, to_readable_format, append_json_data
-from .docbin_utils import load_data_for_spacy, to_docbin_format, load_docbin, combine_docbins
-from .random_utils import train_test_split
\ No newline at end of file
+from .random_utils import train_test_split
+
+_DOCBIN_EXPORTS = {"load_data_for_spacy", "to_docbin_format", "load_docbin", "combine_docbins"}
+
+
+def __getattr__(name):
+    # docbin_utils imports spaCy, so it is only imported when one of its functions is used
+    if name in _DOCBIN_EXPORTS:
+        from . import docbin_utils
+        return getattr(docbin_utils, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
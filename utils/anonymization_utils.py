@@ -3,13 +3,13 @@ import os
 from typing import Iterable
 
 from spacy.tokens import Doc
-from docx import Document
 
 from config import PATIENT_DATA_FIELDS, SINGLE_TEXT_FIELDS, DEFAULT_OUTPUTS_IN_SINGLE_FILE, SINGLE_ENTITY_FIELDS, \
     PERSONAL_DATA_FIELDS
 from utils.json_utils import read_json_file, save_json_file
 from utils.path_utils import get_file_name_from_anagrafica
 from utils.pdf_utils import extract_structured_text, read_pdf_from_s3
+from utils.timing_utils import timed_stage, READ_STAGE, WRITE_STAGE
 
 TEXT = SINGLE_ENTITY_FIELDS[0]
 START = SINGLE_ENTITY_FIELDS[1]
@@ -24,17 +24,37 @@ def anonymize_doc(doc: Doc, labels_to_anonymize: Iterable[str]=None) -> str:
     :param labels_to_anonymize: Iterable of entity labels to anonymize (e.g. {"PER", "LOC"})
                                 If None, anonymizes ALL entities.
     """
-    labels_to_anonymize = set(ent.label_ for ent in doc.ents) if labels_to_anonymize is None else set(labels_to_anonymize)
-    text = doc.text
+    return anonymize_spans(doc.text, doc_to_spans(doc), labels_to_anonymize)
+
+def doc_to_spans(doc: Doc) -> list[tuple[int, int, str]]:
+    """Returns the entities of the given Doc as (start_char, end_char, label) tuples."""
+    return [(ent.start_char, ent.end_char, ent.label_) for ent in doc.ents]
+
+def anonymize_spans(text: str, spans: Iterable[tuple[int, int, str]], labels_to_anonymize: Iterable[str]=None) -> str:
+    """
+    Returns anonymized text where the given (start_char, end_char, label) spans with selected labels are replaced
+    by [LABEL]. Spans are expected not to overlap.
+
+    :param text: original text
+    :param spans: entity spans found in the text
+    :param labels_to_anonymize: Iterable of entity labels to anonymize (e.g. {"PER", "LOC"})
+                                If None, anonymizes ALL entities.
+    """
+    spans = list(spans)
+    labels_to_anonymize = set(label for _, _, label in spans) if labels_to_anonymize is None else set(labels_to_anonymize)
 
     # collect only entities whose label is in the allowed set
-    offsets = [(ent.start_char, ent.end_char, ent.label_) for ent in doc.ents if ent.label_ in labels_to_anonymize]
-    offsets.sort(reverse=True) # Replace from end to beginning to preserve offsets
+    offsets = sorted((start, end, label) for start, end, label in spans if label in labels_to_anonymize)
 
+    # Join the text between entities with the placeholders, in a single pass over the text
+    pieces, position = [], 0
     for start, end, label in offsets:
-        text = text[:start] + f"[{label}]" + text[end:]
+        pieces.append(text[position:start])
+        pieces.append(f"[{label}]")
+        position = end
+    pieces.append(text[position:])
 
-    return text
+    return "".join(pieces)
 
 def get_entity_spans_from_metadata(original_text:str, metadata_entities: list[dict]) -> Iterable[str]:
     """Extracts entity spans from metadata entity list."""
@@ -77,12 +97,29 @@ def save_metrics(metrics: dict, output_path=None, output_dir=None, original_file
     save_json_file(out_path, metrics)
     return out_path
 
+def save_pipeline_metrics(report: dict, output_path=None, output_dir=None, original_filename=None) -> str:
+    """Saves the report of the pipeline stage timings (see utils.timing_utils) to a JSON file next to the metrics and
+    returns the output path."""
+    if output_path:
+        out_path = output_path
+    elif output_dir and original_filename:
+        base_name = os.path.splitext(os.path.basename(original_filename))[0]
+        out_path = os.path.join(output_dir, f"{base_name}_pipeline_metrics.json")
+    else:
+        raise ValueError("Must specify either output_path or output_dir")
+
+    save_json_file(out_path, report)
+    return out_path
+
+@timed_stage(WRITE_STAGE)
 def save_many_texts(texts: list[str],
                     output_dir: str,
                     original_filename: str = None,
                     single_file: bool=DEFAULT_OUTPUTS_IN_SINGLE_FILE,
                     metadata:list[dict] = None,
-                    personal_data:list[dict] = None) -> str:
+                    personal_data:list[dict] = None,
+                    first_index: int = 0,
+                    written_files: list[str] = None) -> str:
     """Saves multiple anonymized documents in the specified directory.
     If the single_file flag is True, texts related to the same patient are saved in a single json file,
     otherwise as separate .txt files.
@@ -94,20 +131,23 @@ def save_many_texts(texts: list[str],
     :param single_file: if True, saves all texts of the same patient in a single JSON file; if False, saves each text in a separate .txt file
     :param metadata: optional list of metadata dictionaries corresponding to each text (used only if single_file is True)
     :param personal_data: optional list of personal data dictionaries corresponding to each text (used only if single_file is True)
+    :param first_index: index of the first text, used in the names of the output files, so that the outputs of
+                        consecutive calls on the same directory do not collide
+    :param written_files: optional list to which the paths of the written files are appended
     :returns: the path to the saved file directory
     """
     os.makedirs(output_dir, exist_ok=True)
 
     if personal_data is not None:
-        base_names = [entry.get(PERSONAL_DATA_FIELDS[8], f"dict_{json.dumps(entry, sort_keys=True)}") if entry else f"text_{i+1}"
+        base_names = [entry.get(PERSONAL_DATA_FIELDS[8], f"dict_{json.dumps(entry, sort_keys=True)}") if entry else f"text_{first_index+i+1}"
                       for i, entry in enumerate(personal_data)]
     else:
-        base_names = [f"text_{i+1}" for i in range(len(texts))]
+        base_names = [f"text_{first_index+i+1}" for i in range(len(texts))]
+    if written_files is None: written_files = []
 
     # Multiple texts → multiple files
     if not single_file:
-        written_files = []
-        for i, (text, base_name) in enumerate(zip(texts, base_names)):
+        for i, (text, base_name) in enumerate(zip(texts, base_names), start=first_index):
             out_path = os.path.join(output_dir, f"{base_name}_anonymized_{i+1}.txt")
             save_anonymized_text(text, output_path=out_path)
             written_files.append(out_path)
@@ -126,7 +166,7 @@ def save_many_texts(texts: list[str],
         for base_name in set(base_names):
             indeces = [i for i in range(len(personal_data))
                        if (personal_data[i].get(PERSONAL_DATA_FIELDS[8], f"dict_{json.dumps(personal_data[i], sort_keys=True)}")
-                           if personal_data[i] else f"text_{i+1}") == base_name]
+                           if personal_data[i] else f"text_{first_index+i+1}") == base_name]
             patient_data = {
                     PERSONAL_DATA_FIELDS[8]: base_name if isinstance(base_name, int) else None,
                     PATIENT_DATA_FIELDS[1]: [text_data[i] for i in indeces]
@@ -139,6 +179,7 @@ def save_many_texts(texts: list[str],
                 else get_file_name_from_anagrafica({}, add_random_suffix=True)
             out_paths.append(os.path.join(output_dir, file_name))
             save_json_file(out_paths[-1], patient_data)
+            written_files.append(out_paths[-1])
         return output_dir
 
     else:
@@ -151,9 +192,11 @@ def save_many_texts(texts: list[str],
             PATIENT_DATA_FIELDS[1]: text_data
         }
         save_json_file(out_path, patient_data)
+        written_files.append(out_path)
         return output_dir
 
 
+@timed_stage(READ_STAGE)
 def read_file(file_path) -> tuple[list[str], list[dict[str,str]]|None, dict[str,str]|None]:
     """Reads a file and returns its text content in form of a list strings combined with optional list of dictionaries
     of metadata and a dictionary of personal data."""
@@ -165,32 +208,58 @@ def read_file(file_path) -> tuple[list[str], list[dict[str,str]]|None, dict[str,
         with open(file_path, "r", encoding="utf-8") as f:
             texts = [f.read()]
     elif ext == ".docx":
+        from docx import Document
         doc = Document(file_path)
         texts = ["\n".join([para.text for para in doc.paragraphs])]
     elif ext == ".pdf":
         texts = [extract_structured_text(file_path)]
     elif ext == ".json":
         data = read_json_file(file_path)
-        texts = []
-        for text in data[PATIENT_DATA_FIELDS[1]]:
-            if SINGLE_TEXT_FIELDS[2] in text:
-                texts.append(text[SINGLE_TEXT_FIELDS[2]])
-            elif SINGLE_TEXT_FIELDS[5] in text:
-                texts.append(extract_structured_text(read_pdf_from_s3(text[SINGLE_TEXT_FIELDS[5]])))
-            else:
-                raise ValueError(f"Each entry in the '{PATIENT_DATA_FIELDS[1]}' list must contain either a '{SINGLE_TEXT_FIELDS[2]}' field with the text content or a '{SINGLE_TEXT_FIELDS[5]}' field with the path to a PDF file containing the text.")
-
-        for text in data[PATIENT_DATA_FIELDS[1]]:
-            meta = {field: text.get(field, None) for field in SINGLE_TEXT_FIELDS
-                    if field not in {SINGLE_TEXT_FIELDS[2], SINGLE_TEXT_FIELDS[5]}}
-            metadata.append(meta)
-
+        texts = read_text_entries(data[PATIENT_DATA_FIELDS[1]])
+        metadata = [text_entry_metadata(text) for text in data[PATIENT_DATA_FIELDS[1]]]
         if PATIENT_DATA_FIELDS[0] in data: personal_data = data[PATIENT_DATA_FIELDS[0]]
     else:
         raise ValueError("Unsupported file type.")
 
     return texts, metadata, personal_data
 
+def read_text_entries(entries: list[dict]) -> list[str]:
+    """Returns the texts of the given entries of the 'testi' list of a patient JSON, extracting the text of the PDF
+    files referenced on S3."""
+    texts = []
+    for text in entries:
+        if SINGLE_TEXT_FIELDS[2] in text:
+            texts.append(text[SINGLE_TEXT_FIELDS[2]])
+        elif SINGLE_TEXT_FIELDS[5] in text:
+            texts.append(extract_structured_text(read_pdf_from_s3(text[SINGLE_TEXT_FIELDS[5]])))
+        else:
+            raise ValueError(f"Each entry in the '{PATIENT_DATA_FIELDS[1]}' list must contain either a '{SINGLE_TEXT_FIELDS[2]}' field with the text content or a '{SINGLE_TEXT_FIELDS[5]}' field with the path to a PDF file containing the text.")
+    return texts
+
+def text_entry_metadata(entry: dict) -> dict:
+    """Returns the metadata of an entry of the 'testi' list of a patient JSON, i.e. its fields except the text."""
+    return {field: entry.get(field, None) for field in SINGLE_TEXT_FIELDS
+            if field not in {SINGLE_TEXT_FIELDS[2], SINGLE_TEXT_FIELDS[5]}}
+
+def read_many_files(paths: list[str], extensions: tuple[str, ...] = (".txt", ".docx", ".pdf", ".json")) \
+        -> tuple[list[str], list[dict[str,str]|None], list[dict[str,str]|None]]:
+    """Reads all the given files and the files with the given extensions contained in the given folders, returning
+    the concatenated lists of texts, metadata and personal data (one element per text)."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, f) for f in sorted(os.listdir(path)) if f.lower().endswith(extensions))
+        else:
+            files.append(path)
+
+    texts, metadata, personal_data = [], [], []
+    for file in files:
+        t, m, pd = read_file(file)
+        texts.extend(t)
+        metadata.extend(m if m else [None] * len(t))
+        personal_data.extend([pd] * len(t))
+    return texts, metadata, personal_data
+
 def replace_patient_labels(data):
     """Replaces 'PATIENT' labels with 'PER'"""
     for item in data:
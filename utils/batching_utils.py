@@ -0,0 +1,147 @@
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+from spacy import Language
+
+from anonymization_functions import anonymize_texts
+from config import MICRO_BATCH_SIZE, MICRO_BATCH_WAIT_MS, MAX_PENDING_REQUESTS, MEMORY_GOVERNOR
+from utils.memory_utils import MemoryGovernor
+
+_STOP = object()
+
+
+class MicroBatcher:
+    """
+    Collects anonymization requests submitted concurrently from several threads into shared batches, processed by a
+    single worker thread with anonymize_texts, so that batching amortizes the inference cost across requests.
+    A batch is started as soon as max_batch_size texts are waiting, or max_wait_ms after its first text arrived.
+    """
+
+    def __init__(self,
+                 nlp: Language,
+                 max_batch_size: int = MICRO_BATCH_SIZE,
+                 max_wait_ms: float = MICRO_BATCH_WAIT_MS,
+                 max_pending: int = MAX_PENDING_REQUESTS,
+                 memory_governor: bool = MEMORY_GOVERNOR,
+                 **anonymize_kwargs):
+        """
+        :param nlp: loaded spaCy Language model.
+        :param max_batch_size: maximum number of texts in a batch.
+        :param max_wait_ms: maximum time a text waits for other texts before its batch is started.
+        :param max_pending: maximum number of texts waiting to be processed. Beyond it, submit blocks (backpressure).
+        :param memory_governor: whether submit also blocks while the memory is above the high watermark (see MemoryGovernor).
+        :param anonymize_kwargs: other arguments of anonymize_texts used for all the batches (e.g. entities, per_matching).
+        """
+        self.nlp = nlp
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        # Batches are small and frequent: a process pool per batch would cost more than it saves
+        self.anonymize_kwargs = {"multi_processing": False, "auto_tuning": False, **anonymize_kwargs}
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.governor = MemoryGovernor() if memory_governor else None
+        self.latencies = deque(maxlen=1000)
+        self.counters = {"texts": 0, "batches": 0, "errors": 0, "chars": 0}
+        self.started = time.time()
+        self.thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, text: str, personal_data: dict[str, str] = None, timeout: float = None,
+               wait_memory: bool = True) -> Future:
+        """
+        Queues a text to be anonymized in the next batch, blocking while max_pending texts are already waiting or
+        the memory is above the high watermark.
+
+        :param text: text to anonymize.
+        :param personal_data: optional dictionary of specific personal data to anonymize.
+        :param timeout: maximum time to wait for a free slot in the queue, or for the memory to drop, after which
+                        queue.Full is raised.
+        :param wait_memory: whether to wait for the memory to drop (see wait_for_memory). Callers that must not block,
+                            like the asyncio API, wait for it beforehand in another thread.
+        :return: a future resolved with the anonymized text.
+        """
+        if wait_memory: self.wait_for_memory(timeout)
+        future = Future()
+        self.queue.put((text, personal_data, future, time.perf_counter()), timeout=timeout)
+        return future
+
+    def memory_pressure(self) -> bool:
+        """Whether the memory is above the high watermark, i.e. whether wait_for_memory would block."""
+        return self.governor is not None and self.governor.check()
+
+    def wait_for_memory(self, timeout: float = None) -> None:
+        """Blocks while the memory is above the high watermark (see MemoryGovernor.wait), raising queue.Full if it
+        does not drop within timeout (MEMORY_PAUSE_TIMEOUT if None)."""
+        if self.memory_pressure() and not self.governor.wait(timeout):
+            raise queue.Full(f"Memory above the high watermark ({self.governor.usage_mb:.0f} MB).")
+
+    def close(self) -> None:
+        """Stops the worker thread after the texts already submitted have been processed."""
+        self.queue.put(_STOP)
+        self.thread.join()
+
+    def stats(self) -> dict:
+        """Throughput and latency statistics of the processed texts."""
+        latencies = sorted(self.latencies)
+        percentile = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000 if latencies else None
+        uptime = time.time() - self.started
+        return {**self.counters,
+                "pending": self.queue.qsize(),
+                "uptime_s": uptime,
+                "texts_per_s": self.counters["texts"] / uptime if uptime else 0.0,
+                "avg_batch_size": self.counters["texts"] / self.counters["batches"] if self.counters["batches"] else 0.0,
+                "latency_ms_p50": percentile(0.5),
+                "latency_ms_p95": percentile(0.95),
+                "memory": self.governor.stats() if self.governor is not None else None}
+
+    def _next_batch(self) -> tuple[list, bool]:
+        """Waits for the first request, then collects the others arriving before the batch is full or the deadline."""
+        first = self.queue.get()
+        if first is _STOP: return [], True
+        batch, deadline = [first], time.perf_counter() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            try:
+                request = self.queue.get(timeout=max(0.0, deadline - time.perf_counter()))
+            except queue.Empty:
+                break
+            if request is _STOP: return batch, True
+            batch.append(request)
+        return batch, False
+
+    def _run(self) -> None:
+        stop = False
+        while not stop:
+            batch, stop = self._next_batch()
+            if not batch: continue
+            try:
+                self._anonymize_batch(batch)
+            except Exception as e:
+                if len(batch) == 1:
+                    self._fail(batch, e)
+                    continue
+                # A single bad request fails the whole batch: its texts are retried one by one, so that only it fails
+                for request in batch:
+                    try:
+                        self._anonymize_batch([request])
+                    except Exception as request_error:
+                        self._fail([request], request_error)
+
+    def _anonymize_batch(self, batch: list) -> None:
+        """Anonymizes the texts of a batch together and resolves their futures, raising if the anonymization fails."""
+        texts = [text for text, _, _, _ in batch]
+        anonymized, _ = anonymize_texts(texts, nlp=self.nlp, personal_data=[data for _, data, _, _ in batch],
+                                        **self.anonymize_kwargs)
+        now = time.perf_counter()
+        for (_, _, future, submitted), result in zip(batch, anonymized):
+            self.latencies.append(now - submitted)
+            future.set_result(result)
+        self.counters["texts"] += len(batch)
+        self.counters["batches"] += 1
+        self.counters["chars"] += sum(len(t) for t in texts)
+
+    def _fail(self, batch: list, error: Exception) -> None:
+        self.counters["errors"] += len(batch)
+        for _, _, future, _ in batch: future.set_exception(error)
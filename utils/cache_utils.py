@@ -0,0 +1,110 @@
+import os
+import re
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+from functools import lru_cache
+from pathlib import Path
+
+from config import RESULT_CACHE_PATH, RESULT_CACHE_MAX_MB
+
+RULES_ROOT = Path(__file__).resolve().parents[1] / "rules"
+RULES_FILES = ["rules.py", "merge_entities.py", "prepare_dictionaries.py"]
+PARAGRAPH_SEPARATOR_RE = re.compile(r"\n[ \t\r\f\v]*\n\s*")   # Blank lines between paragraphs
+
+
+@lru_cache(maxsize=1)
+def get_rules_hash() -> str:
+    """Hash of the rule modules and of the processed dictionaries, changing whenever the rules may give different results."""
+    sha = hashlib.sha256()
+    paths = [RULES_ROOT / f for f in RULES_FILES] + sorted((RULES_ROOT / "dictionaries_processed").glob("*.txt"))
+    for path in paths:
+        if path.is_file():
+            sha.update(path.name.encode("utf-8"))
+            sha.update(path.read_bytes())
+    return sha.hexdigest()
+
+
+def result_cache_key(text: str, personal_data: dict[str, str] | None, model_version: str, entities, per_matching: int,
+                     scope: str = "text") -> str:
+    """
+    Content-addressed key of an anonymization result, covering every input and setting the result depends on.
+    The scope ("text" or "segment") keeps whole-text results and paragraph results apart.
+    """
+    payload = json.dumps([scope, text, personal_data, model_version, sorted(entities), per_matching, get_rules_hash()],
+                         ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def split_paragraphs(text: str) -> list[tuple[int, int]]:
+    """Returns the (start, end) character offsets of the non-blank paragraphs of a text, separated by blank lines."""
+    paragraphs, start = [], 0
+    for match in PARAGRAPH_SEPARATOR_RE.finditer(text):
+        paragraphs.append((start, match.start()))
+        start = match.end()
+    paragraphs.append((start, len(text)))
+    return [(start, end) for start, end in paragraphs if text[start:end].strip()]
+
+
+class ResultCache:
+    """
+    Persistent cache of anonymization results, stored in a local SQLite file as compressed JSON values and bounded in
+    size by evicting the least recently used entries.
+    """
+
+    def __init__(self, path: str = RESULT_CACHE_PATH, max_mb: float = RESULT_CACHE_MAX_MB):
+        """
+        :param path: path of the SQLite file holding the cache.
+        :param max_mb: maximum size of the stored values in MB, beyond which least recently used entries are evicted.
+        """
+        self.path = os.path.expanduser(path)
+        self.max_bytes = int(max_mb * 1024 ** 2)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS results "
+                                "(key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)")
+        self.connection.commit()
+
+    def get_many(self, keys: list[str]) -> list[dict | None]:
+        """Returns the cached values for the given keys (None for missing ones), marking them as recently used."""
+        values = {}
+        for i in range(0, len(keys), 500):  # Stay below the SQLite limit on the number of query parameters
+            chunk = keys[i:i + 500]
+            rows = self.connection.execute(f"SELECT key, value FROM results WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+            values.update({key: json.loads(zlib.decompress(value)) for key, value in rows})
+
+        now = time.time()
+        self.connection.executemany("UPDATE results SET last_access = ? WHERE key = ?", [(now, key) for key in values])
+        self.connection.commit()
+        return [values.get(key) for key in keys]
+
+    def put_many(self, items: list[tuple[str, dict]]) -> None:
+        """Stores the given (key, value) pairs, evicting the least recently used entries if the size limit is exceeded."""
+        now = time.time()
+        rows = []
+        for key, value in items:
+            blob = zlib.compress(json.dumps(value, ensure_ascii=False).encode("utf-8"))
+            rows.append((key, blob, len(blob), now))
+        self.connection.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", rows)
+        self._evict()
+        self.connection.commit()
+
+    def _evict(self) -> None:
+        total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        excess = total - self.max_bytes
+        freed = 0
+        evicted = []
+        for key, size in self.connection.execute("SELECT key, size FROM results ORDER BY last_access"):
+            if freed >= excess: break
+            evicted.append((key,))
+            freed += size
+        self.connection.executemany("DELETE FROM results WHERE key = ?", evicted)
+
+    def close(self) -> None:
+        self.connection.close()
@@ -0,0 +1,227 @@
+import os
+import sys
+import glob
+import math
+import subprocess
+
+import psutil
+
+from config import P_CORES, PIN_WORKERS, WORKER_RAM_GB
+
+GB = 1024 ** 3
+OS_RESERVED_RAM_GB = 2          # Safety buffer: RAM left to the OS when sizing the number of processes
+THREAD_ENV_VARIABLES = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "VECLIB_MAXIMUM_THREADS",
+                        "NUMEXPR_NUM_THREADS"]
+
+_worker_plan = None             # Plan of the current worker process, set by init_pinned_worker
+
+
+def _parse_cpu_list(cpu_list: str) -> list[int]:
+    """Parses a Linux CPU list such as '0-3,8,10-11' into a list of CPU ids."""
+    cpus = []
+    for part in cpu_list.strip().split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.extend(range(int(first), int(last) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def _read_first_line(path: str) -> str | None:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return f.readline().strip()
+    except OSError:
+        return None
+
+
+def detect_allowed_cpus() -> list[int]:
+    """Logical CPUs the current process is allowed to run on (affinity mask), or all CPUs if not available."""
+    try:
+        return sorted(psutil.Process().cpu_affinity())
+    except (AttributeError, NotImplementedError, psutil.Error):
+        return list(range(os.cpu_count() or 1))
+
+
+def detect_performance_cpus(allowed_cpus: list[int]) -> list[int]:
+    """
+    Logical CPUs belonging to performance cores. On hybrid Intel CPUs they are listed by the kernel under the
+    'cpu_core' device, while on ARM big.LITTLE CPUs they are the ones with the highest 'cpu_capacity'.
+    If no distinction between core types is available, all allowed CPUs are returned.
+    """
+    core_cpus = _read_first_line("/sys/devices/cpu_core/cpus")
+    if core_cpus:
+        return [cpu for cpu in _parse_cpu_list(core_cpus) if cpu in allowed_cpus] or allowed_cpus
+
+    capacities = {}
+    for path in glob.glob("/sys/devices/system/cpu/cpu[0-9]*/cpu_capacity"):
+        cpu = int(os.path.basename(os.path.dirname(path))[3:])
+        value = _read_first_line(path)
+        if cpu in allowed_cpus and value:
+            capacities[cpu] = int(value)
+    if capacities and len(set(capacities.values())) > 1:
+        return sorted(cpu for cpu, capacity in capacities.items() if capacity == max(capacities.values()))
+
+    return allowed_cpus
+
+
+def detect_physical_performance_cores(n_performance_cpus: int) -> int:
+    """Number of physical performance cores, i.e. performance CPUs without SMT siblings."""
+    if sys.platform == "darwin":
+        try:
+            output = subprocess.run(["sysctl", "-n", "hw.perflevel0.physicalcpu"], capture_output=True, text=True)
+            return max(1, int(output.stdout.strip()))
+        except (OSError, ValueError):
+            pass
+
+    logical = psutil.cpu_count(logical=True) or 1
+    physical = psutil.cpu_count(logical=False) or logical
+    return max(1, round(n_performance_cpus * physical / logical))
+
+
+def detect_cgroup_cpu_limit() -> float | None:
+    """CPU quota of the current cgroup (v2 or v1) expressed in number of CPUs, or None if unlimited."""
+    cpu_max = _read_first_line("/sys/fs/cgroup/cpu.max")
+    if cpu_max:
+        quota, period = cpu_max.split()[:2]
+        return None if quota == "max" else int(quota) / int(period)
+
+    quota = _read_first_line("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+    period = _read_first_line("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+    if quota and period and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+
+def detect_available_memory() -> int:
+    """Available memory in bytes, taking into account the memory limit of the current cgroup if any."""
+    available = psutil.virtual_memory().available
+
+    limit = _read_first_line("/sys/fs/cgroup/memory.max") or _read_first_line("/sys/fs/cgroup/memory/memory.limit_in_bytes")
+    usage = _read_first_line("/sys/fs/cgroup/memory.current") or _read_first_line("/sys/fs/cgroup/memory/memory.usage_in_bytes")
+    if limit and limit != "max" and usage and int(limit) < psutil.virtual_memory().total:
+        available = min(available, max(0, int(limit) - int(usage)))
+
+    return available
+
+
+def plan_cpu_usage(p_cores: int = P_CORES,
+                   multi_processing: bool = True,
+                   worker_ram_gb: float = WORKER_RAM_GB,
+                   pin_workers: bool = PIN_WORKERS) -> dict:
+    """
+    Plans how many processes and how many torch/BLAS threads per process to use, based on the detected CPU topology,
+    cgroup CPU quota and available memory. The returned dictionary also reports the detected values and the reasons
+    behind each decision.
+
+    :param p_cores: maximum number of cores to use. If None, it is detected from the machine.
+    :param multi_processing: whether more than one spaCy process can be used.
+    :param worker_ram_gb: estimated RAM needed by each worker process holding a copy of the model.
+    :param pin_workers: whether worker processes should be pinned to dedicated cores.
+    :return: a dictionary with the detected resources and the planned processes, threads and CPU assignments.
+    """
+    allowed_cpus = detect_allowed_cpus()
+    performance_cpus = detect_performance_cpus(allowed_cpus)
+    physical_cores = detect_physical_performance_cores(len(performance_cpus))
+    cgroup_limit = detect_cgroup_cpu_limit()
+    available_memory = detect_available_memory()
+    reasons = []
+
+    usable_cores = physical_cores
+    reasons.append(f"{physical_cores} physical performance cores detected on {len(allowed_cpus)} allowed logical CPUs")
+    if cgroup_limit is not None and math.floor(cgroup_limit) < usable_cores:
+        usable_cores = max(1, math.floor(cgroup_limit))
+        reasons.append(f"limited to {usable_cores} cores by a cgroup CPU quota of {cgroup_limit:.2f} CPUs")
+    if p_cores is not None and p_cores < usable_cores:
+        usable_cores = max(1, p_cores)
+        reasons.append(f"limited to {usable_cores} cores by the requested number of cores")
+
+    # One core is left to the parent process, which feeds the workers and collects their results
+    processes = max(1, usable_cores - 1) if multi_processing else 1
+    memory_fit = int(max(0, available_memory / GB - OS_RESERVED_RAM_GB) // worker_ram_gb)
+    if processes > 1 and memory_fit < processes:
+        processes = max(1, memory_fit)
+        reasons.append(f"limited to {processes} processes by {available_memory / GB:.1f}GB of available memory")
+
+    threads_per_process = max(1, usable_cores // processes) if processes > 1 else usable_cores
+    reasons.append(f"{processes} processes with {threads_per_process} torch/BLAS threads each")
+
+    pinned_cpus = []
+    if pin_workers and processes > 1:
+        # Prefer one logical CPU per physical core, skipping SMT siblings when present
+        step = max(1, len(performance_cpus) // physical_cores)
+        pinned_cpus = performance_cpus[::step][:processes * threads_per_process]
+        reasons.append(f"workers pinned to CPUs {pinned_cpus}")
+
+    return {
+        "logical_cpus": os.cpu_count(),
+        "allowed_cpus": allowed_cpus,
+        "performance_cpus": performance_cpus,
+        "physical_performance_cores": physical_cores,
+        "cgroup_cpu_limit": cgroup_limit,
+        "available_memory_gb": round(available_memory / GB, 2),
+        "usable_cores": usable_cores,
+        "processes": processes,
+        "threads_per_process": threads_per_process,
+        "pinned_cpus": pinned_cpus,
+        "reasons": reasons,
+    }
+
+
+def apply_thread_limits(plan: dict) -> None:
+    """
+    Limits torch/BLAS intra-op threads according to the plan. Environment variables are inherited by the worker
+    processes spawned afterwards, while the current process uses all the usable cores. Does nothing in the worker
+    processes initialized by init_pinned_worker, which keep the limits of the plan they were started with.
+    """
+    if _worker_plan is not None:
+        return
+    for var in THREAD_ENV_VARIABLES:
+        os.environ[var] = str(plan["threads_per_process"])
+
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(plan["usable_cores"])
+
+
+def pin_child_processes(plan: dict, already_pinned: set[int], ignored: set[int] = frozenset()) -> None:
+    """
+    Pins the worker processes started by the current process (see multiprocessing.active_children) not pinned yet to
+    the CPUs reserved to them by the plan. Its other child processes (resource tracker, forkserver) and the ignored
+    ones (e.g. workers of another pool) are left alone, so that they take no slot.
+    """
+    import multiprocessing as mp
+
+    cpus = plan["pinned_cpus"]
+    if not cpus:
+        return
+
+    threads = plan["threads_per_process"]
+    try:
+        for child in mp.active_children():
+            if child.pid in already_pinned or child.pid in ignored:
+                continue
+            slot = len(already_pinned) % max(1, len(cpus) // threads)
+            psutil.Process(child.pid).cpu_affinity(cpus[slot * threads:(slot + 1) * threads])
+            already_pinned.add(child.pid)
+    except (AttributeError, NotImplementedError, psutil.Error):
+        pass  # Pinning is best-effort: unsupported platforms or exited workers are left unpinned
+
+
+def init_pinned_worker(plan: dict) -> None:
+    """Pool initializer setting thread limits and CPU affinity of a worker process according to the plan."""
+    import multiprocessing as mp
+    global _worker_plan
+
+    _worker_plan = plan
+    cpus = plan["pinned_cpus"]
+    threads = plan["threads_per_process"]
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(threads)
+    if cpus:
+        identity = mp.current_process()._identity
+        slot = (identity[0] - 1 if identity else 0) % max(1, len(cpus) // threads)
+        try:
+            psutil.Process().cpu_affinity(cpus[slot * threads:(slot + 1) * threads])
+        except (AttributeError, NotImplementedError, psutil.Error):
+            pass
@@ -1,8 +1,16 @@
+import os
+import glob
+
 import spacy
-from spacy.tokens import DocBin
+from spacy.tokens import Doc, DocBin
 from spacy.util import filter_spans
 
-from utils.json_utils import read_json_file, to_spacy_format
+from config import NER_SHARD_SIZE
+from utils.json_utils import read_json_file, save_json_file, to_spacy_format
+
+NER_DOCS_ATTRS = ["ORTH", "SPACY", "ENT_IOB", "ENT_TYPE"]     # Token attributes needed to rebuild texts and entities
+NER_SHARD_PATTERN = "ner_{:05d}.spacy"
+NER_SIDECAR_FILE = "ner_meta.json"
 
 
 def load_data_for_spacy(file_path: str):
@@ -48,4 +56,62 @@ def combine_docbins(docbins: list[DocBin]) -> DocBin:
     for db in docbins:
         for doc in db.get_docs(spacy.blank('it').vocab):
             combined_docbin.add(doc)
-    return combined_docbin
\ No newline at end of file
+    return combined_docbin
+
+
+def save_ner_docs(docs: list[Doc],
+                  output_dir: str,
+                  metadata: list[dict] = None,
+                  personal_data: list[dict] = None,
+                  inputs: list[str] = None,
+                  model_version: str = None,
+                  shard_size: int = NER_SHARD_SIZE) -> str:
+    """
+    Saves the output of the NER model as sharded DocBin files, keeping only the texts and the entities (no tensors,
+    no user data). Metadata, personal data and input paths are saved in a JSON sidecar, so that the docs can be
+    anonymized later without the original inputs.
+
+    :param docs: the list of docs processed by the NER model.
+    :param output_dir: folder where to save the shards and the sidecar.
+    :param metadata: optional list of metadata dictionaries for each doc.
+    :param personal_data: optional list of personal data dictionaries for each doc.
+    :param inputs: optional list of the input paths the docs were read from, used to place the outputs later.
+    :param model_version: optional identifier of the model that produced the entities.
+    :param shard_size: maximum number of docs in each DocBin file.
+    :return: the path of the output folder.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    if glob.glob(os.path.join(output_dir, NER_SHARD_PATTERN.replace("{:05d}", "*"))):
+        raise ValueError(f"Folder '{output_dir}' already contains saved NER output.")
+
+    shards = []
+    for i in range(0, len(docs), shard_size):
+        doc_bin = DocBin(attrs=NER_DOCS_ATTRS, store_user_data=False, docs=docs[i:i + shard_size])
+        shards.append(NER_SHARD_PATTERN.format(len(shards)))
+        doc_bin.to_disk(os.path.join(output_dir, shards[-1]))
+
+    save_json_file(os.path.join(output_dir, NER_SIDECAR_FILE), {
+        "model_version": model_version,
+        "inputs": [os.path.abspath(path) for path in inputs] if inputs else [],
+        "shards": shards,
+        "metadata": metadata if metadata is not None else [None] * len(docs),
+        "personal_data": personal_data if personal_data is not None else [None] * len(docs)
+    })
+    return output_dir
+
+
+def load_ner_docs(input_dir: str) -> tuple[list[Doc], list[dict | None], list[dict | None], list[str]]:
+    """
+    Loads the docs saved by save_ner_docs, without loading the NER model.
+
+    :param input_dir: folder containing the shards and the sidecar.
+    :return: a tuple containing the docs, their metadata, their personal data and the original input paths.
+    """
+    sidecar = read_json_file(os.path.join(input_dir, NER_SIDECAR_FILE))
+    vocab = spacy.blank("it").vocab
+
+    docs = []
+    for shard in sidecar["shards"]:
+        docs.extend(DocBin().from_disk(os.path.join(input_dir, shard)).get_docs(vocab))
+
+    return docs, sidecar["metadata"], sidecar["personal_data"], sidecar["inputs"]
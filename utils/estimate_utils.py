@@ -0,0 +1,301 @@
+import os
+import sys
+import time
+import threading
+from contextlib import contextmanager
+
+import psutil
+
+from config import DEFAULT_NER_MODEL, TRANSFORMER_BACKEND, P_CORES, PATIENT_DATA_FIELDS, SINGLE_TEXT_FIELDS, \
+    ESTIMATE_SAMPLE_DOCS, ESTIMATE_PARALLEL_EFFICIENCY
+from utils.json_utils import read_json_file
+from utils.cpu_utils import plan_cpu_usage
+from utils.memory_utils import get_rss_mb, MB
+from utils.multiprocessing_utils import estimate_spacy_params
+from utils.timing_utils import collect_pipeline_metrics
+
+# Kinds of input files, whose reading costs are calibrated separately
+TEXT_FILES = "text"     # .txt, .docx and JSON files with the texts inline: cost per character
+PDF_FILES = "pdf"       # Local PDF files: cost per page
+S3_FILES = "s3"         # JSON files referencing PDF files on S3: cost per reference
+RSS_SAMPLING_INTERVAL = 0.05    # Time in seconds between two measures of the resident memory during the calibration
+
+
+def scan_file(path: str) -> dict:
+    """
+    Counts the documents, characters, PDF pages and S3 references of an input file without extracting the text of
+    PDF files nor fetching them from S3, so that the characters of PDF files are not known.
+
+    :param path: path of a .txt, .docx, .pdf or .json file.
+    :return: a dictionary with the path, kind (see TEXT_FILES, PDF_FILES, S3_FILES), docs, chars, pdf_pages and s3_refs.
+    """
+    from utils.anonymization_utils import read_file
+
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".pdf":
+        from pypdf import PdfReader
+        return {"path": path, "kind": PDF_FILES, "docs": 1, "chars": 0, "pdf_pages": len(PdfReader(path).pages), "s3_refs": 0}
+    if ext == ".json":
+        entries = read_json_file(path)[PATIENT_DATA_FIELDS[1]]
+        texts = [entry[SINGLE_TEXT_FIELDS[2]] for entry in entries if SINGLE_TEXT_FIELDS[2] in entry]
+        s3_refs = sum(1 for entry in entries if SINGLE_TEXT_FIELDS[2] not in entry and SINGLE_TEXT_FIELDS[5] in entry)
+        if len(texts) + s3_refs < len(entries):
+            raise ValueError(f"Each entry in the '{PATIENT_DATA_FIELDS[1]}' list must contain either a '{SINGLE_TEXT_FIELDS[2]}' or a '{SINGLE_TEXT_FIELDS[5]}' field.")
+    else:
+        texts, s3_refs = read_file(path)[0], 0
+    return {"path": path, "kind": S3_FILES if s3_refs else TEXT_FILES, "docs": len(texts) + s3_refs,
+            "chars": sum(len(text) for text in texts), "pdf_pages": 0, "s3_refs": s3_refs}
+
+
+def scan_inputs(files: list[str]) -> tuple[list[dict], dict]:
+    """
+    Scans the given input files (see scan_file), warning about the ones that cannot be read.
+
+    :return: the scans of the readable files and the totals over all of them, with the unreadable files in "errors".
+    """
+    scans, errors = [], []
+    for path in files:
+        try:
+            scans.append(scan_file(path))
+        except Exception as e:
+            print(f"Warning: cannot scan '{path}': {e}", file=sys.stderr)
+            errors.append({"path": path, "error": str(e)})
+    totals = {"files": len(scans), **{key: sum(scan[key] for scan in scans) for key in ("docs", "chars", "pdf_pages", "s3_refs")},
+              "files_by_kind": {kind: sum(1 for scan in scans if scan["kind"] == kind) for kind in (TEXT_FILES, PDF_FILES, S3_FILES)},
+              "errors": errors}
+    return scans, totals
+
+
+def calibrate(scans: list[dict],
+              sample_docs: int = ESTIMATE_SAMPLE_DOCS,
+              profile: str = None,
+              backend: str = TRANSFORMER_BACKEND,
+              entities: list[str] = None,
+              per_matching: int = None,
+              p_cores: int = P_CORES,
+              scan_s: float = 0.0) -> dict:
+    """
+    Measures on the current machine the costs the estimate is based on, by reading a sample of the scanned files
+    (with read_file, so PDF files are extracted and S3 references fetched) and anonymizing up to sample_docs of their
+    documents in a single process: model loading time, reading time per character, PDF page and S3 reference,
+    anonymization throughput, and resident memory of a process holding the model.
+
+    :param scans: scans of the input files (see scan_inputs).
+    :param sample_docs: number of documents to anonymize. Each kind of file found is sampled at least once.
+    :param profile: name of the inference profile of the run.
+    :param backend: backend running the transformer.
+    :param entities: entity types to anonymize.
+    :param per_matching: extra PER matching level.
+    :param p_cores: maximum number of cores to use, for the batch size. If None, it is detected from the machine.
+    :param scan_s: time spent scanning the inputs, to tell apart the rest of the time spent by the process before the
+                   model is loaded (interpreter start and imports), which is part of the startup of a run.
+    :return: a dictionary of the measured costs.
+    """
+    from anonymization_functions import anonymize_texts
+    from utils.anonymization_utils import read_file
+    from utils.model_utils import load_model
+
+    # Reading costs, by kind of file
+    read = {kind: {"seconds": 0.0, "chars": 0, "pdf_pages": 0, "s3_refs": 0, "files": 0} for kind in (TEXT_FILES, PDF_FILES, S3_FILES)}
+    texts, personal_data = [], []
+    for scan, limit in _sample_files(scans, sample_docs):
+        start = time.perf_counter()
+        t, _, pd = read_file(scan["path"])
+        cost = read[scan["kind"]]
+        cost["seconds"] += time.perf_counter() - start
+        cost["chars"] += sum(len(text) for text in t) - (scan["chars"] if scan["kind"] == S3_FILES else 0)
+        cost["pdf_pages"] += scan["pdf_pages"]
+        cost["s3_refs"] += scan["s3_refs"]
+        cost["files"] += 1
+        texts.extend(t[:limit])
+        personal_data.extend([pd] * len(t[:limit]))
+    if not texts:
+        raise ValueError("No documents to calibrate on.")
+
+    imports_s = time.time() - psutil.Process().create_time() - scan_s - sum(cost["seconds"] for cost in read.values())
+    rss_base = get_rss_mb()
+    start = time.perf_counter()
+    nlp = load_model(DEFAULT_NER_MODEL, profile, backend)
+    model_load_s = time.perf_counter() - start
+    rss_model = get_rss_mb()
+
+    # The first anonymization builds the dictionaries of the rules, a cost paid once per process
+    anonymize_kwargs = {"nlp": nlp, "entities": entities, "per_matching": per_matching, "multi_processing": False,
+                        "auto_tuning": False, "use_cache": False, "segment_cache": False, "watchdog": False}
+    start = time.perf_counter()
+    anonymize_texts([texts[0][:1000]], personal_data=personal_data[:1], **anonymize_kwargs)
+    warmup_s = time.perf_counter() - start
+
+    with _track_peak_rss() as peak, collect_pipeline_metrics() as metrics:
+        start = time.perf_counter()
+        anonymize_texts(texts, personal_data=personal_data, **anonymize_kwargs)
+        anonymization_s = time.perf_counter() - start
+    report = metrics.report(include_documents=False)
+    chars = sum(len(text) for text in texts)
+
+    return {"sample_files": sum(cost["files"] for cost in read.values()),
+            "sample_docs": len(texts),
+            "sample_chars": chars,
+            "imports_s": imports_s,
+            "model_load_s": model_load_s,
+            "warmup_s": warmup_s,
+            "chars_per_s": _rate(chars, anonymization_s),
+            "stage_shares": {stage: values["share"] for stage, values in report["stages"].items()},
+            "text_read_s_per_char": _rate(read[TEXT_FILES]["seconds"], read[TEXT_FILES]["chars"]),
+            "pdf_s_per_page": _rate(read[PDF_FILES]["seconds"], read[PDF_FILES]["pdf_pages"]),
+            "pdf_chars_per_page": _rate(read[PDF_FILES]["chars"], read[PDF_FILES]["pdf_pages"]),
+            "s3_s_per_ref": _rate(read[S3_FILES]["seconds"], read[S3_FILES]["s3_refs"]),
+            "s3_chars_per_ref": _rate(read[S3_FILES]["chars"], read[S3_FILES]["s3_refs"]),
+            "rss_base_mb": rss_base,
+            "model_mb": rss_model - rss_base,
+            "peak_rss_mb": max(peak["mb"], rss_model),
+            "bytes_per_char": sum(sys.getsizeof(text) for text in texts) / max(1, chars),
+            "batch_size": min(estimate_spacy_params(texts, plan_cpu_usage(p_cores)["usable_cores"])[1], nlp.batch_size)}
+
+
+def predict(totals: dict,
+            calibration: dict,
+            p_cores: int = P_CORES,
+            parallel_efficiency: float = ESTIMATE_PARALLEL_EFFICIENCY) -> dict:
+    """
+    Predicts wall time and peak memory of the anonymization of the scanned inputs on the current machine, with the
+    worker configuration recommended by plan_cpu_usage for workers of the calibrated size.
+    The texts of all the inputs are read before they are anonymized and kept in memory with their anonymized version
+    until they are written, as anonymize.py does. Each worker is counted as a full copy of the calibrated process,
+    which overestimates the memory of workers sharing the model copy-on-write ("fork" and "forkserver" start methods).
+
+    :param totals: totals of the scanned inputs (see scan_inputs).
+    :param calibration: costs measured by calibrate.
+    :param p_cores: maximum number of cores to use. If None, it is detected from the machine.
+    :param parallel_efficiency: fraction of the throughput of a single process assumed for each additional worker.
+    :return: a dictionary with the predicted characters, times, memory, recommended configuration and the assumptions made.
+    """
+    assumptions = []
+    extrapolate = lambda count, key, fallback, what: _extrapolate(count, calibration, key, fallback, what, assumptions)
+    mean_chars = calibration["sample_chars"] / calibration["sample_docs"]
+
+    # PDF texts are only known after extraction, so they are extrapolated from the calibrated documents
+    chars = totals["chars"] \
+        + extrapolate(totals["pdf_pages"], "pdf_chars_per_page", mean_chars, "characters per PDF page") \
+        + extrapolate(totals["s3_refs"], "s3_chars_per_ref", mean_chars, "characters per S3 document")
+    read_s = extrapolate(totals["chars"], "text_read_s_per_char", 0, "reading time per character of text files") \
+        + extrapolate(totals["pdf_pages"], "pdf_s_per_page", 0, "extraction time per PDF page") \
+        + extrapolate(totals["s3_refs"], "s3_s_per_ref", 0, "fetch and extraction time per S3 document")
+
+    plan = plan_cpu_usage(p_cores, multi_processing=True, worker_ram_gb=calibration["peak_rss_mb"] * MB / 1024 ** 3)
+    processes = plan["processes"]
+    speedup = 1 + (processes - 1) * parallel_efficiency
+    single_anonymization_s = chars / calibration["chars_per_s"] if calibration["chars_per_s"] else 0.0
+    startup_s = calibration["imports_s"] + calibration["model_load_s"] + calibration["warmup_s"]
+    wall_s = startup_s + read_s + single_anonymization_s / speedup
+    if processes > 1:
+        assumptions.append(f"each of the {processes} worker processes adds {parallel_efficiency:.0%} of the throughput of a single process (ESTIMATE_PARALLEL_EFFICIENCY)")
+
+    texts_mb = 2 * chars * calibration["bytes_per_char"] / MB
+    main_mb = calibration["peak_rss_mb"] + texts_mb
+    workers_mb = processes * calibration["peak_rss_mb"] if processes > 1 else 0.0
+
+    return {"chars": int(chars),
+            "wall_s": wall_s,
+            "wall_h": wall_s / 3600,
+            "single_process_wall_s": startup_s + read_s + single_anonymization_s,
+            "time_s": {"startup": startup_s,
+                       "read": read_s,
+                       "anonymization": single_anonymization_s / speedup},
+            "anonymization_s_by_stage": {stage: single_anonymization_s / speedup * share
+                                         for stage, share in calibration["stage_shares"].items()},
+            "docs_per_s": totals["docs"] / wall_s if wall_s else None,
+            "peak_memory_mb": {"main": main_mb, "workers": workers_mb, "total": main_mb + workers_mb,
+                               "available": plan["available_memory_gb"] * 1024},
+            "recommended": {"multi_processing": processes > 1,
+                            "p_cores": plan["usable_cores"],
+                            "processes": processes,
+                            "threads_per_process": plan["threads_per_process"],
+                            "batch_size": calibration["batch_size"],
+                            "reasons": plan["reasons"]},
+            "assumptions": assumptions}
+
+
+def estimate_run(files: list[str],
+                 sample_docs: int = ESTIMATE_SAMPLE_DOCS,
+                 profile: str = None,
+                 backend: str = TRANSFORMER_BACKEND,
+                 entities: list[str] = None,
+                 per_matching: int = None,
+                 p_cores: int = P_CORES) -> dict:
+    """
+    Dry run planning the anonymization of the given input files: scans them without running the model and, unless
+    sample_docs is 0, calibrates the costs on a sample of them to predict wall time, peak memory and the recommended
+    worker and batch configuration for the current machine.
+
+    :param files: input files (see utils.path_utils.list_input_files).
+    :param sample_docs: number of documents anonymized for the calibration. If 0, only the scan is returned.
+    :param profile: name of the inference profile of the run.
+    :param backend: backend running the transformer.
+    :param entities: entity types to anonymize.
+    :param per_matching: extra PER matching level.
+    :param p_cores: maximum number of cores to use. If None, it is detected from the machine.
+    :return: a dictionary with the scanned "inputs", and the "calibration" and "estimate" (None without calibration).
+    """
+    start = time.perf_counter()
+    scans, totals = scan_inputs(files)
+    scan_s = time.perf_counter() - start
+    calibration = calibrate(scans, sample_docs, profile, backend, entities, per_matching, p_cores, scan_s) \
+        if sample_docs > 0 and scans else None
+    return {"inputs": totals,
+            "calibration": calibration,
+            "estimate": predict(totals, calibration, p_cores) if calibration is not None else None}
+
+
+def _sample_files(scans: list[dict], sample_docs: int) -> list[tuple[dict, int]]:
+    """
+    Files evenly spaced among the files of each kind, with a number of documents of each kind proportional to its
+    share of the documents (at least one file per kind), together with the number of their documents to anonymize.
+    """
+    total_docs = sum(scan["docs"] for scan in scans)
+    sample = []
+    for kind in (TEXT_FILES, PDF_FILES, S3_FILES):
+        kind_scans = [scan for scan in scans if scan["kind"] == kind and scan["docs"]]
+        kind_docs = sum(scan["docs"] for scan in kind_scans)
+        if not kind_docs:
+            continue
+        target = max(1, round(sample_docs * kind_docs / total_docs))
+        for scan in kind_scans[::max(1, kind_docs // target)]:
+            sample.append((scan, target))
+            target -= scan["docs"]
+            if target <= 0: break
+    return sample
+
+
+def _rate(numerator: float, denominator: float) -> float | None:
+    return numerator / denominator if denominator else None
+
+
+def _extrapolate(count: float, calibration: dict, key: str, fallback: float, what: str, assumptions: list[str]) -> float:
+    """count times the calibrated value of key, or times fallback if the sample did not allow measuring it, noting the
+    assumption."""
+    if not count:
+        return 0.0
+    if calibration[key] is not None:
+        return count * calibration[key]
+    assumptions.append(f"{what} not measured on the sample, assumed {fallback:.0f}")
+    return count * fallback
+
+
+@contextmanager
+def _track_peak_rss():
+    """Context manager measuring the peak resident memory of the current process in a background thread."""
+    peak, stop = {"mb": get_rss_mb()}, threading.Event()
+
+    def track():
+        while not stop.wait(RSS_SAMPLING_INTERVAL):
+            peak["mb"] = max(peak["mb"], get_rss_mb())
+
+    thread = threading.Thread(target=track, daemon=True)
+    thread.start()
+    try:
+        yield peak
+    finally:
+        stop.set()
+        thread.join()
+        peak["mb"] = max(peak["mb"], get_rss_mb())
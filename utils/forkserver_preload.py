@@ -0,0 +1,27 @@
+import gc
+import os
+import sys
+import json
+
+from utils.preload_utils import PRELOAD_ENV_VAR
+
+# Imported by the forkserver process before it forks any worker (see utils.preload_utils.configure_start_method):
+# loads the model (only for the runs whose workers load it) and compiles the rules described by PRELOAD_ENV_VAR, so
+# that all the workers share them copy-on-write instead of loading their own copy.
+
+if os.environ.get(PRELOAD_ENV_VAR):
+    try:
+        from rules.rules import preload_rules
+        from utils.model_utils import load_model, preload_model
+        # Modules of the worker functions, which the entry points only import when needed
+        import anonymization_functions
+        import utils.streaming_utils
+
+        settings = json.loads(os.environ[PRELOAD_ENV_VAR])
+        if settings["model_args"] is not None:
+            preload_model(load_model(**settings["model_args"]))
+        preload_rules(settings["per_matching"])
+        gc.freeze()
+    except Exception as e:
+        # Workers fall back to loading their own copy of the model
+        print(f"Warning: preloading the model in the forkserver failed ({e}).", file=sys.stderr)
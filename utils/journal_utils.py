@@ -0,0 +1,102 @@
+import os
+import json
+import time
+
+JOURNAL_FILE = "_journal.jsonl"     # Journal of the input files already anonymized, in the output folder
+
+
+class RunJournal:
+    """
+    Append-only journal of the input files anonymized by a run, with their documents and output files, so that a run
+    interrupted (crash, OOM kill) and started again skips the files already done. Each file gets one JSON line,
+    written and flushed to disk after its outputs, so that a line is only found for files whose outputs are complete.
+    A line left incomplete by an interruption is ignored. The latest line of a file wins.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: path of the journal file, created if missing.
+        """
+        self.path = path
+        self.records = {}       # Latest record of each input file, by absolute path
+        self.next_index = 0     # Index of the next document, so that output names do not collide across files
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                content = f.read()
+            for line in content.splitlines():
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue    # Line left incomplete by an interruption
+                self.records[record["input"]] = record
+                self.next_index = max(self.next_index, record["first_index"] + record["docs"])
+            if content and not content.endswith(b"\n"):
+                with open(path, "ab") as f:
+                    f.write(b"\n")
+        self.file = open(path, "a", encoding="utf-8")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self) -> None:
+        self.file.close()
+
+    def is_done(self, input_path: str) -> bool:
+        """Whether the given input file, unchanged since, was anonymized and all its outputs still exist."""
+        record = self.records.get(os.path.abspath(input_path))
+        return record is not None and record["signature"] == file_signature(input_path) \
+            and all(os.path.exists(path) for path in record["outputs"])
+
+    def known_entries(self, input_path: str) -> dict:
+        """The journal does not reuse the outputs of single documents: files changed since are anonymized again."""
+        return {}
+
+    def record(self, input_path: str, docs: int, outputs: list[str], quarantine: list[dict] = None,
+               entries: list[str] = None) -> dict:
+        """
+        Records an input file as done, after flushing its outputs to disk.
+
+        :param input_path: path of the input file.
+        :param docs: number of documents read from the file (skipped documents included).
+        :param outputs: paths of the output files written for it.
+        :param quarantine: records of its documents skipped by the watchdog (see utils.watchdog.quarantine_record).
+        :param entries: hashes of the documents saved in the outputs, in order (see utils.manifest_utils.document_hash).
+        :return: the journal record.
+        """
+        for path in outputs:
+            _fsync(path)
+        record = {"input": os.path.abspath(input_path),
+                  "signature": file_signature(input_path),
+                  "docs": docs,
+                  "first_index": self.next_index,
+                  "outputs": [os.path.abspath(path) for path in outputs],
+                  "entries": entries or [],
+                  "quarantine": quarantine or [],
+                  "time": time.strftime("%Y-%m-%d %H:%M:%S")}
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.records[record["input"]] = record
+        self.next_index += docs
+        return record
+
+    def checkpoint(self) -> None:
+        """Nothing to do: each record is flushed to disk as soon as it is written."""
+
+    def quarantine(self) -> list[dict]:
+        """Records of the documents skipped by the watchdog in all the runs journaled."""
+        return [entry for record in self.records.values() for entry in record["quarantine"]]
+
+
+def file_signature(path: str) -> list:
+    """Size and modification time of a file, to tell whether it changed since it was journaled."""
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _fsync(path: str) -> None:
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import hashlib
+
+from config import DEFAULT_ENTITIES, PATIENT_DATA_FIELDS, SINGLE_TEXT_FIELDS
+from utils.anonymization_utils import read_file, read_text_entries, text_entry_metadata
+from utils.cache_utils import get_rules_hash
+from utils.journal_utils import file_signature
+from utils.json_utils import read_json_file
+from utils.path_utils import get_resource_path
+from utils.profile_utils import get_profile_per_matching
+from utils.timing_utils import timed_stage, READ_STAGE
+
+MANIFEST_FILE = "_manifest.json"    # Manifest of the input files anonymized in the output folder, across runs
+
+
+class RunManifest:
+    """
+    Manifest of the input files anonymized in an output folder across runs: for each input file, the hash of its
+    content, its size and modification time, the fingerprint of the settings it was anonymized with (see
+    settings_fingerprint), its output files and the hash of each of its documents saved in them, in order. Only the
+    files whose size or modification time changed are hashed. Later runs skip the files unchanged since, and for the
+    patient JSONs that changed only anonymize the entries of the 'testi' list not saved yet, reusing the others.
+    It is rewritten (atomically) after each chunk of files, so that an interrupted run also picks up where it stopped.
+    """
+
+    def __init__(self, path: str, settings: str):
+        """
+        :param path: path of the manifest file, created if missing.
+        :param settings: fingerprint of the settings of the run (see settings_fingerprint).
+        """
+        self.path = path
+        self.settings = settings
+        self.records = {}       # Record of each input file, by absolute path
+        if os.path.exists(path):
+            try:
+                self.records = read_json_file(path)["files"]
+            except (OSError, ValueError, KeyError):
+                pass            # Unreadable manifest: every file is anonymized again
+        self.next_index = max((record["first_index"] + record["docs"] for record in self.records.values()), default=0)
+        self.hashes = {}        # Content hash of the input files checked in this run, by absolute path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.save()
+
+    def is_done(self, input_path: str) -> bool:
+        """Whether the given input file, with the same content, was anonymized with the same settings and all its
+        outputs still exist. The content is only hashed if the size or the modification time of the file changed."""
+        input_path = os.path.abspath(input_path)
+        record = self.records.get(input_path)
+        if record is None or record["settings"] != self.settings \
+                or not all(os.path.exists(path) for path in record["outputs"]):
+            return False
+        signature = file_signature(input_path)
+        if record.get("signature") == signature:
+            return True
+        self.hashes[input_path] = file_hash(input_path)
+        if record["sha256"] != self.hashes[input_path]:
+            return False
+        record["signature"] = signature     # Touched or copied but unchanged: not hashed again by the next runs
+        return True
+
+    def known_entries(self, input_path: str) -> dict[str, dict | str]:
+        """
+        Saved outputs of the documents of an input file anonymized before with the same settings, by document hash
+        (see document_hash). Only the outputs saved in a single JSON file (DEFAULT_OUTPUTS_IN_SINGLE_FILE) are reused.
+
+        :param input_path: path of the input file.
+        :return: the entries of the 'testi' list of its output file, by hash of the input document, if any.
+        """
+        record = self.records.get(os.path.abspath(input_path))
+        if record is None or record["settings"] != self.settings or len(record["outputs"]) != 1 \
+                or not record["outputs"][0].endswith(".json"):
+            return {}
+        try:
+            saved = read_json_file(record["outputs"][0])[PATIENT_DATA_FIELDS[1]]
+        except (OSError, ValueError, KeyError):
+            return {}
+        return dict(zip(record["entries"], saved)) if len(saved) == len(record["entries"]) else {}
+
+    def record(self, input_path: str, docs: int, outputs: list[str], quarantine: list[dict] = None,
+               entries: list[str] = None) -> dict:
+        """
+        Records an input file as done, after flushing its outputs to disk and deleting the previous outputs not
+        overwritten. The manifest is written by save.
+
+        :param input_path: path of the input file.
+        :param docs: number of documents read from the file (skipped documents included).
+        :param outputs: paths of the output files written for it.
+        :param quarantine: records of its documents skipped by the watchdog (see utils.watchdog.quarantine_record).
+        :param entries: hashes of the documents saved in the outputs, in order (see document_hash).
+        :return: the manifest record.
+        """
+        input_path = os.path.abspath(input_path)
+        outputs = [os.path.abspath(path) for path in outputs]
+        for path in self.records.get(input_path, {}).get("outputs", []):
+            if path not in outputs and os.path.exists(path):
+                os.remove(path)
+        for path in outputs:
+            _fsync(path)
+        record = {"sha256": self.hashes.get(input_path) or file_hash(input_path),
+                  "signature": file_signature(input_path),
+                  "settings": self.settings,
+                  "docs": docs,
+                  "first_index": self.next_index,
+                  "outputs": outputs,
+                  "entries": entries or [],
+                  "quarantine": quarantine or [],
+                  "time": time.strftime("%Y-%m-%d %H:%M:%S")}
+        self.records[input_path] = record
+        self.next_index += docs
+        return record
+
+    def checkpoint(self) -> None:
+        """Writes the manifest (see save), called after each chunk of files."""
+        self.save()
+
+    def save(self) -> None:
+        """Writes the manifest to a temporary file flushed to disk, then replaces the previous one with it."""
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"files": self.records}, f, ensure_ascii=False, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+
+    def quarantine(self) -> list[dict]:
+        """Records of the documents skipped by the watchdog in the latest anonymization of each file."""
+        return [entry for record in self.records.values() for entry in record["quarantine"]]
+
+
+def settings_fingerprint(model_path: str, profile: str, backend: str, entities: list[str], per_matching: int,
+                         personal_data: dict = None) -> str:
+    """
+    Hash of the settings the outputs depend on, computed without loading the model: the meta.json of the model
+    (name, version, quantization), inference profile, backend, entities, extra PER matching level, personal data
+    given for all the inputs and the hash of the rules (see utils.cache_utils.get_rules_hash).
+    """
+    meta_path = os.path.join(get_resource_path(model_path), "meta.json")
+    with open(meta_path, "rb") as f:
+        meta_hash = hashlib.sha256(f.read()).hexdigest()
+    payload = json.dumps([meta_hash, profile, backend, sorted(entities or DEFAULT_ENTITIES),
+                          per_matching if per_matching is not None else get_profile_per_matching(profile),
+                          personal_data, get_rules_hash()], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def file_hash(path: str) -> str:
+    """SHA-256 of the content of a file."""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def document_hash(document: dict | str, personal_data: dict | None) -> str:
+    """Hash of a document (entry of the 'testi' list of a patient JSON, or text) together with its personal data."""
+    payload = json.dumps([document, personal_data], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+@timed_stage(READ_STAGE)
+def read_file_entries(file_path: str, known: dict | set = ()) \
+        -> tuple[list[str | None], list[dict | None], dict | None, list[str]]:
+    """
+    Reads a file like utils.anonymization_utils.read_file, also returning the hash of each document (see
+    document_hash). The entries of a patient JSON whose hash is in known are not read (nor fetched from S3): their
+    text is None.
+
+    :param file_path: path of the file.
+    :param known: hashes of the documents not to read.
+    :return: a tuple containing the texts, the metadata (one per text), the personal data and the document hashes.
+    """
+    if os.path.splitext(file_path)[1].lower() != ".json":
+        texts, metadata, personal_data = read_file(file_path)
+        return texts, metadata or [None] * len(texts), personal_data, \
+            [document_hash(text, personal_data) for text in texts]
+
+    data = read_json_file(file_path)
+    entries = data[PATIENT_DATA_FIELDS[1]]
+    personal_data = data.get(PATIENT_DATA_FIELDS[0])
+    hashes = [document_hash(entry, personal_data) for entry in entries]
+    new = [i for i, digest in enumerate(hashes) if digest not in known]
+    texts = [None] * len(entries)
+    for i, text in zip(new, read_text_entries([entries[i] for i in new])):
+        texts[i] = text
+    return texts, [text_entry_metadata(entry) for entry in entries], personal_data, hashes
+
+
+def saved_text(entry: dict | str) -> str:
+    """Anonymized text of an entry of the 'testi' list of an output file."""
+    return entry[SINGLE_TEXT_FIELDS[2]] if isinstance(entry, dict) else entry
+
+
+def _fsync(path: str) -> None:
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
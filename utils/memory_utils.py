@@ -0,0 +1,272 @@
+import gc
+import sys
+import time
+import threading
+import ctypes
+import pickle
+import tempfile
+from contextlib import nullcontext
+from typing import Callable
+
+import psutil
+from spacy import Language
+
+from config import VOCAB_RECYCLING, VOCAB_RECYCLE_DOCS, VOCAB_RECYCLE_RSS_MB, VOCAB_RSS_CHECK_DOCS, MEMORY_HIGH_WATERMARK_MB, \
+    MEMORY_LOW_WATERMARK_MB, MEMORY_CHECK_INTERVAL, MEMORY_PAUSE_TIMEOUT, MEMORY_SPILL_DIR
+from utils.cpu_utils import detect_available_memory
+
+MB = 1024 ** 2
+WATERMARK_RATIO = 0.8       # Default high watermark as a fraction of the available memory, and low watermark as a fraction of the high one
+MIN_CHUNK_SCALE = 1 / 16    # Chunks are shrunk at most to this fraction of their size, so that throughput never collapses
+
+
+def get_rss_mb() -> float:
+    """Resident set size of the current process in MB."""
+    return psutil.Process().memory_info().rss / MB
+
+
+def get_tree_rss_mb() -> float:
+    """
+    Resident set size in MB of the current process and of all its descendants (worker processes). Pages shared by
+    several processes (e.g. a model shared copy-on-write by forked workers) are counted once per process, so the
+    result overestimates the real footprint.
+    """
+    process = psutil.Process()
+    total = process.memory_info().rss
+    for child in process.children(recursive=True):
+        try:
+            total += child.memory_info().rss
+        except psutil.Error:
+            pass    # Exited in the meantime
+    return total / MB
+
+
+def release_free_memory() -> None:
+    """Runs the garbage collector and, with glibc, returns the freed heap memory to the OS so that it leaves the RSS."""
+    gc.collect()
+    if sys.platform.startswith("linux"):
+        try:
+            ctypes.CDLL("libc.so.6").malloc_trim(0)
+        except (OSError, AttributeError):
+            pass    # Not glibc
+
+
+class MemoryGovernor:
+    """
+    Watches the resident memory of the current process and of its workers, and tells the processing loops how to
+    react when it crosses the high watermark: chunks of texts are shrunk (halved at each crossing, down to
+    MIN_CHUNK_SCALE of their size) and grow back once the memory is below the low watermark, finished results are
+    spilled to disk (see SpillList) and intake can be paused until the memory drops. Sustained throughput under a
+    memory limit is preferred to peak speed.
+    """
+
+    def __init__(self,
+                 high_watermark_mb: float = MEMORY_HIGH_WATERMARK_MB,
+                 low_watermark_mb: float = MEMORY_LOW_WATERMARK_MB,
+                 check_interval: float = MEMORY_CHECK_INTERVAL,
+                 pause_timeout: float = MEMORY_PAUSE_TIMEOUT):
+        """
+        :param high_watermark_mb: memory in MB beyond which the governor acts. If None, WATERMARK_RATIO of the memory
+                                  available at start is added to the current memory.
+        :param low_watermark_mb: memory in MB below which shrunk chunks grow back. If None, WATERMARK_RATIO of the high watermark.
+        :param check_interval: minimum time in seconds between two measures, which are reused in between.
+        :param pause_timeout: maximum time in seconds a pause waits for the memory to drop.
+        """
+        self.usage_mb = get_tree_rss_mb()
+        self.high_watermark_mb = high_watermark_mb or self.usage_mb + WATERMARK_RATIO * detect_available_memory() / MB
+        self.low_watermark_mb = low_watermark_mb or WATERMARK_RATIO * self.high_watermark_mb
+        self.check_interval = check_interval
+        self.pause_timeout = pause_timeout
+        self.scale = 1.0
+        self.pressure = self.usage_mb > self.high_watermark_mb
+        self.pause_expired = False  # Whether the last pause timed out, so that intake is not paused again until relief
+        self.checked = time.monotonic()
+        self.lock = threading.Lock()    # The service checks the memory from several request threads
+        self.counters = {"peak_mb": self.usage_mb, "shrinks": 0, "pauses": 0, "paused_s": 0.0}
+
+    def check(self, force: bool = False) -> bool:
+        """
+        Measures the memory, unless measured less than check_interval ago, and updates the chunk scale.
+
+        :param force: whether to measure even if the last measure is recent.
+        :return: whether the memory is above the high watermark.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if not force and now - self.checked < self.check_interval:
+                return self.pressure
+            self.checked = now
+            self.usage_mb = get_tree_rss_mb()
+            self.counters["peak_mb"] = max(self.counters["peak_mb"], self.usage_mb)
+
+            self.pressure = self.usage_mb > self.high_watermark_mb
+            if self.pressure and self.scale > MIN_CHUNK_SCALE:
+                self.scale = max(MIN_CHUNK_SCALE, self.scale / 2)
+                self.counters["shrinks"] += 1
+            elif self.usage_mb < self.low_watermark_mb:
+                self.scale = min(1.0, self.scale * 2)
+                self.pause_expired = False
+            return self.pressure
+
+    def chunk_size(self, size: int) -> int:
+        """Number of items to process in the next chunk instead of size, given the memory pressure seen so far."""
+        return max(1, int(size * self.scale))
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Pauses intake while the memory is above the high watermark, releasing free memory and waiting for the work in
+        progress to complete, for at most pause_timeout. After a pause timed out, intake is not paused again until the
+        memory drops below the low watermark, so that processing goes on (with shrunk chunks) rather than stalling.
+
+        :param timeout: maximum time in seconds to pause instead of pause_timeout.
+        :return: whether the memory is below the high watermark.
+        """
+        if not self.check() or self.pause_expired:
+            return not self.pressure
+        timeout = self.pause_timeout if timeout is None else timeout
+        start = time.monotonic()
+        self.counters["pauses"] += 1
+        release_free_memory()
+        while self.check(force=True) and time.monotonic() - start < timeout:
+            time.sleep(self.check_interval)
+        self.counters["paused_s"] += time.monotonic() - start
+
+        if self.pressure:
+            self.pause_expired = True
+            print(f"Warning: memory still above the high watermark ({self.usage_mb:.0f} MB > {self.high_watermark_mb:.0f} MB) "
+                  f"after pausing {timeout} s.", file=sys.stderr)
+        return not self.pressure
+
+    def stats(self) -> dict:
+        """Current and peak memory, watermarks and number of actions taken."""
+        return {"usage_mb": self.usage_mb,
+                "high_watermark_mb": self.high_watermark_mb,
+                "low_watermark_mb": self.low_watermark_mb,
+                "chunk_scale": self.scale,
+                **self.counters}
+
+
+class SpillList:
+    """
+    List of results to which slices are appended, which can be spilled to an anonymous temporary file (deleted when
+    closed, and already unlinked on POSIX systems) so that the memory they use is available to the work in progress.
+    """
+
+    def __init__(self, spill_dir: str = MEMORY_SPILL_DIR):
+        """
+        :param spill_dir: folder of the temporary file. If None, the system temporary folder.
+        """
+        self.spill_dir = spill_dir
+        self.items = []
+        self.file = None
+        self.spilled = 0
+
+    def __len__(self) -> int:
+        return self.spilled + len(self.items)
+
+    def extend(self, items: list) -> None:
+        self.items.extend(items)
+
+    def spill(self) -> None:
+        """Moves the items held in memory to the temporary file."""
+        if not self.items:
+            return
+        if self.file is None:
+            self.file = tempfile.TemporaryFile(dir=self.spill_dir)
+        pickle.dump(self.items, self.file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.spilled += len(self.items)
+        self.items = []
+
+    def to_list(self) -> list:
+        """Returns all the items in order, reading back the spilled ones and deleting the temporary file."""
+        if self.file is None:
+            return self.items
+        items = []
+        self.file.seek(0)
+        while True:
+            try:
+                items += pickle.load(self.file)
+            except EOFError:
+                break
+        self.file.close()
+        self.file, self.spilled, self.items = None, 0, items + self.items
+        return self.items
+
+
+def memory_zone(nlp: Language, enabled: bool = None):
+    """
+    Context manager in which the strings added to the vocab, and the memory pools of the docs created, are released
+    on exit (see spacy.Language.memory_zone). Docs created inside it must not be used outside of it.
+    If enabled is None, VOCAB_RECYCLING is used.
+    """
+    return nlp.memory_zone() if _is_enabled(enabled) else nullcontext()
+
+
+def process_in_memory_zones(nlp: Language,
+                            items: list,
+                            process: Callable[[list, int], list],
+                            enabled: bool = None,
+                            max_docs: int = VOCAB_RECYCLE_DOCS,
+                            max_rss_mb: float = VOCAB_RECYCLE_RSS_MB,
+                            check_every: int = VOCAB_RSS_CHECK_DOCS,
+                            governor: MemoryGovernor = None,
+                            max_chars: int = None) -> list:
+    """
+    Applies a processing function to consecutive slices of the given items inside spaCy memory zones, so that the
+    vocab and the string store of a long-running process do not grow without bound. A memory zone is closed and a new
+    one opened after max_docs items, or earlier as soon as the resident memory exceeds max_rss_mb. The transformer
+    weights and the rest of the pipeline are kept loaded.
+    With a memory governor, the memory of the process and its workers is checked after each slice: above the high
+    watermark, the results of the finished slices are spilled to disk, the memory zone is closed early and the next
+    slices are shrunk, and intake is paused until the memory drops.
+
+    :param nlp: loaded spaCy Language model used by the processing function.
+    :param items: items to process (e.g. texts).
+    :param process: function receiving a slice of items and the index of its first item, returning a list of results
+                    which must not reference docs or spans created inside the memory zone.
+    :param enabled: whether to use memory zones. If False, all the items are processed with a single call (unless a
+                    governor is given). If None, VOCAB_RECYCLING is used.
+    :param max_docs: maximum number of items processed in the same memory zone.
+    :param max_rss_mb: resident memory in MB beyond which the current memory zone is closed early. If None, only max_docs is used.
+    :param check_every: number of items processed between two checks of the resident memory (before shrinking).
+    :param governor: optional memory governor adapting the slices to the memory pressure.
+    :param max_chars: maximum total length of the items (texts) of a slice, shrunk by the governor under pressure.
+                      If None, slices are only limited by their number of items.
+    :return: the concatenated results of the processing function.
+    """
+    if not _is_enabled(enabled) and governor is None:
+        return process(items, 0)
+
+    zone = nlp.memory_zone if _is_enabled(enabled) else nullcontext
+    step = min(check_every, max_docs) if max_rss_mb or governor else max_docs
+    results, i = SpillList(), 0
+    while i < len(items):
+        zone_start = i
+        with zone():
+            while i < len(items) and i - zone_start < max_docs:
+                if governor: governor.wait()
+                size = min(step, max_docs - (i - zone_start))
+                if governor: size = governor.chunk_size(size)
+                if max_chars: size = _fit_length(items, i, size, governor.chunk_size(max_chars) if governor else max_chars)
+                results.extend(process(items[i:i + size], i))
+                i += size
+                if max_rss_mb and get_rss_mb() > max_rss_mb: break
+                if governor and governor.check():
+                    results.spill()
+                    break
+    return results.to_list()
+
+
+def _fit_length(items: list, start: int, size: int, max_length: int) -> int:
+    """Number of items from start, at most size and at least one, whose total length does not exceed max_length."""
+    n, length = 0, 0
+    while n < size and start + n < len(items):
+        length += len(items[start + n])
+        if length > max_length and n > 0: break
+        n += 1
+    return n
+
+
+def _is_enabled(enabled: bool | None) -> bool:
+    # Read at call time, so that the setting can be changed on the module by long-running processes and benchmarks
+    return VOCAB_RECYCLING if enabled is None else enabled
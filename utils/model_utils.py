@@ -0,0 +1,181 @@
+import os
+import sys
+
+import spacy
+from spacy import Language
+from spacy.tokens import Doc
+from spacy_transformers.span_getters import configure_strided_spans
+
+from config import DEFAULT_NER_MODEL, DEFAULT_INFERENCE_PROFILE, \
+    TRANSFORMER_BACKEND, ONNX_TRANSFORMER_DIR, STRIP_TRF_DATA, SNAPSHOT_TRANSFORMER_DIR, USE_MODEL_SNAPSHOT
+from utils.path_utils import get_resource_path
+from utils.profile_utils import get_inference_profile, get_profile_per_matching
+
+QUANTIZATION_META_KEY = "transformer_quantization"     # Key of meta.json marking models whose transformer is quantized at load time
+DYNAMIC_INT8 = "dynamic_int8"
+BACKEND_META_KEY = "transformer_backend"
+ONNX_THREADS_META_KEY = "onnx_threads"                 # Key of the meta set to the ONNX Runtime threads of models loaded with the ONNX backend
+PYTORCH_BACKEND = "pytorch"
+ONNX_BACKEND = "onnx"
+STRIP_TRF_DATA_COMPONENT = "strip_trf_data"
+
+_preloaded_models = []      # Models loaded before forking worker processes, reused by them (see load_worker_model)
+
+
+@Language.component(STRIP_TRF_DATA_COMPONENT)
+def strip_trf_data(doc: Doc) -> Doc:
+    """
+    Drops the transformer output (wordpiece tensors and alignment) of a doc once the ner component has used it,
+    so that downstream stages, worker processes and pickled docs only carry the text and the entities.
+    """
+    if Doc.has_extension("trf_data"):
+        doc._.trf_data = None
+    return doc
+
+
+def apply_inference_profile(nlp: Language, profile: str = None) -> Language:
+    """
+    Overrides span-getter window/stride and batch sizes of a loaded pipeline according to the given inference profile.
+    The model folder is left untouched, so the same model can be loaded with different profiles.
+
+    :param nlp: loaded spaCy Language model with a transformer component.
+    :param profile: name of the inference profile to apply. If None, the default profile is applied.
+    :return: the same Language model, for chaining.
+    """
+    settings = get_inference_profile(profile)
+    nlp.batch_size = settings["batch_size"]
+
+    if "transformer" in nlp.pipe_names:
+        trf = nlp.get_pipe("transformer")
+        trf.model.attrs["get_spans"] = configure_strided_spans(settings["window"], settings["stride"])
+        trf.cfg["max_batch_items"] = settings["max_batch_items"]
+
+    nlp.meta["inference_profile"] = profile or DEFAULT_INFERENCE_PROFILE
+    return nlp
+
+
+def get_model_name(nlp: Language) -> str:
+    """Name identifying a loaded spaCy model, based on its folder and meta information."""
+    folder = os.path.basename(str(nlp.path)) if getattr(nlp, "path", None) else ""
+    return f"{folder or nlp.meta.get('name', 'pipeline')}-{nlp.meta.get('version', '0.0.0')}"
+
+
+def get_model_version(nlp: Language) -> str:
+    """Identifier of a loaded spaCy model together with the load-time settings that affect its predictions."""
+    return "|".join([get_model_name(nlp),
+                     nlp.meta.get("inference_profile", DEFAULT_INFERENCE_PROFILE),
+                     nlp.meta.get(QUANTIZATION_META_KEY, "float32"),
+                     nlp.meta.get(BACKEND_META_KEY, PYTORCH_BACKEND)])
+
+
+def get_model_load_args(nlp: Language, n_threads: int = None) -> dict:
+    """
+    Arguments of load_model reproducing the given loaded model in another process.
+
+    :param nlp: loaded spaCy Language model.
+    :param n_threads: number of ONNX Runtime threads of the copy, e.g. threads_per_process of the CPU plan for the
+                      worker processes (see utils.cpu_utils.plan_cpu_usage). If None, the ones of the given model.
+    """
+    backend = nlp.meta.get(BACKEND_META_KEY, PYTORCH_BACKEND)
+    return {"path": str(nlp.path),
+            "profile": nlp.meta.get("inference_profile"),
+            "backend": backend,
+            "strip_trf": STRIP_TRF_DATA_COMPONENT in nlp.pipe_names,
+            "n_threads": n_threads or nlp.meta.get(ONNX_THREADS_META_KEY) if backend == ONNX_BACKEND else None}
+
+
+def _set_torch_transformer(nlp: Language, module) -> None:
+    """Replaces the PyTorch module wrapped by the transformer component of the given pipeline."""
+    shim = nlp.get_pipe("transformer").model.layers[0].shims[0]
+    shim._model = module
+    shim._hfmodel.transformer = module
+
+
+def quantize_transformer(nlp: Language) -> Language:
+    """
+    Applies dynamic int8 quantization to the linear layers of the transformer component, which dominate CPU inference
+    time. Weights are quantized once, while activations are quantized on the fly at each forward pass.
+    The quantized pipeline is meant for inference on CPU only and must not be saved back with nlp.to_disk.
+    """
+    import torch
+    from torch.ao.quantization import quantize_dynamic
+
+    transformer = nlp.get_pipe("transformer").model.transformer.eval()
+    _set_torch_transformer(nlp, quantize_dynamic(transformer, {torch.nn.Linear}, dtype=torch.qint8))
+    return nlp
+
+
+def add_strip_trf_data(nlp: Language) -> Language:
+    """Adds the component dropping the transformer output right after the ner component, if not already present."""
+    if "ner" in nlp.pipe_names and STRIP_TRF_DATA_COMPONENT not in nlp.pipe_names:
+        nlp.add_pipe(STRIP_TRF_DATA_COMPONENT, after="ner")
+    return nlp
+
+
+def load_model(path: str = DEFAULT_NER_MODEL,
+               profile: str = None,
+               backend: str = TRANSFORMER_BACKEND,
+               strip_trf: bool = STRIP_TRF_DATA,
+               n_threads: int = None) -> Language:
+    """
+    Loads the spaCy model at the given path (relative to the project root) applying the given inference profile.
+    Models marked as quantized in their meta.json get their transformer quantized right after loading.
+    With the PyTorch backend, models with an up-to-date snapshot (see optimize_model.py snapshot) get their
+    transformer weights memory-mapped from it instead of deserialized.
+
+    :param path: path of the spaCy model.
+    :param profile: name of the inference profile to apply. If None, the default profile is applied.
+    :param backend: backend running the transformer, "pytorch" or "onnx". If the ONNX backend cannot be loaded
+                    (missing onnxruntime or exported transformer), the PyTorch backend is used instead.
+    :param strip_trf: whether to drop the transformer output from the docs right after the ner component.
+    :param n_threads: number of ONNX Runtime intra-op threads, with the ONNX backend. If None, ONNX Runtime chooses it.
+    :return: the loaded Language model.
+    """
+    path = get_resource_path(path)
+    nlp = None
+
+    if backend == ONNX_BACKEND:
+        try:
+            from utils.onnx_utils import load_onnx_model
+            nlp = load_onnx_model(path, os.path.join(path, ONNX_TRANSFORMER_DIR), n_threads)
+            nlp.meta[ONNX_THREADS_META_KEY] = n_threads
+        except Exception as e:
+            print(f"Warning: ONNX backend not available ({e}), falling back to PyTorch.", file=sys.stderr)
+    elif backend != PYTORCH_BACKEND:
+        raise ValueError(f"Unknown transformer backend '{backend}'. Available backends: {[PYTORCH_BACKEND, ONNX_BACKEND]}.")
+    elif USE_MODEL_SNAPSHOT and os.path.isdir(os.path.join(path, SNAPSHOT_TRANSFORMER_DIR)):
+        try:
+            from utils.snapshot_utils import load_snapshot_model, is_snapshot_current
+            snapshot_dir = os.path.join(path, SNAPSHOT_TRANSFORMER_DIR)
+            if is_snapshot_current(path, snapshot_dir):
+                nlp = load_snapshot_model(path, snapshot_dir)
+            else:
+                print(f"Warning: model snapshot in '{snapshot_dir}' is outdated, re-create it with 'optimize_model.py snapshot'.", file=sys.stderr)
+        except Exception as e:
+            print(f"Warning: model snapshot not loadable ({e}), loading the model from its folder.", file=sys.stderr)
+
+    if nlp is None:
+        nlp = spacy.load(path)
+    if nlp.meta.get(BACKEND_META_KEY) != ONNX_BACKEND and nlp.meta.get(QUANTIZATION_META_KEY) == DYNAMIC_INT8:
+        quantize_transformer(nlp)
+    if strip_trf:
+        add_strip_trf_data(nlp)
+    return apply_inference_profile(nlp, profile)
+
+
+def preload_model(nlp: Language) -> None:
+    """Registers a loaded model to be reused by the worker processes forked afterwards, instead of loading their own copy."""
+    _preloaded_models.append(nlp)
+
+
+def load_worker_model(model_args: dict) -> Language:
+    """
+    Model of a worker process: the model preloaded with the same load arguments by the process it was forked from
+    (parent process or forkserver), whose weights are shared copy-on-write, or else a new copy loaded with load_model.
+
+    :param model_args: arguments of load_model (see get_model_load_args).
+    """
+    for nlp in _preloaded_models:
+        if get_model_load_args(nlp) == model_args:
+            return nlp
+    return load_model(**model_args)
@@ -1,6 +1,19 @@
+import os
+import time
+import platform
+from typing import Iterator
+
 import psutil
+from spacy import Language
+from spacy.tokens import Doc
+
+from config import P_CORES, TUNING_WARMUP_BATCHES, TUNING_MIN_BATCH_CHARS, TUNING_LENGTH_TOLERANCE, TUNING_PROFILES_PATH
+from utils.json_utils import read_json_file, save_json_file
+
+GB = 1024 ** 3
+OS_RESERVED_RAM_GB = 2          # Safety buffer: RAM left to the OS when sizing batches and processes
+MAX_BATCH_SIZE = 1024           # Cap on the number of texts per batch, to keep latency reasonable
 
-from config import P_CORES
 
 def estimate_spacy_params(texts: list[str], p_cores: int = P_CORES, model_size_gb: float = 0.5):
     """
@@ -12,15 +25,180 @@ def estimate_spacy_params(texts: list[str], p_cores: int = P_CORES, model_size_g
     :param model_size_gb: Estimated size of the loaded spaCy model in GB.
     :return: Tuple of (n_process, batch_size).
     """
-    n_process = max(1, p_cores - 1)
-    available_ram_gb = psutil.virtual_memory().available / (1024 ** 3)
-    usable_ram = max(1, available_ram_gb - (model_size_gb*n_process) - 2)  # Safety buffer: leave 2GB for the OS
+    n_process = max(1, (p_cores or os.cpu_count() or 1) - 1)
+    available_ram_gb = psutil.virtual_memory().available / GB
+    usable_ram = max(1, available_ram_gb - (model_size_gb*n_process) - OS_RESERVED_RAM_GB)
     batch_size = int((usable_ram / n_process) * _density_factor(texts))
 
-    return n_process, min(batch_size, 1024)  # Cap at 1024 to keep latency reasonable
+    return n_process, max(1, min(batch_size, MAX_BATCH_SIZE))
 
 
 def _density_factor(texts: list[str]):
     """Compute a density factor for texts to adjust batch sizes based on average text length."""
-    avg_len = sum(len(t) for t in texts) / len(texts)
-    return 150000 / avg_len
\ No newline at end of file
+    return 150000 / _average_length(texts)
+
+
+def _average_length(texts: list[str]) -> float:
+    """Average number of characters of the given texts, at least 1 to be safely used as a divisor."""
+    return max(1.0, sum(len(t) for t in texts) / len(texts)) if texts else 1.0
+
+
+def _current_rss() -> int:
+    """Resident set size in bytes of the current process."""
+    return psutil.Process().memory_info().rss
+
+
+class ThroughputTuner:
+    """
+    Adaptive tuner for the n_process and batch_size parameters of spaCy's nlp.pipe.
+
+    The first batches are processed in the current process with increasing batch sizes, measuring docs/sec, chars/sec
+    and RSS growth for each of them. The fastest batch size is then kept, and the number of processes is chosen so that
+    all workers fit in the available memory. The warm-up goes on across calls of pipe, so that the same tuner can be
+    fed consecutive slices of the texts (e.g. by process_in_memory_zones). The learned profile is saved for the current
+    machine and model by finish, only if the whole warm-up was measured on batches of at least TUNING_MIN_BATCH_CHARS
+    characters, so later runs on texts of similar length (see TUNING_LENGTH_TOLERANCE) skip the warm-up and start from
+    the tuned parameters.
+    """
+
+    def __init__(self,
+                 texts: list[str],
+                 model_name: str,
+                 max_processes: int = 1,
+                 warmup_batches: int = TUNING_WARMUP_BATCHES,
+                 profiles_path: str = TUNING_PROFILES_PATH):
+        """
+        :param texts: the texts that will be processed, used to compute the average text length.
+        :param model_name: name identifying the loaded model, used as part of the profile key.
+        :param max_processes: maximum number of processes that can be used by nlp.pipe.
+        :param warmup_batches: number of batches to measure before settling on the final parameters.
+        :param profiles_path: path of the JSON file where tuned profiles are stored.
+        """
+        self.avg_len = _average_length(texts)
+        self.max_processes = max(1, max_processes)
+        self.warmup_batches = warmup_batches
+        self.profiles_path = os.path.expanduser(profiles_path)
+        self.key = f"{platform.node()}|{os.cpu_count()}cpu|{round(psutil.virtual_memory().total / GB)}gb|{model_name}"
+        self.measurements = []
+        self.warmup_step = 0        # Index of the next warm-up batch
+        self.n_texts = 0            # Texts processed by pipe so far
+        self.started = None         # Time of the first call of pipe
+
+        self.profile = self._load_profiles().get(self.key)
+        if self.profile and not self._matches_length(self.profile):
+            self.profile = None     # Tuned on texts of a different length, or saved before the length was recorded
+        if self.profile:
+            self.chars_per_batch = self.profile["chars_per_batch"]
+            self.n_process = max(1, min(self.profile["n_process"], self.max_processes))
+        else:
+            n_process, batch_size = estimate_spacy_params(texts, self.max_processes + 1)
+            self.chars_per_batch = batch_size * self.avg_len
+            self.n_process = min(n_process, self.max_processes)
+        self.base_size = self.batch_size    # Batch size around which the warm-up batch sizes are chosen
+
+    @property
+    def batch_size(self) -> int:
+        """Number of texts per batch corresponding to the tuned amount of characters per batch."""
+        return max(1, min(int(self.chars_per_batch / self.avg_len), MAX_BATCH_SIZE))
+
+    @property
+    def settled(self) -> bool:
+        """Whether the parameters are final: loaded from a profile, or all the warm-up batches were measured."""
+        return bool(self.profile) or self.warmup_step >= self.warmup_batches
+
+    @property
+    def tuned(self) -> bool:
+        """Whether the parameters are worth saving: loaded from a profile, or tuned on a whole warm-up of batches
+        large enough to be measured reliably."""
+        return bool(self.profile) or (self.warmup_step >= self.warmup_batches
+                                      and all(m["chars"] >= TUNING_MIN_BATCH_CHARS for m in self.measurements))
+
+    def pipe(self, nlp: Language, texts: list[str]) -> Iterator[Doc]:
+        """
+        Processes the given texts with nlp.pipe, tuning its parameters on the first batches if no profile is
+        available for the current machine and model. Docs are yielded in the same order of the input texts.
+        """
+        if self.started is None: self.started = time.perf_counter()
+        position = 0
+
+        while not self.settled and position < len(texts):
+            size = max(1, int(self.base_size * 2 ** (self.warmup_step - self.warmup_batches // 2)))
+            batch = texts[position:position + size]
+            if position > 0 and len(batch) < max(1, size // 2):
+                # Too few texts left in this call for a meaningful measurement. A call with fewer texts than the batch
+                # size (e.g. a slice of process_in_memory_zones) is still measured, as no larger batch can be used.
+                position += len(batch)
+                yield from nlp.pipe(batch, batch_size=size)
+                continue
+            position += len(batch)
+
+            rss_before = _current_rss()
+            batch_start = time.perf_counter()
+            docs = list(nlp.pipe(batch, batch_size=size))
+            elapsed = max(time.perf_counter() - batch_start, 1e-6)
+
+            self.measurements.append({
+                "chars": sum(len(t) for t in batch),
+                "docs_per_sec": len(batch) / elapsed,
+                "chars_per_sec": sum(len(t) for t in batch) / elapsed,
+                "rss": rss_before,
+                "rss_growth": max(0, _current_rss() - rss_before),
+            })
+            self.warmup_step += 1
+            if self.settled: self._settle()
+            yield from docs
+
+        remaining = texts[position:]
+        if remaining:
+            yield from nlp.pipe(remaining,
+                                n_process=self.n_process if len(remaining) > self.batch_size else 1,
+                                batch_size=self.batch_size)
+        self.n_texts += len(texts)
+
+    def finish(self) -> None:
+        """Saves the profile together with the throughput observed since the first call of pipe, unless the texts were
+        too few or too short to tune the parameters reliably."""
+        if self.started is not None and self.tuned:
+            self._save_profile(self.n_texts, time.perf_counter() - self.started)
+
+    def _matches_length(self, profile: dict) -> bool:
+        """Whether a profile was tuned on texts of about the same average length as the current ones."""
+        tuned_len = profile.get("avg_len")
+        return bool(tuned_len) and 1 / TUNING_LENGTH_TOLERANCE <= self.avg_len / tuned_len <= TUNING_LENGTH_TOLERANCE
+
+    def _settle(self) -> None:
+        """Keeps the batch size with the best throughput and the largest number of processes fitting in memory."""
+        if not self.measurements:
+            return
+
+        best = max(self.measurements, key=lambda m: m["chars_per_sec"])
+        self.chars_per_batch = best["chars"]
+
+        # Each spawned worker holds its own copy of the model (approximated by the RSS of this process) plus its batch
+        per_worker = best["rss"] + best["rss_growth"]
+        usable_ram = psutil.virtual_memory().available - OS_RESERVED_RAM_GB * GB
+        self.n_process = max(1, min(self.max_processes, int(usable_ram // max(per_worker, 1))))
+
+    def _load_profiles(self) -> dict:
+        try:
+            return read_json_file(self.profiles_path)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_profile(self, n_texts: int, elapsed: float) -> None:
+        """Stores the tuned parameters together with the throughput observed on the whole run."""
+        profiles = self._load_profiles()
+        profiles[self.key] = {
+            "chars_per_batch": int(self.chars_per_batch),
+            "n_process": self.n_process,
+            "avg_len": self.profile["avg_len"] if self.profile else self.avg_len,   # Length the parameters were tuned on
+            "docs_per_sec": n_texts / max(elapsed, 1e-6),
+            "chars_per_sec": n_texts * self.avg_len / max(elapsed, 1e-6),
+            "updated": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        try:
+            os.makedirs(os.path.dirname(self.profiles_path), exist_ok=True)
+            save_json_file(self.profiles_path, profiles)
+        except OSError:
+            pass  # Tuning profiles are an optimization: failing to persist them must not fail the anonymization
+
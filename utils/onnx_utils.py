@@ -0,0 +1,110 @@
+import os
+from pathlib import Path
+
+import spacy
+import torch
+from spacy import Language
+from spacy_transformers.data_classes import HFObjects
+from transformers import AutoConfig, AutoTokenizer
+from transformers.modeling_outputs import BaseModelOutput
+
+ONNX_MODEL_FILE = "model.onnx"
+ONNX_INPUT_NAMES = ["input_ids", "attention_mask", "token_type_ids"]
+
+
+class OnnxTransformer(torch.nn.Module):
+    """
+    Drop-in replacement of the HuggingFace transformer wrapped by the spaCy transformer component, running an
+    exported ONNX graph with ONNX Runtime on CPU. It returns the same last_hidden_state output, so the
+    TransformerListener of the ner component receives the usual tensors.
+    """
+
+    def __init__(self, onnx_dir: str | Path, n_threads: int = None):
+        super().__init__()
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if n_threads:
+            options.intra_op_num_threads = n_threads
+        self.session = ort.InferenceSession(os.path.join(onnx_dir, ONNX_MODEL_FILE), options,
+                                            providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        self.config = AutoConfig.from_pretrained(onnx_dir)
+
+    @property
+    def device(self) -> torch.device:
+        return torch.device("cpu")
+
+    def forward(self, input_ids, attention_mask, token_type_ids=None) -> BaseModelOutput:
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask, "token_type_ids": token_type_ids}
+        if token_type_ids is None:
+            inputs["token_type_ids"] = torch.zeros_like(input_ids)
+        feed = {name: inputs[name].cpu().numpy().astype("int64") for name in self.input_names}
+        last_hidden_state = self.session.run(["last_hidden_state"], feed)[0]
+        return BaseModelOutput(last_hidden_state=torch.from_numpy(last_hidden_state))
+
+
+def export_transformer_to_onnx(nlp: Language, output_dir: str | Path, opset: int = 17) -> str:
+    """
+    Exports the HuggingFace model wrapped by the transformer component to ONNX, together with its configuration and
+    tokenizer, so that it can be loaded without deserializing the PyTorch weights.
+
+    :param nlp: loaded spaCy Language model with a transformer component.
+    :param output_dir: folder where to save the ONNX graph, the configuration and the tokenizer.
+    :param opset: ONNX opset version to export to.
+    :return: the path of the exported folder.
+    """
+    trf = nlp.get_pipe("transformer").model
+    transformer = trf.transformer.eval()
+    os.makedirs(output_dir, exist_ok=True)
+
+    dummy = trf.tokenizer(["Mario Rossi vive a Roma."], return_tensors="pt", return_token_type_ids=True)
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in ONNX_INPUT_NAMES + ["last_hidden_state"]}
+
+    class _LastHiddenState(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask, token_type_ids):
+            return self.model(input_ids=input_ids, attention_mask=attention_mask,
+                              token_type_ids=token_type_ids).last_hidden_state
+
+    with torch.no_grad():
+        torch.onnx.export(_LastHiddenState(transformer),
+                          tuple(dummy[name] for name in ONNX_INPUT_NAMES),
+                          os.path.join(output_dir, ONNX_MODEL_FILE),
+                          input_names=ONNX_INPUT_NAMES,
+                          output_names=["last_hidden_state"],
+                          dynamic_axes=dynamic_axes,
+                          opset_version=opset,
+                          dynamo=False)
+
+    transformer.config.save_pretrained(output_dir)
+    trf.tokenizer.save_pretrained(output_dir)
+    return str(output_dir)
+
+
+def load_onnx_model(model_path: str | Path, onnx_dir: str | Path, n_threads: int = None) -> Language:
+    """
+    Loads a spaCy model whose transformer runs on ONNX Runtime. The pipeline is built from the model configuration and
+    every component except the transformer is deserialized from disk, so the PyTorch transformer weights are never
+    loaded. The transformer component is then set with the exported tokenizer and the ONNX graph.
+
+    :param model_path: path of the spaCy model.
+    :param onnx_dir: folder containing the transformer exported by export_transformer_to_onnx.
+    :param n_threads: number of ONNX Runtime intra-op threads. If None, ONNX Runtime chooses it.
+    :return: the loaded Language model.
+    """
+    model_path = Path(model_path)
+    config = spacy.util.load_config(model_path / "config.cfg")
+    meta = spacy.util.load_meta(model_path / "meta.json")
+    nlp = spacy.util.load_model_from_config(config, meta=meta)
+    nlp.from_disk(model_path, exclude=["transformer"])
+
+    trf = nlp.get_pipe("transformer")
+    tokenizer = AutoTokenizer.from_pretrained(onnx_dir, use_fast=True)
+    trf.model.attrs["set_transformer"](trf.model, HFObjects(tokenizer, OnnxTransformer(onnx_dir, n_threads), None))
+    nlp.meta["transformer_backend"] = "onnx"
+    return nlp
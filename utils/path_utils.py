@@ -1,3 +1,4 @@
+import os
 import sys
 import uuid
 from pathlib import Path
@@ -8,6 +9,22 @@ def get_resource_path(relative_path):
     PROJECT_ROOT = Path(sys._MEIPASS) if hasattr(sys, "_MEIPASS") else Path(__file__).resolve().parents[1]
     return PROJECT_ROOT / relative_path
 
+def list_input_files(paths: list[str]) -> list[str]:
+    """Returns the given files and the files contained in the given folders (not recursively), warning about the
+    paths that are neither."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for filename in os.listdir(path):
+                full_path = os.path.join(path, filename)
+                if os.path.isfile(full_path):
+                    files.append(full_path)
+        elif os.path.isfile(path):
+            files.append(path)
+        else:
+            print(f"Warning: '{path}' is not valid.", file=sys.stderr)
+    return files
+
 def get_file_name_from_anagrafica(anagrafica, add_random_suffix=False):
     """
     Provides a safe filename based on the anagrafica information, prioritizing idAna, then cognome, and adding a
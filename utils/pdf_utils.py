@@ -2,16 +2,15 @@ import io
 from pathlib import Path
 from typing import IO, Any
 
-import boto3
-import pdfplumber
-from pypdf import PdfReader
 from collections import Counter, defaultdict
 import statistics
 import re
 
 from config import PDF_BUCKET_NAME
+from utils.timing_utils import timed_stage, PDF_EXTRACTION_STAGE, S3_FETCH_STAGE
 
 
+@timed_stage(PDF_EXTRACTION_STAGE)
 def extract_structured_text(
         pdf_path: str | IO[Any] | Path,
         big_font_ratio=1.05,
@@ -33,6 +32,8 @@ def extract_structured_text(
     :return: A string containing the extracted body text from the PDF, with non-body elements filtered out.
     """
 
+    import pdfplumber
+
     # Detect digital signature rectangles once
     digital_signature_rects = detect_digital_signature_rectangles(pdf_path)
 
@@ -307,6 +308,8 @@ def detect_signature_images(page, position_bias:bool = False):
     return candidates
 
 def detect_digital_signature_rectangles(pdf_path: str | IO[Any] | Path):
+    from pypdf import PdfReader
+
     reader = PdfReader(pdf_path)
     signature_rects = []
 
@@ -431,6 +434,7 @@ def merge_lines(lines):
 
     return "\n".join(merged)
 
+@timed_stage(S3_FETCH_STAGE)
 def read_pdf_from_s3(pdf_key:str, bucket_name:str = PDF_BUCKET_NAME) -> io.BytesIO:
     """
     Reads a PDF file from an S3 bucket and returns its content as bytes.
@@ -438,6 +442,8 @@ def read_pdf_from_s3(pdf_key:str, bucket_name:str = PDF_BUCKET_NAME) -> io.Bytes
     :param bucket_name: The name of the S3 bucket where the PDF file is stored. Defaults to PDF_BUCKET_NAME from config.
     :return: A BytesIO stream object containing the PDF file's content
     """
+    import boto3
+
     s3 = boto3.client('s3')
     response = s3.get_object(Bucket=bucket_name, Key=pdf_key)
 
@@ -0,0 +1,66 @@
+import gc
+import os
+import json
+import multiprocessing as mp
+from typing import TYPE_CHECKING
+
+from config import MP_START_METHOD
+from utils.path_utils import get_resource_path
+
+if TYPE_CHECKING:
+    from spacy import Language
+
+SPAWN = "spawn"
+FORKSERVER = "forkserver"
+FORK = "fork"
+PRELOAD_ENV_VAR = "ANONYMIZER_FORKSERVER_PRELOAD"     # Model and rules to preload in the forkserver, as JSON
+
+
+def configure_start_method(method: str = MP_START_METHOD, model_args: dict = None, per_matching: int = 0) -> str:
+    """
+    Sets the start method of the worker processes. To be called once by the entry point, before any worker is started.
+    - "spawn": each worker starts a new interpreter, imports spaCy and torch and loads its own copy of the model.
+    - "forkserver": a server process loads the model and compiles the rules once, then forks the workers from itself,
+      so that the weights are shared copy-on-write. The server never runs inference, so no thread pools are forked.
+    - "fork": workers are forked from the current process, sharing the model it loaded (see share_with_workers).
+    Methods not available on the platform (forkserver and fork on Windows) fall back to spawn.
+
+    :param method: name of the start method.
+    :param model_args: arguments of load_model of the model used by the workers, preloaded by the forkserver. If None,
+                       only the rules are preloaded, e.g. when the workers receive the pipeline pickled by nlp.pipe.
+    :param per_matching: extra PER matching level of the rules compiled by the forkserver.
+    :return: the start method set.
+    """
+    if method not in mp.get_all_start_methods():
+        method = SPAWN
+    mp.set_start_method(method, force=True)
+
+    if method == FORKSERVER:
+        # The forkserver inherits the environment but not the sys.path of this process: the project root is added to
+        # its PYTHONPATH, so that utils.forkserver_preload is found whatever the working directory
+        root, paths = str(get_resource_path("")), [p for p in os.environ.get("PYTHONPATH", "").split(os.pathsep) if p]
+        if root not in paths: os.environ["PYTHONPATH"] = os.pathsep.join([root] + paths)
+        # Read by utils.forkserver_preload when imported by the forkserver, which inherits this environment
+        os.environ[PRELOAD_ENV_VAR] = json.dumps({"model_args": model_args, "per_matching": per_matching})
+        mp.set_forkserver_preload(["__main__", "utils.forkserver_preload"])
+    return method
+
+
+def share_with_workers(nlp: "Language", per_matching: int = 0) -> None:
+    """
+    With the fork start method, registers the loaded model to be reused by the workers forked afterwards and compiles
+    the rules they use, so that both are shared copy-on-write instead of being loaded again by each worker.
+    Does nothing with the other start methods.
+
+    :param nlp: loaded spaCy Language model.
+    :param per_matching: extra PER matching level of the rules to compile.
+    """
+    if mp.get_start_method(allow_none=True) != FORK:
+        return
+    from rules.rules import preload_rules
+    from utils.model_utils import preload_model
+
+    preload_model(nlp)
+    preload_rules(per_matching)
+    # Objects created so far are never collected, so the garbage collector does not dirty their shared pages
+    gc.freeze()
@@ -0,0 +1,15 @@
+from config import DEFAULT_INFERENCE_PROFILE, INFERENCE_PROFILES, DEFAULT_EXTRA_PER_MATCHING_LEVEL
+
+
+def get_inference_profile(profile: str = None) -> dict:
+    """Returns the settings of the given inference profile, or of the default one if None."""
+    profile = profile or DEFAULT_INFERENCE_PROFILE
+    if profile not in INFERENCE_PROFILES:
+        raise ValueError(f"Unknown inference profile '{profile}'. Available profiles: {list(INFERENCE_PROFILES.keys())}.")
+    return INFERENCE_PROFILES[profile]
+
+
+def get_profile_per_matching(profile: str = None) -> int:
+    """Returns the level of extra PER matching of the given inference profile, falling back to the default level."""
+    per_matching = get_inference_profile(profile)["per_matching"]
+    return DEFAULT_EXTRA_PER_MATCHING_LEVEL if per_matching is None else per_matching
@@ -0,0 +1,276 @@
+import os
+import sys
+import glob
+import queue
+import shutil
+import atexit
+import cProfile
+import tempfile
+import selectors
+import threading
+import contextlib
+import tracemalloc
+import multiprocessing as mp
+from collections import Counter
+from contextlib import ExitStack
+from multiprocessing import util, connection, queues, synchronize
+
+from config import PROFILE_MODE, PROFILE_SAMPLING_INTERVAL, PROFILE_MEMORY_FRAMES
+from utils import timing_utils
+from utils.json_utils import save_json_file
+from utils.timing_utils import PipelineMetrics, collect_pipeline_metrics, get_pipeline_metrics, READ_STAGE, \
+    S3_FETCH_STAGE, PDF_EXTRACTION_STAGE, NER_STAGE, RULES_STAGE, MERGE_STAGE, REPLACEMENT_STAGE, WRITE_STAGE
+
+SAMPLING = "sampling"
+DETERMINISTIC = "deterministic"
+PROFILE_DIR_ENV_VAR = "ANONYMIZER_PROFILE_DIR"  # Folder where worker processes write their samples, set while profiling
+MEMORY_STAGES = (RULES_STAGE, MERGE_STAGE)
+FLUSH_INTERVAL = 1.0        # Seconds between two writes of the samples of a worker, which can be terminated at any time
+OTHER_STAGE = "other"       # Samples of the main process outside of any stage (e.g. model loading)
+TOP_ALLOCATIONS = 20        # Number of allocation sites listed for each memory stage
+# Allocations of the profiler itself, made by its threads and stage context managers while the rules are traced
+_PROFILER_FILTERS = [tracemalloc.Filter(False, module.__file__) for module in (sys.modules[__name__], timing_utils, threading, contextlib, tracemalloc)]
+# Modules where threads wait for work, results or locks: samples whose innermost frame is in them are skipped, so that
+# idle workers and the main process waiting for them do not count as time spent in a stage
+_IDLE_FILES = {module.__file__ for module in (connection, queues, synchronize, selectors, threading, queue)}
+
+# Functions identifying the stage of the samples taken outside of timed stages, i.e. in worker processes (innermost
+# match first). The other samples of the workers are attributed to NER, which they run together with the rules.
+_STAGE_FUNCTIONS = {
+    "merged_entity_spans": MERGE_STAGE,
+    "_apply_rules": RULES_STAGE,
+    "anonymize_spans": REPLACEMENT_STAGE,
+    "read_pdf_from_s3": S3_FETCH_STAGE,
+    "extract_structured_text": PDF_EXTRACTION_STAGE,
+    "read_file": READ_STAGE,
+    "save_many_texts": WRITE_STAGE,
+}
+
+
+class StackSampler:
+    """
+    Sampling profiler: a background thread records the stack of a thread every interval seconds, counting the
+    distinct stacks in folded format ("stage;outer frame;...;inner frame"), whose first frame is the stage of the
+    pipeline the thread was in. Samples of the thread waiting (see _IDLE_FILES) are skipped.
+    """
+
+    def __init__(self,
+                 interval: float = PROFILE_SAMPLING_INTERVAL,
+                 metrics: PipelineMetrics = None,
+                 default_stage: str = OTHER_STAGE,
+                 output_path: str = None):
+        """
+        :param interval: time in seconds between two samples.
+        :param metrics: pipeline metrics collected by the sampled thread, giving the stage of each sample.
+        :param default_stage: stage of the samples outside of timed stages and of the functions in _STAGE_FUNCTIONS.
+        :param output_path: optional file where the samples are written every FLUSH_INTERVAL seconds and on stop.
+        """
+        self.interval = interval
+        self.metrics = metrics
+        self.default_stage = default_stage
+        self.output_path = output_path
+        self.counts = Counter()
+        self.thread_id = None
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+
+    def start(self) -> "StackSampler":
+        """Starts sampling the current thread."""
+        self.thread_id = threading.get_ident()
+        threading.Thread(target=self._run, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.flush()
+
+    def sample(self) -> None:
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return
+        if frame.f_code.co_filename in _IDLE_FILES:
+            return
+        stack = []
+        while frame is not None:
+            stack.append(frame.f_code)
+            frame = frame.f_back
+        stage = (self.metrics.current_stage(self.thread_id) if self.metrics is not None else None) or \
+            next((_STAGE_FUNCTIONS[code.co_name] for code in stack if code.co_name in _STAGE_FUNCTIONS), self.default_stage)
+        with self.lock:
+            self.counts[";".join([stage, *(_frame_name(code) for code in reversed(stack))])] += 1
+
+    def flush(self) -> None:
+        """Writes the samples to output_path, replacing the previous ones."""
+        if self.output_path is None:
+            return
+        with self.lock:
+            lines = [f"{stack} {count}\n" for stack, count in self.counts.items()]
+        try:
+            with open(self.output_path + ".tmp", "w", encoding="utf-8") as f:
+                f.writelines(lines)
+            os.replace(self.output_path + ".tmp", self.output_path)
+        except OSError:
+            pass    # Folder already removed by the main process, whose profile is complete
+
+    def _run(self) -> None:
+        flushed = 0.0
+        while not self.stopped.wait(self.interval):
+            self.sample()
+            flushed += self.interval
+            if flushed >= FLUSH_INTERVAL:
+                self.flush()
+                flushed = 0.0
+
+
+class RunProfiler:
+    """
+    Context manager profiling a run of the pipeline, worker processes included, for flamegraph tools:
+    - "sampling": the stacks of the current thread and of the worker processes started meanwhile are sampled and
+      saved as folded stacks (flamegraph.pl, inferno, speedscope), merged by stage of the pipeline;
+    - "deterministic": every call of the current thread is traced with cProfile and saved as a .pstats file
+      (snakeviz, flameprof, gprof2dot). Worker processes are not traced.
+    Pipeline metrics are collected meanwhile, if they are not already, so that samples can be attributed to stages.
+    With memory=True, the allocations of the rules and merge stages run by the current thread are traced with
+    tracemalloc (only while they run, after a first call building the dictionaries and regexes of the rules): the peak
+    of each call is recorded, with a snapshot of the allocations still alive at the end of the call with the highest peak.
+    """
+
+    def __init__(self, mode: str = PROFILE_MODE, memory: bool = False, interval: float = PROFILE_SAMPLING_INTERVAL):
+        """
+        :param mode: "sampling" or "deterministic".
+        :param memory: whether to trace the allocations of the rules and merge stages.
+        :param interval: time in seconds between two samples in sampling mode.
+        """
+        if mode not in (SAMPLING, DETERMINISTIC):
+            raise ValueError(f"Unknown profiling mode '{mode}', expected '{SAMPLING}' or '{DETERMINISTIC}'.")
+        self.mode = mode
+        self.memory = memory
+        self.interval = interval
+        self.metrics = None
+        self.sampler = None
+        self.profiler = None
+        self.worker_dir = None
+        self.worker_samples = Counter()
+        self.exit_stack = ExitStack()
+
+    def __enter__(self) -> "RunProfiler":
+        self.metrics = get_pipeline_metrics() or self.exit_stack.enter_context(collect_pipeline_metrics())
+        if self.memory:
+            self.metrics.memory_stages.update(MEMORY_STAGES)
+            self.metrics.memory_frames = PROFILE_MEMORY_FRAMES
+        if self.mode == SAMPLING:
+            # Inherited by the worker processes, which sample themselves (see _start_worker_sampler)
+            self.worker_dir = tempfile.mkdtemp(prefix="anonymizer_profile_")
+            os.environ[PROFILE_DIR_ENV_VAR] = self.worker_dir
+            self.sampler = StackSampler(self.interval, self.metrics).start()
+        else:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        if self.sampler is not None:
+            self.sampler.stop()
+            os.environ.pop(PROFILE_DIR_ENV_VAR, None)
+            for path in glob.glob(os.path.join(self.worker_dir, "*.folded")):
+                self.worker_samples += read_folded(path)
+            shutil.rmtree(self.worker_dir, ignore_errors=True)
+        if self.profiler is not None:
+            self.profiler.disable()
+        if self.memory:
+            self.metrics.memory_stages.difference_update(MEMORY_STAGES)
+        self.exit_stack.close()
+
+    def samples(self) -> Counter:
+        """Folded stacks of the current thread and of the workers, with their number of samples."""
+        return self.sampler.counts + self.worker_samples if self.sampler is not None else Counter()
+
+    def stage_shares(self) -> dict[str, float]:
+        """Share of the samples of each stage, workers included."""
+        stages = Counter()
+        for stack, count in self.samples().items():
+            stages[stack.split(";", 1)[0]] += count
+        total = sum(stages.values())
+        return {stage: count / total for stage, count in stages.most_common()} if total else {}
+
+    def save(self, output_prefix: str) -> list[str]:
+        """
+        Saves the profile in <output_prefix>_profile.folded (sampling) or <output_prefix>_profile.pstats
+        (deterministic), and the allocations of the memory stages in <output_prefix>_memory_profile.json, with the
+        snapshot of each stage in <output_prefix>_<stage>.tracemalloc (see tracemalloc.Snapshot.load).
+
+        :param output_prefix: path and base name of the output files.
+        :return: the paths of the saved files.
+        """
+        paths = []
+        if self.sampler is not None:
+            paths.append(f"{output_prefix}_profile.folded")
+            with open(paths[-1], "w", encoding="utf-8") as f:
+                f.writelines(f"{stack} {count}\n" for stack, count in sorted(self.samples().items()))
+        if self.profiler is not None:
+            paths.append(f"{output_prefix}_profile.pstats")
+            self.profiler.dump_stats(paths[-1])
+
+        if self.memory:
+            report = {}
+            for stage, peaks in self.metrics.memory_peaks.items():
+                peaks = sorted(peaks)
+                snapshot = self.metrics.memory_snapshots[stage].filter_traces(_PROFILER_FILTERS)
+                paths.append(f"{output_prefix}_{stage}.tracemalloc")
+                snapshot.dump(paths[-1])
+                report[stage] = {"calls": len(peaks),
+                                 "peak_kb_p50": peaks[len(peaks) // 2] / 1024,
+                                 "peak_kb_p95": peaks[min(len(peaks) - 1, int(0.95 * len(peaks)))] / 1024,
+                                 "peak_kb_max": peaks[-1] / 1024,
+                                 "top_allocations": [{"site": str(stat.traceback[0]), "size_kb": stat.size / 1024, "count": stat.count}
+                                                     for stat in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]]}
+            paths.append(f"{output_prefix}_memory_profile.json")
+            save_json_file(paths[-1], report)
+        return paths
+
+
+def read_folded(path: str) -> Counter:
+    """Reads a file of folded stacks, one "stack count" per line."""
+    counts = Counter()
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            stack, _, count = line.rstrip("\n").rpartition(" ")
+            if stack: counts[stack] += int(count)
+    return counts
+
+
+def _frame_name(code) -> str:
+    # Paths relative to the installed packages or the project, without the separators of the folded format
+    path = code.co_filename.replace("\\", "/")
+    for marker in ("site-packages/", "dist-packages/", "lib/python"):
+        if marker in path:
+            path = path.split(marker, 1)[1]
+            break
+    else:
+        path = os.path.relpath(path, _PROJECT_ROOT) if os.path.isabs(path) else path
+    return f"{code.co_name} ({path}:{code.co_firstlineno})".replace(";", ",")
+
+
+_PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_worker_sampler = None
+
+
+def _start_worker_sampler() -> None:
+    """Starts sampling a worker process started while a RunProfiler is active, writing its samples in its folder."""
+    global _worker_sampler
+    worker_dir = os.environ.get(PROFILE_DIR_ENV_VAR)
+    if not worker_dir or not os.path.isdir(worker_dir):
+        return
+    _worker_sampler = StackSampler(PROFILE_SAMPLING_INTERVAL, default_stage=NER_STAGE,
+                                   output_path=os.path.join(worker_dir, f"worker_{os.getpid()}.folded")).start()
+    # Workers usually exit through os._exit, which skips atexit but not the multiprocessing finalizers
+    util.Finalize(None, _worker_sampler.stop, exitpriority=0)
+    atexit.register(_worker_sampler.stop)
+
+
+# Spawned workers import this module (through the entry point or the worker functions) with the name of their process
+# already set, forked ones (fork and forkserver start methods) run the fork hook
+if mp.current_process().name != "MainProcess":
+    _start_worker_sampler()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_start_worker_sampler)
@@ -0,0 +1,289 @@
+import os
+import json
+import socket
+import threading
+import zlib
+from contextlib import contextmanager
+
+from config import PATIENT_DATA_FIELDS, QUEUE_LEASE_SECONDS, QUEUE_HEARTBEAT_SECONDS
+from utils.json_utils import read_json_file
+
+QUEUE_DIR = "_queue"        # Folder of the work queue, in the output folder shared by the nodes
+UNITS_FILE = "units.json"   # Work units of the queue, written once by the first node
+LEASES_DIR = "leases"       # Lease file of each unit being processed, created with O_EXCL by the node claiming it
+DONE_DIR = "done"           # Result of each unit processed
+FAILED_DIR = "failed"       # Error of each unit that could not be processed, not claimed again until deleted
+NODES_DIR = "nodes"         # Status of each node, with the time of its last update
+CLOCK_FILE = "clock"        # File touched to read the current time of the shared filesystem
+HEARTBEAT_RETRY_SECONDS = 1 # Delay before retrying a failed heartbeat, after which the lease is considered lost
+
+
+class WorkQueue:
+    """
+    Queue of work units (groups of input files) shared by nodes through a folder, without any other service.
+    A node claims a unit by creating its lease file with O_EXCL (atomic on local filesystems and NFSv3+), keeps the
+    lease alive by touching it while processing (see lease_heartbeat), then records the result and deletes the lease.
+    Leases not touched for QUEUE_LEASE_SECONDS belong to dead nodes: they are reclaimed by renaming them, which only
+    one node can do. Times are compared on the clock of the shared filesystem (file modification times), not on the
+    clocks of the nodes.
+    """
+
+    def __init__(self, root: str, node: str = None):
+        """
+        :param root: folder of the queue, created if missing.
+        :param node: name of this node. If None, the host name and the process id.
+        """
+        self.root = root
+        self.node = node or f"{socket.gethostname()}-{os.getpid()}"
+        for folder in [LEASES_DIR, DONE_DIR, FAILED_DIR, NODES_DIR]:
+            os.makedirs(os.path.join(root, folder), exist_ok=True)
+        self.units = []
+
+    def create_units(self, files: list[str], unit_files: int) -> list[dict]:
+        """
+        Splits the input files into units of unit_files files, unless another node already did: then its units are
+        used, so that all the nodes work on the same units whatever inputs they were given.
+
+        :param files: paths of the input files, the same on every node.
+        :param unit_files: number of files of each unit.
+        :return: the units, dictionaries with the id, the files, their number of documents and the index of the first
+                 document (used to name the outputs, as a single run would).
+        """
+        path = os.path.join(self.root, UNITS_FILE)
+        if not os.path.exists(path):
+            units, first_index = [], 0
+            for start in range(0, len(files), unit_files):
+                chunk = files[start:start + unit_files]
+                docs = sum(_count_documents(filepath) for filepath in chunk)
+                units.append({"id": f"{len(units):06d}", "files": chunk, "docs": docs, "first_index": first_index})
+                first_index += docs
+            # Written aside, then linked: os.link fails if another node created the file in the meantime
+            temp_path = f"{path}.{self.node}.tmp"
+            _write_json(temp_path, units)
+            try:
+                os.link(temp_path, path)
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(temp_path)
+        self.units = read_json_file(path)
+        return self.units
+
+    def claim(self) -> dict | None:
+        """Claims a unit neither done, failed nor leased by a live node, starting from a different unit on each node
+        to limit contention. Returns the unit, or None if there is none left to claim."""
+        finished = set(os.listdir(os.path.join(self.root, DONE_DIR))) | set(os.listdir(os.path.join(self.root, FAILED_DIR)))
+        start = zlib.crc32(self.node.encode("utf-8")) % len(self.units) if self.units else 0
+        for unit in self.units[start:] + self.units[:start]:
+            if f"{unit['id']}.json" in finished:
+                continue
+            lease = self._lease_path(unit)
+            if os.path.exists(lease):
+                if not self._reclaim(lease):
+                    continue
+            try:
+                fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                continue        # Claimed by another node in the meantime
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"node": self.node, "unit": unit["id"]}, f)
+            if os.path.exists(os.path.join(self.root, DONE_DIR, f"{unit['id']}.json")):
+                os.remove(lease)    # Finished by the node whose lease was just released
+                continue
+            self.update_node("running", unit["id"])
+            return unit
+        return None
+
+    def leased(self) -> bool:
+        """Whether some units neither done nor failed are leased, by live nodes or by dead ones to be reclaimed."""
+        finished = set(os.listdir(os.path.join(self.root, DONE_DIR))) | set(os.listdir(os.path.join(self.root, FAILED_DIR)))
+        return any(name.endswith(".lease") and f"{name[:-len('.lease')]}.json" not in finished
+                   for name in os.listdir(os.path.join(self.root, LEASES_DIR)))
+
+    def heartbeat(self, unit: dict) -> bool:
+        """Keeps the lease of a unit alive, returning False if it was reclaimed by another node."""
+        try:
+            with open(self._lease_path(unit), encoding="utf-8") as f:
+                if json.load(f)["node"] != self.node:
+                    return False
+            os.utime(self._lease_path(unit))
+            return True
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def complete(self, unit: dict, result: dict) -> None:
+        """Records the result of a unit (files, documents, outputs, quarantine, seconds) and releases its lease."""
+        _write_json(os.path.join(self.root, DONE_DIR, f"{unit['id']}.json"), {"unit": unit["id"], "node": self.node, **result})
+        self._release(unit)
+
+    def fail(self, unit: dict, error: str) -> None:
+        """Records the error of a unit, which is not claimed again until its file in failed/ is deleted, and releases
+        its lease."""
+        _write_json(os.path.join(self.root, FAILED_DIR, f"{unit['id']}.json"), {"unit": unit["id"], "node": self.node, "error": error})
+        self._release(unit)
+
+    def update_node(self, state: str, unit: str = None) -> None:
+        """Writes the status of this node (idle, running a unit, done), shown by status."""
+        _write_json(os.path.join(self.root, NODES_DIR, f"{self.node}.json"), {"node": self.node, "state": state, "unit": unit})
+
+    def filesystem_time(self) -> float:
+        """Current time on the clock of the shared filesystem, the modification time of a file just touched."""
+        path = os.path.join(self.root, CLOCK_FILE)
+        with open(path, "a"):
+            os.utime(path)
+        return os.stat(path).st_mtime
+
+    def status(self) -> dict:
+        """
+        Progress of the queue: units, files and documents done, failed, running (with their node and the seconds since
+        their last heartbeat), expired (leases of dead nodes, to be reclaimed) and pending, documents per second of the
+        nodes together since the first unit done was started, estimated remaining seconds and the activity of each node.
+        """
+        units = read_json_file(os.path.join(self.root, UNITS_FILE)) if os.path.exists(os.path.join(self.root, UNITS_FILE)) else []
+        now = self.filesystem_time()
+        done, failed, running, expired = {}, {}, [], []
+        for unit in units:
+            done_path = os.path.join(self.root, DONE_DIR, f"{unit['id']}.json")
+            failed_path = os.path.join(self.root, FAILED_DIR, f"{unit['id']}.json")
+            lease = self._lease_path(unit)
+            if os.path.exists(done_path):
+                done[unit["id"]] = {**_read_json(done_path), "finished": os.stat(done_path).st_mtime}
+            elif os.path.exists(failed_path):
+                failed[unit["id"]] = _read_json(failed_path)
+            elif os.path.exists(lease):
+                try:
+                    age = now - os.stat(lease).st_mtime
+                except FileNotFoundError:
+                    continue
+                entry = {"unit": unit["id"], "node": _read_json(lease).get("node"), "heartbeat_s": round(age, 1)}
+                (expired if age > QUEUE_LEASE_SECONDS else running).append(entry)
+
+        nodes = {}
+        for name in os.listdir(os.path.join(self.root, NODES_DIR)):
+            path = os.path.join(self.root, NODES_DIR, name)
+            node = _read_json(path)
+            nodes[node.get("node", name)] = {"state": node.get("state"), "unit": node.get("unit"),
+                                             "last_seen_s": round(now - os.stat(path).st_mtime, 1),
+                                             "units": 0, "docs": 0, "seconds": 0.0}
+        for result in done.values():
+            node = nodes.setdefault(result["node"], {"state": None, "unit": None, "last_seen_s": None, "units": 0, "docs": 0, "seconds": 0.0})
+            node["units"] += 1
+            node["docs"] += result["docs"]
+            node["seconds"] += result["seconds"]
+
+        total_docs = sum(unit["docs"] for unit in units)
+        docs_done = sum(result["docs"] for result in done.values())
+        started = min((result["finished"] - result["seconds"] for result in done.values()), default=now)
+        docs_per_s = docs_done / (now - started) if done and now > started else None
+        return {"units": len(units),
+                "files": sum(len(unit["files"]) for unit in units),
+                "docs": total_docs,
+                "done": {"units": len(done), "files": sum(len(result["files"]) for result in done.values()), "docs": docs_done},
+                "failed": list(failed.values()),
+                "running": running,
+                "expired": expired,
+                "pending": len(units) - len(done) - len(failed) - len(running) - len(expired),
+                "progress": docs_done / total_docs if total_docs else 1.0,
+                "docs_per_s": docs_per_s,
+                "eta_s": (total_docs - docs_done) / docs_per_s if docs_per_s else None,
+                "quarantine": [entry for result in done.values() for entry in result.get("quarantine", [])],
+                "nodes": nodes}
+
+    def _lease_path(self, unit: dict) -> str:
+        return os.path.join(self.root, LEASES_DIR, f"{unit['id']}.lease")
+
+    def _reclaim(self, lease: str) -> bool:
+        """Removes an expired lease, returning whether it was expired and this node removed it."""
+        try:
+            mtime = os.stat(lease).st_mtime
+        except FileNotFoundError:
+            return True         # Released in the meantime
+        if self.filesystem_time() - mtime <= QUEUE_LEASE_SECONDS:
+            return False
+        owner = _read_json(lease).get("node")
+        # Renaming is atomic: when several nodes reclaim the same lease, only one of them succeeds
+        stale = f"{lease}.{self.node}.stale"
+        try:
+            os.rename(lease, stale)
+        except FileNotFoundError:
+            return False
+        # The lease may have been renewed, or released and claimed again, between the check and the rename: the file
+        # moved aside is checked again, and put back unless it is the expired lease
+        if os.stat(stale).st_mtime != mtime or _read_json(stale).get("node") != owner:
+            try:
+                os.link(stale, lease)   # Unlike a rename, fails instead of replacing a lease created in the meantime
+            except FileExistsError:
+                pass
+            os.remove(stale)
+            return False
+        os.remove(stale)
+        return True
+
+    def _release(self, unit: dict) -> None:
+        try:
+            if self.heartbeat(unit):
+                os.remove(self._lease_path(unit))
+        except FileNotFoundError:
+            pass
+        self.update_node("idle")
+
+
+class LeaseLost(Exception):
+    """Raised when the lease of the unit being processed was reclaimed by another node."""
+
+
+@contextmanager
+def lease_heartbeat(queue: WorkQueue, unit: dict, interval: float = QUEUE_HEARTBEAT_SECONDS):
+    """
+    Context manager keeping the lease of a unit alive from a background thread while the unit is processed.
+    Yields a function raising LeaseLost once the lease was reclaimed by another node, to be called before writing the
+    outputs of the unit: they are then left to that node.
+    """
+    stop, lost = threading.Event(), threading.Event()
+
+    def beat():
+        while not stop.wait(interval):
+            # Retried once: another node checking the lease may have moved it aside for a moment (see WorkQueue._reclaim)
+            if not queue.heartbeat(unit) and (stop.wait(HEARTBEAT_RETRY_SECONDS) or not queue.heartbeat(unit)):
+                if not stop.is_set(): lost.set()
+                return
+            queue.update_node("running", unit["id"])
+
+    def check():
+        if lost.is_set():
+            raise LeaseLost(f"The lease of unit {unit['id']} was reclaimed by another node.")
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield check
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _count_documents(path: str) -> int:
+    """Number of documents of an input file, without reading the PDFs referenced on S3."""
+    if os.path.splitext(path)[1].lower() != ".json":
+        return 1
+    try:
+        return len(read_json_file(path)[PATIENT_DATA_FIELDS[1]])
+    except (OSError, ValueError, KeyError, TypeError):
+        return 0            # Reported as unreadable when its unit is processed
+
+
+def _read_json(path: str) -> dict:
+    try:
+        return read_json_file(path)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_json(path: str, data) -> None:
+    """Writes a JSON file atomically: to a temporary file flushed to disk, then renamed over the target."""
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
@@ -0,0 +1,136 @@
+import os
+import sys
+import json
+import stat
+import queue
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+
+from spacy import Language
+
+from config import SERVER_HOST, SERVER_PORT, SERVER_MAX_REQUEST_MB, SERVER_QUEUE_TIMEOUT
+from utils.batching_utils import MicroBatcher
+from utils.model_utils import get_model_name, get_model_version
+
+MB = 1024 ** 2
+
+
+class _UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+class AnonymizationRequestHandler(BaseHTTPRequestHandler):
+    """
+    Endpoints of the anonymization service:
+    - POST /anonymize        {"text": str, "personal_data": dict | null}           -> {"text": str}
+    - POST /anonymize/batch  {"texts": [str], "personal_data": [dict | null] | null} -> {"texts": [str]}
+    - GET  /health           model name and version
+    - GET  /stats            throughput and latency statistics (see MicroBatcher.stats)
+    """
+    server_version = "Anonymizer"
+    batcher: MicroBatcher = None
+    nlp: Language = None
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(HTTPStatus.OK, {"status": "ok", "model": get_model_name(self.nlp), "version": get_model_version(self.nlp)})
+        elif self.path == "/stats":
+            self._send_json(HTTPStatus.OK, self.batcher.stats())
+        else:
+            self._send_json(HTTPStatus.NOT_FOUND, {"error": f"Unknown endpoint '{self.path}'."})
+
+    def do_POST(self):
+        if self.path not in ("/anonymize", "/anonymize/batch"):
+            self._send_json(HTTPStatus.NOT_FOUND, {"error": f"Unknown endpoint '{self.path}'."})
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        if length > SERVER_MAX_REQUEST_MB * MB:
+            self._send_json(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {"error": f"Requests are limited to {SERVER_MAX_REQUEST_MB} MB."})
+            return
+        try:
+            body = json.loads(self.rfile.read(length))
+            if self.path == "/anonymize":
+                texts, personal_data = [body["text"]], [body.get("personal_data")]
+            else:
+                texts = body["texts"]
+                personal_data = body.get("personal_data") or [None] * len(texts)
+            if not isinstance(texts, list) or not all(isinstance(t, str) for t in texts) \
+                    or not isinstance(personal_data, list) or len(personal_data) != len(texts) \
+                    or not all(_valid_personal_data(pd) for pd in personal_data):
+                raise ValueError("texts must be strings, with one personal data dictionary of strings (or null) for each text.")
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(HTTPStatus.BAD_REQUEST, {"error": f"Invalid request: {e}"})
+            return
+
+        try:
+            futures = [self.batcher.submit(t, pd, timeout=SERVER_QUEUE_TIMEOUT) for t, pd in zip(texts, personal_data)]
+        except queue.Full:
+            self._send_json(HTTPStatus.SERVICE_UNAVAILABLE, {"error": "Too many pending requests or not enough memory, retry later."})
+            return
+        try:
+            anonymized = [future.result() for future in futures]
+        except Exception as e:
+            self._send_json(HTTPStatus.INTERNAL_SERVER_ERROR, {"error": f"{type(e).__name__}: {e}"})
+            return
+
+        self._send_json(HTTPStatus.OK, {"text": anonymized[0]} if self.path == "/anonymize" else {"texts": anonymized})
+
+    def _send_json(self, status: HTTPStatus, data: dict) -> None:
+        payload = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def address_string(self) -> str:
+        # Clients of Unix sockets have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+
+def _valid_personal_data(personal_data) -> bool:
+    """Whether the personal data of a request is null or a dictionary of strings, so that a malformed request is
+    rejected instead of failing the micro-batch it would be anonymized in."""
+    return personal_data is None or isinstance(personal_data, dict) \
+        and all(isinstance(key, str) and isinstance(value, str) for key, value in personal_data.items())
+
+
+def serve(nlp: Language,
+          host: str = SERVER_HOST,
+          port: int = SERVER_PORT,
+          socket_path: str = None,
+          **batcher_kwargs) -> None:
+    """
+    Runs the anonymization service until interrupted, keeping the model loaded. Texts of concurrent requests are
+    anonymized together in micro-batches (see utils.batching_utils.MicroBatcher).
+
+    :param nlp: loaded spaCy Language model.
+    :param host: address to listen on. Use a local address, since the service has no authentication.
+    :param port: TCP port to listen on.
+    :param socket_path: path of a Unix socket to listen on instead of host and port.
+    :param batcher_kwargs: arguments of MicroBatcher (batching settings and arguments of anonymize_texts).
+    """
+    batcher = MicroBatcher(nlp, **batcher_kwargs)
+    handler = type("Handler", (AnonymizationRequestHandler,), {"batcher": batcher, "nlp": nlp})
+
+    if socket_path:
+        # Remove the socket file left by a previous run
+        if os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode): os.remove(socket_path)
+        server = _UnixHTTPServer(socket_path, handler)
+        address = f"unix:{socket_path}"
+    else:
+        server = ThreadingHTTPServer((host, port), handler)
+        address = f"http://{host}:{port}"
+
+    print(f"Anonymization service listening on {address}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        if socket_path and os.path.exists(socket_path): os.remove(socket_path)
+
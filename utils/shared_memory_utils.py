@@ -0,0 +1,115 @@
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from rules.rules import apply_rules
+from utils.anonymization_utils import doc_to_spans
+from utils.cpu_utils import init_pinned_worker
+from utils.memory_utils import memory_zone
+from utils.model_utils import load_worker_model
+
+SPAN_DTYPE = np.dtype([("doc_id", np.int64), ("start", np.int32), ("end", np.int32), ("label_id", np.int16)])
+
+_worker = {}    # State of the current worker process, set by _init_worker
+
+
+class SharedTexts:
+    """
+    Texts packed into a single shared UTF-8 buffer together with a shared array of byte offsets, so that worker
+    processes can read them by index without receiving them through pickling.
+    """
+
+    def __init__(self, texts: list[str]):
+        encoded = [text.encode("utf-8") for text in texts]
+        offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+
+        self.buffer = SharedMemory(create=True, size=max(1, int(offsets[-1])))
+        for e, start in zip(encoded, offsets):
+            self.buffer.buf[start:start + len(e)] = e
+        self.offsets = SharedMemory(create=True, size=offsets.nbytes)
+        np.ndarray(offsets.shape, dtype=np.int64, buffer=self.offsets.buf)[:] = offsets
+
+        self.descriptor = (self.buffer.name, self.offsets.name, len(texts))
+
+    def close(self) -> None:
+        """Releases and removes the shared buffers."""
+        for shm in (self.buffer, self.offsets):
+            shm.close()
+            shm.unlink()
+
+
+def predict_spans_shared(texts: list[str],
+                         personal_data: list[dict[str, str]],
+                         per_matching: int,
+                         model_args: dict,
+                         labels: list[str],
+                         plan: dict,
+                         chunk_size: int) -> list[list[tuple[int, int, str]]]:
+    """
+    Runs NER and rules on the given texts in a pool of worker processes, each loading its own copy of the model
+    (unless preloaded, see load_worker_model).
+    Texts are read by the workers from shared memory, and the entity spans are written by the workers into shared
+    arrays of (doc_id, start, end, label_id), so only small descriptors cross process boundaries.
+
+    :param texts: the list of texts to process.
+    :param personal_data: list of dictionaries of specific personal data to anonymize for each text.
+    :param per_matching: level of extra PER matching of the rules.
+    :param model_args: arguments of load_model used by the workers to load the model (see get_model_load_args).
+    :param labels: list of all the labels the model and the rules can produce, indexed by label_id.
+    :param plan: CPU plan (see utils.cpu_utils.plan_cpu_usage) giving the number of workers and their threads.
+    :param chunk_size: number of texts processed by a worker in each task.
+    :return: the (start, end, label) entity spans of each text.
+    """
+    shared = SharedTexts(texts)
+    spans = [[] for _ in texts]
+    try:
+        with Pool(processes=plan["processes"], initializer=_init_worker,
+                  initargs=(model_args, shared.descriptor, labels, plan)) as pool:
+            tasks = [(i, min(i + chunk_size, len(texts)), per_matching, personal_data[i:i + chunk_size])
+                     for i in range(0, len(texts), chunk_size)]
+            for name, count in pool.imap_unordered(_process_range, tasks):
+                for doc_id, start, end, label_id in _read_spans(name, count).tolist():
+                    spans[doc_id].append((start, end, labels[label_id]))
+    finally:
+        shared.close()
+    return spans
+
+
+def _read_spans(name: str, count: int) -> np.ndarray:
+    """Copies the spans written by a worker out of their shared array, then removes it."""
+    shm = SharedMemory(name=name)
+    try:
+        return np.ndarray((count,), dtype=SPAN_DTYPE, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def _init_worker(model_args: dict, texts_descriptor: tuple[str, str, int], labels: list[str], plan: dict) -> None:
+    buffer_name, offsets_name, n_texts = texts_descriptor
+    _worker["buffer"] = SharedMemory(name=buffer_name)
+    _worker["offsets_shm"] = SharedMemory(name=offsets_name)
+    _worker["offsets"] = np.ndarray((n_texts + 1,), dtype=np.int64, buffer=_worker["offsets_shm"].buf)
+    _worker["label_ids"] = {label: i for i, label in enumerate(labels)}
+    _worker["nlp"] = load_worker_model(model_args)
+    init_pinned_worker(plan)  # After loading the model, so that torch is imported and gets its thread limit
+
+
+def _process_range(task: tuple[int, int, int, list[dict[str, str]]]) -> tuple[str, int]:
+    """Processes the texts with index in [start, end) and returns the name and length of the shared array of their spans."""
+    start, end, per_matching, personal_data = task
+    buffer, offsets = _worker["buffer"].buf, _worker["offsets"]
+    texts = [bytes(buffer[offsets[i]:offsets[i + 1]]).decode("utf-8") for i in range(start, end)]
+
+    rows = []
+    with memory_zone(_worker["nlp"]):
+        for doc_id, doc, per_data in zip(range(start, end), _worker["nlp"].pipe(texts), personal_data):
+            rows += [(doc_id, s, e, _worker["label_ids"][label]) for s, e, label in doc_to_spans(apply_rules(doc, per_matching, per_data))]
+
+    spans = np.array(rows, dtype=SPAN_DTYPE)
+    shm = SharedMemory(create=True, size=max(1, spans.nbytes))
+    np.ndarray(spans.shape, dtype=SPAN_DTYPE, buffer=shm.buf)[:] = spans
+    shm.close()  # The parent process removes it after reading
+    return shm.name, len(rows)
@@ -0,0 +1,83 @@
+import os
+from pathlib import Path
+
+import spacy
+from spacy import Language
+from spacy_transformers.data_classes import HFObjects
+from transformers import AutoConfig, AutoModel, AutoTokenizer
+from transformers.modeling_utils import no_init_weights
+
+from utils.json_utils import read_json_file, save_json_file
+
+SNAPSHOT_WEIGHTS_FILE = "model.safetensors"
+SNAPSHOT_INFO_FILE = "snapshot.json"
+
+
+def _source_fingerprint(model_path: str | Path) -> dict:
+    """Size and modification time of the serialized transformer the snapshot was taken from."""
+    stat = os.stat(Path(model_path) / "transformer" / "model")
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def save_transformer_snapshot(nlp: Language, model_path: str | Path, output_dir: str | Path) -> str:
+    """
+    Saves the HuggingFace model wrapped by the transformer component as a safetensors file, together with its
+    configuration and tokenizer. Unlike the msgpack/pickle serialization of spaCy, the weights can be memory-mapped
+    at load time, so they are neither deserialized nor randomly initialized first.
+
+    :param nlp: spaCy Language model loaded from model_path with a PyTorch transformer component.
+    :param model_path: folder of the model, whose transformer file is fingerprinted to detect stale snapshots.
+    :param output_dir: folder where to save the snapshot.
+    :return: the path of the snapshot folder.
+    """
+    from safetensors.torch import save_model
+
+    trf = nlp.get_pipe("transformer").model
+    os.makedirs(output_dir, exist_ok=True)
+    save_model(trf.transformer, os.path.join(output_dir, SNAPSHOT_WEIGHTS_FILE))  # Handles tied weights
+    trf.transformer.config.save_pretrained(output_dir)
+    trf.tokenizer.save_pretrained(output_dir)
+    save_json_file(os.path.join(output_dir, SNAPSHOT_INFO_FILE), _source_fingerprint(model_path))
+    return str(output_dir)
+
+
+def is_snapshot_current(model_path: str | Path, snapshot_dir: str | Path) -> bool:
+    """Whether the snapshot exists and was taken from the current transformer of the model."""
+    info_path = Path(snapshot_dir) / SNAPSHOT_INFO_FILE
+    return info_path.is_file() and read_json_file(str(info_path)) == _source_fingerprint(model_path)
+
+
+def load_snapshot_model(model_path: str | Path, snapshot_dir: str | Path) -> Language:
+    """
+    Loads a spaCy model whose transformer weights are memory-mapped from the snapshot saved by
+    save_transformer_snapshot. The pipeline is built from the model configuration and every component except the
+    transformer is deserialized from disk; the HuggingFace model is created without initializing its weights, which
+    are then assigned the tensors mapped from the safetensors file, so pages are only read when first used.
+
+    :param model_path: path of the spaCy model.
+    :param snapshot_dir: folder containing the snapshot of the transformer.
+    :return: the loaded Language model.
+    """
+    from safetensors.torch import load_file
+
+    model_path = Path(model_path)
+    config = spacy.util.load_config(model_path / "config.cfg")
+    meta = spacy.util.load_meta(model_path / "meta.json")
+    nlp = spacy.util.load_model_from_config(config, meta=meta)
+    nlp.from_disk(model_path, exclude=["transformer"])
+
+    with no_init_weights():
+        transformer = AutoModel.from_config(AutoConfig.from_pretrained(snapshot_dir))
+    missing, unexpected = transformer.load_state_dict(load_file(os.path.join(snapshot_dir, SNAPSHOT_WEIGHTS_FILE)),
+                                                      strict=False, assign=True)
+    transformer.tie_weights()
+    # Weights missing from the file are only allowed if tied to loaded ones (saved once by save_model)
+    state = transformer.state_dict()
+    loaded = {tensor.data_ptr() for name, tensor in state.items() if name not in missing}
+    if unexpected or any(state[name].data_ptr() not in loaded for name in missing):
+        raise ValueError(f"Snapshot in '{snapshot_dir}' does not match the transformer configuration.")
+
+    trf = nlp.get_pipe("transformer")
+    tokenizer = AutoTokenizer.from_pretrained(snapshot_dir, use_fast=True)
+    trf.model.attrs["set_transformer"](trf.model, HFObjects(tokenizer, transformer.eval(), None))
+    return nlp
@@ -0,0 +1,94 @@
+from collections import deque
+from multiprocessing import Pool
+from typing import Any, Iterable, Iterator
+
+from spacy import Language
+
+from anonymization_functions import anonymize_texts
+from config import MEMORY_GOVERNOR
+from utils.cpu_utils import init_pinned_worker
+from utils.memory_utils import MemoryGovernor
+from utils.model_utils import load_worker_model, get_model_load_args
+
+_worker = {}    # State of the current worker process, set by _init_worker
+
+
+def anonymize_stream(batches: Iterable[tuple[Any, list[str], list[dict[str, str] | None]]],
+                     nlp: Language,
+                     plan: dict,
+                     ordered: bool = True,
+                     **anonymize_kwargs) -> Iterator[tuple[Any, list[str] | Exception]]:
+    """
+    Anonymizes a stream of batches of texts, yielding each batch as soon as it is done, so that arbitrarily long
+    streams are processed with bounded memory. With more than one planned process, batches are anonymized by worker
+    processes each loading its own copy of the model (unless preloaded, see load_worker_model), with at most two
+    batches per worker in flight. Under memory pressure (see MemoryGovernor), intake pauses until the batches in flight
+    are done or the memory drops.
+
+    :param batches: iterable of (key, texts, personal data of each text) batches. Keys are returned unchanged.
+    :param nlp: loaded spaCy Language model (loaded again by the worker processes).
+    :param plan: CPU plan (see utils.cpu_utils.plan_cpu_usage) giving the number of workers and their threads.
+    :param ordered: whether batches are yielded in input order. If False, they are yielded as soon as they are done.
+    :param anonymize_kwargs: other arguments of anonymize_texts (e.g. entities, per_matching).
+    :return: iterator of (key, anonymized texts) pairs, or (key, exception) for the batches that failed.
+    """
+    if plan["processes"] <= 1:
+        for key, texts, personal_data in batches:
+            try:
+                yield key, _anonymize_batch(texts, personal_data, nlp, anonymize_kwargs)
+            except Exception as e:
+                yield key, e
+        return
+
+    window = plan["processes"] * 2
+    governor = MemoryGovernor() if MEMORY_GOVERNOR else None
+    model_args = get_model_load_args(nlp, plan["threads_per_process"])
+    with Pool(plan["processes"], initializer=_init_worker, initargs=(model_args, plan, anonymize_kwargs)) as pool:
+        running = deque()
+        for key, texts, personal_data in batches:
+            while governor is not None and running and governor.check():
+                yield from _collect(running, ordered, block=True)
+            running.append((key, pool.apply_async(_anonymize_worker_batch, (texts, personal_data))))
+            yield from _collect(running, ordered, block=len(running) >= window)
+        yield from _collect(running, ordered, block=True, until_empty=True)
+
+
+def _collect(running: deque, ordered: bool, block: bool, until_empty: bool = False) -> Iterator[tuple[Any, list[str] | Exception]]:
+    """
+    Yields the finished batches (only the leading ones if ordered), waiting for at least one of them if block,
+    or for all of them if until_empty.
+    """
+    while running:
+        if ordered:
+            done = [running[0]] if block or until_empty or running[0][1].ready() else []
+        else:
+            done = [item for item in running if item[1].ready()]
+        if not done:
+            if not (block or until_empty): return
+            running[0][1].wait(0.01)
+            continue
+
+        for item in done:
+            running.remove(item)
+            key, result = item
+            try:
+                yield key, result.get()
+            except Exception as e:
+                yield key, e
+        block = False
+
+
+def _anonymize_batch(texts: list[str], personal_data: list[dict[str, str] | None], nlp: Language, anonymize_kwargs: dict) -> list[str]:
+    anonymized, _ = anonymize_texts(texts, nlp=nlp, personal_data=personal_data, multi_processing=False,
+                                    auto_tuning=False, **anonymize_kwargs)
+    return anonymized
+
+
+def _init_worker(model_args: dict, plan: dict, anonymize_kwargs: dict) -> None:
+    _worker["nlp"] = load_worker_model(model_args)
+    _worker["anonymize_kwargs"] = anonymize_kwargs
+    init_pinned_worker(plan)  # After loading the model, so that torch is imported and gets its thread limit
+
+
+def _anonymize_worker_batch(texts: list[str], personal_data: list[dict[str, str] | None]) -> list[str]:
+    return _anonymize_batch(texts, personal_data, _worker["nlp"], _worker["anonymize_kwargs"])
@@ -0,0 +1,285 @@
+import sys
+import time
+import threading
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Callable, Iterator
+
+# Pipeline stages, in processing order
+READ_STAGE = "read"
+S3_FETCH_STAGE = "s3_fetch"
+PDF_EXTRACTION_STAGE = "pdf_extraction"
+TOKENIZATION_STAGE = "tokenization"
+TRANSFORMER_STAGE = "transformer"
+NER_STAGE = "ner"
+RULES_STAGE = "rules"
+MERGE_STAGE = "merge"
+REPLACEMENT_STAGE = "replacement"
+WRITE_STAGE = "write"
+STAGES = [READ_STAGE, S3_FETCH_STAGE, PDF_EXTRACTION_STAGE, TOKENIZATION_STAGE, TRANSFORMER_STAGE, NER_STAGE,
+          RULES_STAGE, MERGE_STAGE, REPLACEMENT_STAGE, WRITE_STAGE]
+COMPONENT_STAGES = {"transformer": TRANSFORMER_STAGE}   # Stage of each pipeline component, NER_STAGE for the others
+PERCENTILES = (50, 95, 99)
+
+_active_metrics = ContextVar("pipeline_metrics", default=None)
+
+
+class PipelineMetrics:
+    """
+    Timings and counters of the stages of the pipeline, collected while active (see collect_pipeline_metrics).
+    Stage times are exclusive: the time of a stage nested in another one (e.g. the S3 fetch of a file being read) is
+    only counted for the inner stage, so that the stage times add up to the time spent in the pipeline.
+    Stages processing batches of documents (tokenization, transformer, ner) are split among the documents of the batch
+    in proportion to their length.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.samples = {}       # Seconds of each timed call (or of each document of a batch) of each stage
+        self.documents = []     # Length and optional description of each document, indexed by document id
+        self.doc_times = {}     # Seconds of each stage for each document id
+        self.counters = Counter()
+        self.lock = threading.Lock()
+        self.frames = {}        # Stack of the open stages of each thread, by thread id (read by utils.profiling_utils)
+        self.memory_stages = set()      # Stages whose allocations are traced with tracemalloc (see utils.profiling_utils)
+        self.memory_frames = 1          # Number of frames stored by tracemalloc for each allocation of the memory stages
+        self.memory_warmed_up = set()   # Memory stages already called once (the first call, which builds caches, is not traced)
+        self.memory_peaks = {}          # Peak bytes allocated by each call of the memory stages
+        self.memory_snapshots = {}      # tracemalloc snapshot taken at the end of the call of each memory stage with the highest peak
+
+    def add_documents(self, texts: list[str]) -> int:
+        """Registers the given texts as new documents, returning the id of the first one (the others follow)."""
+        with self.lock:
+            first = len(self.documents)
+            self.documents += [{"chars": len(text)} for text in texts]
+        self.count("docs", len(texts))
+        self.count("chars", sum(len(text) for text in texts))
+        return first
+
+    def describe_documents(self, first: int, **fields: list) -> None:
+        """Adds the given fields (e.g. source=[...]) to the documents starting at id first."""
+        with self.lock:
+            for name, values in fields.items():
+                for doc_id, value in enumerate(values, start=first):
+                    self.documents[doc_id][name] = value
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self.lock:
+            self.counters[name] += n
+
+    def record(self, stage: str, seconds: float, doc_ids: list[int] = None, weights: list[float] = None) -> None:
+        """Records the time of a stage, split among the given documents in proportion to weights (equally if None)."""
+        with self.lock:
+            samples = self.samples.setdefault(stage, [])
+            if not doc_ids:
+                samples.append(seconds)
+                return
+            total = sum(weights) if weights else 0
+            for i, doc_id in enumerate(doc_ids):
+                share = seconds * weights[i] / total if total else seconds / len(doc_ids)
+                samples.append(share)
+                if doc_id is not None:
+                    times = self.doc_times.setdefault(doc_id, {})
+                    times[stage] = times.get(stage, 0.0) + share
+
+    def report(self, include_documents: bool = True) -> dict:
+        """
+        Aggregated metrics: wall time (since collection started, model loading included) and time spent in the stages,
+        documents and characters per second over the wall time, counters, and for each stage the total
+        time, its share of the time spent in stages and the percentiles of the time per document (per call for the
+        stages not attributed to documents, like reading and writing files).
+
+        :param include_documents: whether to include the stage times of each document.
+        """
+        with self.lock:
+            wall = time.perf_counter() - self.started
+            timed = sum(sum(samples) for samples in self.samples.values())
+            stages = {}
+            for stage in sorted(self.samples, key=_stage_order):
+                per_doc = [times[stage] for times in self.doc_times.values() if stage in times]
+                values = sorted(per_doc or self.samples[stage])
+                total = sum(self.samples[stage])
+                stages[stage] = {"total_s": total,
+                                 "share": total / timed if timed else 0.0,
+                                 "count": len(values),
+                                 **{f"p{p}_ms": values[min(len(values) - 1, int(p / 100 * len(values)))] * 1000 for p in PERCENTILES},
+                                 "max_ms": values[-1] * 1000}
+            report = {"wall_s": wall,
+                      "timed_s": timed,
+                      "docs": self.counters["docs"],
+                      "chars": self.counters["chars"],
+                      "docs_per_s": self.counters["docs"] / wall if wall else 0.0,
+                      "chars_per_s": self.counters["chars"] / wall if wall else 0.0,
+                      "counters": dict(self.counters),
+                      "stages": stages}
+            if include_documents:
+                report["documents"] = [{"id": doc_id, **info, "stages_ms": {
+                                            stage: times[stage] * 1000 for stage in sorted(times, key=_stage_order)}}
+                                       for doc_id, info in enumerate(self.documents)
+                                       for times in [self.doc_times.get(doc_id, {})]]
+        return report
+
+    def summary(self) -> str:
+        """One-line summary of the throughput and of the share of each stage, for the live output."""
+        report = self.report(include_documents=False)
+        stages = ", ".join(f"{stage} {values['share']:.0%}" for stage, values in report["stages"].items())
+        return (f"{report['counters'].get('processed', 0)}/{report['docs']} docs in {report['wall_s']:.1f} s, "
+                f"{report['counters'].get('processed', 0) / report['wall_s']:.2f} docs/s, "
+                f"{report['chars_per_s'] / 1000:.1f}k chars/s | {stages}")
+
+    def record_memory(self, stage: str, peak: int) -> None:
+        """Records the peak bytes allocated by a call of a memory stage, taking a snapshot if it is the highest so far."""
+        with self.lock:
+            peaks = self.memory_peaks.setdefault(stage, [])
+            highest = not peaks or peak > max(peaks)
+            peaks.append(peak)
+        if highest:
+            self.memory_snapshots[stage] = tracemalloc.take_snapshot()
+
+    def current_stage(self, thread_id: int) -> str | None:
+        """Name of the innermost stage open in the given thread, or None."""
+        names = [frame["name"] for frame in list(self.frames.get(thread_id, ())) if frame["name"] is not None]
+        return names[-1] if names else None
+
+    def _frames(self) -> list:
+        return self.frames.setdefault(threading.get_ident(), [])
+
+
+@contextmanager
+def collect_pipeline_metrics(live_interval: float = None) -> Iterator[PipelineMetrics]:
+    """
+    Context manager in which the stages of the pipeline run by the current thread are timed.
+
+    :param live_interval: if given, a summary of the metrics is printed on stderr every live_interval seconds.
+    :return: the PipelineMetrics being collected.
+    """
+    metrics = PipelineMetrics()
+    token = _active_metrics.set(metrics)
+    stop = threading.Event()
+    if live_interval:
+        threading.Thread(target=_print_live_summary, args=(metrics, live_interval, stop), daemon=True).start()
+    try:
+        yield metrics
+    finally:
+        stop.set()
+        _active_metrics.reset(token)
+
+
+def get_pipeline_metrics() -> PipelineMetrics | None:
+    """The metrics being collected by the current thread, or None."""
+    return _active_metrics.get()
+
+
+@contextmanager
+def stage(name: str | None, doc_ids: list[int] = None, weights: list[float] = None):
+    """
+    Context manager timing a stage of the pipeline, if metrics are being collected (otherwise it does nothing).
+    Nested stages are subtracted from the enclosing one. Stages without doc_ids are attributed to the documents of the
+    enclosing stage, if any; with name None, the block is not a stage and only attributes its stages to doc_ids.
+
+    :param name: name of the stage (see STAGES).
+    :param doc_ids: ids of the documents processed by the stage (see PipelineMetrics.add_documents).
+    :param weights: relative cost of each document (e.g. its length), used to split the time among them.
+    """
+    metrics = _active_metrics.get()
+    if metrics is None:
+        yield
+        return
+
+    frames = metrics._frames()
+    parent = frames[-1] if frames else None
+    if doc_ids is None and parent is not None:
+        doc_ids, weights = parent["doc_ids"], parent["weights"]
+    frame = {"name": name, "doc_ids": doc_ids, "weights": weights, "nested": 0.0, "peak": 0}
+    traced = name in metrics.memory_stages and name in metrics.memory_warmed_up
+    if name in metrics.memory_stages:
+        metrics.memory_warmed_up.add(name)
+    if traced:
+        # Tracing only while the outermost memory stage runs, since it slows down every allocation
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing: tracemalloc.start(metrics.memory_frames)
+        allocated = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    frames.append(frame)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        frames.pop()
+        if name is not None:
+            metrics.record(name, elapsed - frame["nested"], doc_ids, weights)
+        if traced:
+            # Nested memory stages reset the peak, so the highest one they saw is kept in their parent frame
+            peak = max(tracemalloc.get_traced_memory()[1], frame["peak"])
+            metrics.record_memory(name, peak - allocated)
+            if parent is not None: parent["peak"] = max(parent["peak"], peak)
+            if started_tracing: tracemalloc.stop()
+        if parent is not None:
+            parent["nested"] += elapsed if name is not None else frame["nested"]
+
+
+def timed_stage(name: str) -> Callable:
+    """Decorator timing each call of a function as the given stage (see stage)."""
+    def decorator(func: Callable) -> Callable:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def register_documents(texts: list[str]) -> list[int] | None:
+    """Registers the given texts in the metrics being collected, returning their document ids, or None if not collecting."""
+    metrics = _active_metrics.get()
+    if metrics is None:
+        return None
+    first = metrics.add_documents(texts)
+    return list(range(first, first + len(texts)))
+
+
+def count(name: str, n: int = 1) -> None:
+    """Increments a counter of the metrics being collected, if any."""
+    metrics = _active_metrics.get()
+    if metrics is not None:
+        metrics.count(name, n)
+
+
+def pipe_by_stage(nlp, texts: list[str], doc_ids: list[int] = None, batch_size: int = None) -> Iterator:
+    """
+    Equivalent of nlp.pipe in the current process, running the tokenizer and each component on a batch of texts at a
+    time, so that each of them can be timed as a stage.
+
+    :param nlp: loaded spaCy Language model.
+    :param texts: texts to process.
+    :param doc_ids: ids of the documents of the texts, to attribute them the stage times.
+    :param batch_size: number of texts processed together. If None, the batch size of the model.
+    :return: iterator of the processed docs.
+    """
+    batch_size = batch_size or nlp.batch_size
+    for start in range(0, len(texts), batch_size):
+        batch = texts[start:start + batch_size]
+        ids = doc_ids[start:start + batch_size] if doc_ids is not None else None
+        weights = [len(text) for text in batch]
+        with stage(TOKENIZATION_STAGE, ids, weights):
+            docs = [nlp.make_doc(text) for text in batch]
+        for name, component in nlp.pipeline:
+            with stage(COMPONENT_STAGES.get(name, NER_STAGE), ids, weights):
+                docs = list(component.pipe(docs, batch_size=batch_size)) if hasattr(component, "pipe") \
+                    else [component(doc) for doc in docs]
+        yield from docs
+
+
+def _stage_order(stage: str) -> int:
+    return STAGES.index(stage) if stage in STAGES else len(STAGES)
+
+
+def _print_live_summary(metrics: PipelineMetrics, interval: float, stop: threading.Event) -> None:
+    while not stop.wait(interval):
+        if not metrics.samples:
+            continue    # Still loading the model
+        print(f"[metrics] {metrics.summary()}", file=sys.stderr, flush=True)
@@ -0,0 +1,221 @@
+import os
+import time
+from collections import deque
+from multiprocessing import Pool, SimpleQueue
+from typing import Any, Callable
+
+from config import EXTRACTION_TIMEOUT, NER_TIMEOUT, RULES_TIMEOUT
+from rules.rules import apply_rules
+from utils.anonymization_utils import doc_to_spans, read_file
+from utils.cpu_utils import init_pinned_worker
+from utils.memory_utils import memory_zone
+from utils.model_utils import load_worker_model
+
+# Reason codes of quarantined documents
+EXTRACTION_TIMEOUT_REASON = "extraction_timeout"
+EXTRACTION_ERROR_REASON = "extraction_error"
+NER_TIMEOUT_REASON = "ner_timeout"
+RULES_TIMEOUT_REASON = "rules_timeout"
+PROCESSING_ERROR_REASON = "processing_error"
+
+TIMEOUT = "timeout"     # Failure returned by Watchdog.map for items that exceeded their time budget
+
+_worker = {}    # State of the current worker process, set by _init_watchdog_worker and _init_model_worker
+
+
+class Watchdog:
+    """
+    Process pool running each item under a time budget, starting when a worker picks the item up. Items exceeding it
+    are reported as failed, and the workers are killed and restarted, so that a single pathological input cannot stall
+    the items processed after it.
+    """
+
+    def __init__(self, processes: int = 1, initializer: Callable = None, initargs: tuple = ()):
+        """
+        :param processes: number of worker processes.
+        :param initializer: function called by each worker process when started (also after restarts).
+        :param initargs: arguments of the initializer.
+        """
+        self.processes = max(1, processes)
+        self.initializer = initializer
+        self.initargs = initargs
+        self.pool = None
+        self.started = None     # Indexes of the items picked up by the workers, sent by _run_item
+
+    def __enter__(self):
+        self._start()
+        return self
+
+    def __exit__(self, *exc):
+        self.pool.terminate()
+        self.pool.join()
+
+    def _start(self) -> None:
+        # A new queue for each pool, since killing the workers may leave the previous one locked
+        self.started = SimpleQueue()
+        self.pool = Pool(self.processes, initializer=_init_watchdog_worker,
+                         initargs=(self.started, self.initializer, self.initargs))
+        # Wait for all the workers to be initialized, so that loading times are not counted in the budgets. The first
+        # worker ready may take all the readiness tasks, so they are sent again until every worker answered
+        ready = set()
+        while len(ready) < self.processes:
+            ready.update(self.pool.map(_ready, range(self.processes), chunksize=1))
+
+    def _restart(self) -> None:
+        self.pool.terminate()
+        self.pool.join()
+        self._start()
+
+    def map(self, func: Callable, items: list, timeouts: list[float] | float) -> list[tuple[bool, Any]]:
+        """
+        Applies func to each item in the worker processes, with at most one item running on each worker at a time.
+        The budget of each item starts when a worker picks it up.
+
+        :param func: picklable function of one argument.
+        :param items: the items to process.
+        :param timeouts: time budget in seconds of each item, or the same budget for all the items.
+        :return: for each item, (True, result) or (False, reason), where reason is TIMEOUT or a description of the
+                 exception raised by func.
+        """
+        if not isinstance(timeouts, list): timeouts = [timeouts] * len(items)
+        results = [None] * len(items)
+        pending, running = deque(range(len(items))), {}
+
+        while pending or running:
+            while pending and len(running) < self.processes:
+                i = pending.popleft()
+                running[i] = (self.pool.apply_async(_run_item, (func, i, items[i])), None)
+            while not self.started.empty():
+                i = self.started.get()
+                if i in running and running[i][1] is None:
+                    running[i] = (running[i][0], time.monotonic() + timeouts[i])
+
+            for i in [i for i, (result, _) in running.items() if result.ready()]:
+                result, _ = running.pop(i)
+                try:
+                    results[i] = (True, result.get())
+                except Exception as e:
+                    results[i] = (False, f"{type(e).__name__}: {e}")
+
+            now = time.monotonic()
+            expired = [i for i, (result, deadline) in running.items() if deadline is not None and now > deadline]
+            if expired:
+                for i in expired:
+                    running.pop(i)
+                    results[i] = (False, TIMEOUT)
+                # Pool workers cannot be killed one by one: restart all of them and resubmit the interrupted items
+                pending.extendleft(sorted(running, reverse=True))
+                running.clear()
+                self._restart()
+            elif running:
+                next(iter(running.values()))[0].wait(0.01)
+
+        return results
+
+
+def _init_watchdog_worker(started: SimpleQueue, initializer: Callable, initargs: tuple) -> None:
+    _worker["started"] = started
+    if initializer is not None: initializer(*initargs)
+
+
+def _ready(_) -> int:
+    time.sleep(0.01)    # Leaves the other readiness tasks to the other workers
+    return os.getpid()
+
+
+def _run_item(func: Callable, index: int, item) -> Any:
+    """Reports to the watchdog that the item is picked up, starting its budget, then applies func to it."""
+    _worker["started"].put(index)
+    return func(item)
+
+
+def read_files_with_watchdog(paths: list[str], timeout: float = EXTRACTION_TIMEOUT, processes: int = 1,
+                             reader: Callable = read_file) -> tuple[list[tuple[str, tuple]], list[dict]]:
+    """
+    Reads files (see utils.anonymization_utils.read_file) in worker processes under a time budget per file.
+
+    :param paths: paths of the files to read.
+    :param timeout: time budget in seconds for reading each file, including the text extraction of PDF files.
+    :param processes: number of worker processes.
+    :param reader: module-level function reading a file, read_file or one returning more about it.
+    :return: a tuple containing the (path, reader result) pairs of the files read and the quarantine records of the others.
+    """
+    with Watchdog(processes) as watchdog:
+        results = watchdog.map(reader, paths, timeout)
+
+    read, quarantine = [], []
+    for path, (ok, value) in zip(paths, results):
+        if ok:
+            read.append((path, value))
+        else:
+            quarantine.append(quarantine_record(EXTRACTION_TIMEOUT_REASON if value == TIMEOUT else EXTRACTION_ERROR_REASON,
+                                                source=path, detail=None if value == TIMEOUT else value))
+    return read, quarantine
+
+
+def predict_spans_with_watchdog(texts: list[str],
+                                personal_data: list[dict[str, str]],
+                                per_matching: int,
+                                model_args: dict,
+                                plan: dict,
+                                chunk_size: int,
+                                ner_timeout: float = NER_TIMEOUT,
+                                rules_timeout: float = RULES_TIMEOUT) -> list[tuple[bool, Any]]:
+    """
+    Runs NER and rules on the given texts in worker processes, each loading its own copy of the model (unless preloaded,
+    see load_worker_model), under time budgets per document. Texts are processed in chunks with a budget proportional
+    to their size; the texts of a chunk exceeding it are retried one by one, so that only the texts exceeding their own
+    budget are quarantined.
+
+    :param texts: the list of texts to process.
+    :param personal_data: list of dictionaries of specific personal data to anonymize for each text.
+    :param per_matching: level of extra PER matching of the rules.
+    :param model_args: arguments of load_model used by the workers to load the model (see get_model_load_args).
+    :param plan: CPU plan (see utils.cpu_utils.plan_cpu_usage) giving the number of workers and their threads.
+    :param chunk_size: number of texts processed by a worker in each task.
+    :param ner_timeout: time budget in seconds for NER and rules on each text.
+    :param rules_timeout: time budget in seconds for the rules on each text, enforced through regex timeouts.
+    :return: for each text, (True, spans) or (False, reason code).
+    """
+    results = [None] * len(texts)
+    chunks = [list(range(i, min(i + chunk_size, len(texts)))) for i in range(0, len(texts), chunk_size)]
+
+    with Watchdog(plan["processes"], initializer=_init_model_worker, initargs=(model_args, plan)) as watchdog:
+        while chunks:
+            tasks = [([texts[i] for i in chunk], per_matching, [personal_data[i] for i in chunk], rules_timeout) for chunk in chunks]
+            outcomes = watchdog.map(_process_texts, tasks, [(ner_timeout + rules_timeout) * len(chunk) for chunk in chunks])
+
+            retry = []
+            for chunk, (ok, value) in zip(chunks, outcomes):
+                if ok:
+                    for i, result in zip(chunk, value): results[i] = result
+                elif len(chunk) > 1:
+                    retry += [[i] for i in chunk]
+                else:
+                    results[chunk[0]] = (False, NER_TIMEOUT_REASON if value == TIMEOUT else PROCESSING_ERROR_REASON)
+            chunks = retry
+
+    return results
+
+
+def quarantine_record(reason: str, index: int = None, source: str = None, detail: str = None) -> dict:
+    """Record describing a document skipped because it exceeded its time budget or made a stage fail."""
+    return {"index": index, "source": source, "reason": reason, "detail": detail}
+
+
+def _init_model_worker(model_args: dict, plan: dict) -> None:
+    _worker["nlp"] = load_worker_model(model_args)
+    init_pinned_worker(plan)  # After loading the model, so that torch is imported and gets its thread limit
+
+
+def _process_texts(task: tuple[list[str], int, list[dict[str, str]], float]) -> list[tuple[bool, Any]]:
+    """Runs NER and rules on a chunk of texts, returning (True, spans) or (False, reason code) for each text."""
+    texts, per_matching, personal_data, rules_timeout = task
+    results = []
+    with memory_zone(_worker["nlp"]):
+        for doc, per_data in zip(_worker["nlp"].pipe(texts), personal_data):
+            try:
+                results.append((True, doc_to_spans(apply_rules(doc, per_matching, per_data, timeout=rules_timeout))))
+            except TimeoutError:
+                results.append((False, RULES_TIMEOUT_REASON))
+    return results